@@ -17,10 +17,119 @@ ALLOWED_HOSTS = ['*']
 
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://localhost:6379/0')
+# Redis для состояния обработки исследований, пока их части ждут результатов YOLO
+REDIS_URL = os.getenv('REDIS_URL', CELERY_BROKER_URL)
+STUDY_PROGRESS_TTL = int(os.getenv('STUDY_PROGRESS_TTL', str(24 * 3600)))
+# Идемпотентность стадий (конвертация, отправка частей, сборка): блокировка выполняемой стадии
+# истекает через NII_STAGE_LOCK_TTL (после падения воркера стадию забирает повторная доставка),
+# отметка о выполнении хранится NII_STAGE_DONE_TTL
+NII_STAGE_LOCK_TTL = int(os.getenv('NII_STAGE_LOCK_TTL', '3600'))
+NII_STAGE_DONE_TTL = int(os.getenv('NII_STAGE_DONE_TTL', str(24 * 3600)))
 
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 
+# Очереди Celery: 'render' — CPU (конвертация тома, рендеринг PNG, сборка исследования),
+# 'dispatch' — короткие I/O задачи обмена с сервером YOLO, 'maintenance' — фоновое обслуживание
+# (вытеснение кэша конвертации) и всё остальное.
+# Каждую очередь обслуживает свой воркер со своими параллельностью и prefetch (celery_worker.sh)
+CELERY_TASK_DEFAULT_QUEUE = 'maintenance'
+CELERY_TASK_ROUTES = {
+    'WebSite.tasks.convert_patient_nii': {'queue': 'render'},
+    'WebSite.tasks.render_slices': {'queue': 'render'},
+    'WebSite.tasks.finalize_study': {'queue': 'render'},
+    'WebSite.tasks.render_done': {'queue': 'dispatch'},
+    'WebSite.tasks.dispatch_inference': {'queue': 'dispatch'},
+    'WebSite.tasks.handle_inference_result': {'queue': 'dispatch'},
+    'WebSite.tasks.check_inference_part': {'queue': 'dispatch'},
+    'WebSite.tasks.evict_conversion_cache': {'queue': 'maintenance'},
+}
+# Приоритеты в Redis: 0 — наивысший. Срочные исследования (поле при загрузке) получают
+# NII_URGENT_PRIORITY, остальные — CELERY_TASK_DEFAULT_PRIORITY; подзадачи наследуют приоритет
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+    # Неподтверждённая задача доставляется снова не раньше, чем истечёт блокировка её стадии
+    'visibility_timeout': NII_STAGE_LOCK_TTL,
+}
+CELERY_TASK_DEFAULT_PRIORITY = int(os.getenv('CELERY_TASK_DEFAULT_PRIORITY', '5'))
+CELERY_TASK_INHERIT_PARENT_PRIORITY = True
+NII_URGENT_PRIORITY = int(os.getenv('NII_URGENT_PRIORITY', '0'))
+# Воркер не набирает задачи впрок, иначе срочная задача ждёт за уже полученными
+CELERY_WORKER_PREFETCH_MULTIPLIER = int(os.getenv('CELERY_WORKER_PREFETCH_MULTIPLIER', '1'))
+# Задача подтверждается после выполнения: при падении воркера она доставляется повторно,
+# а уже выполненные стадии пропускаются (WebSite.progress.StageLock)
+CELERY_TASK_ACKS_LATE = True
+CELERY_TASK_REJECT_ON_WORKER_LOST = True
+
+# Загрузка NIfTI: файлы больше FILE_UPLOAD_MAX_MEMORY_SIZE пишутся во временный файл,
+# а в хранилище копируются по частям NII_UPLOAD_CHUNK_SIZE
+NII_UPLOAD_MAX_SIZE = int(os.getenv('NII_UPLOAD_MAX_SIZE', str(1024 ** 3)))
+NII_UPLOAD_CHUNK_SIZE = int(os.getenv('NII_UPLOAD_CHUNK_SIZE', str(1024 ** 2)))
+# Лимит NII_UPLOAD_MAX_SIZE проверяется при разборе тела (его начинает уже CsrfViewMiddleware),
+# поэтому слишком большой запрос не принимается целиком и не попадает во временный файл
+FILE_UPLOAD_HANDLERS = [
+    'WebSite.upload_handlers.UploadSizeLimitHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
+# Конвертация NIfTI -> PNG: рендерер и пул кодирования PNG для просмотра (render_slices)
+NII_RENDERER = os.getenv('NII_RENDERER', 'pil')  # 'pil' или 'matplotlib'
+NII_OUTPUT_SIZE = int(os.getenv('NII_OUTPUT_SIZE', '640'))  # большая сторона PNG, px
+NII_CONVERT_WORKERS = int(os.getenv('NII_CONVERT_WORKERS', '4'))  # параллельное кодирование срезов
+# 'thread' или 'process'; в дочернем процессе prefork-воркера Celery процессы недоступны,
+# там всегда используются потоки
+NII_CONVERT_EXECUTOR = os.getenv('NII_CONVERT_EXECUTOR', 'thread')
+# Нормализация интенсивности по всему набору срезов: 'percentile', 'minmax', 'zscore'
+# или 'slice' (каждый срез по своим min/max, как раньше)
+NII_NORMALIZATION = os.getenv('NII_NORMALIZATION', 'percentile')
+NII_NORMALIZATION_PERCENTILES = tuple(
+    float(p) for p in os.getenv('NII_NORMALIZATION_PERCENTILES', '0.5,99.5').split(',')
+)
+NII_NORMALIZATION_ZSCORE = float(os.getenv('NII_NORMALIZATION_ZSCORE', '3'))  # ширина окна, σ
+# Срезы передаются на инференс через raw/slices.npz, PNG рендерятся параллельно с инференсом;
+# 'png' — после обработки в raw остаются только PNG, 'array' — slices.npz сохраняется
+NII_HANDOFF = os.getenv('NII_HANDOFF', 'png')
+# Срезов в одной задаче рендеринга PNG и в одном запросе к YOLO (части обрабатываются параллельно)
+NII_RENDER_CHUNK_SIZE = int(os.getenv('NII_RENDER_CHUNK_SIZE', '16'))
+NII_INFERENCE_CHUNK_SIZE = int(os.getenv('NII_INFERENCE_CHUNK_SIZE', '16'))
+NII_INFERENCE_CHUNK_ATTEMPTS = int(os.getenv('NII_INFERENCE_CHUNK_ATTEMPTS', '3'))  # попыток части на сервере
+# Если результат части не пришёл за NII_INFERENCE_TIMEOUT секунд (callback потерян, сервер
+# перезапущен), часть отправляется повторно; меньше visibility_timeout, иначе проверка задвоится
+NII_INFERENCE_TIMEOUT = int(os.getenv('NII_INFERENCE_TIMEOUT', '900'))
+
+# HTTP-клиент сервера YOLO в воркерах Celery: пул keep-alive соединений, повторы с экспоненциальной
+# задержкой и автомат отключения — после YOLO_BREAKER_THRESHOLD ошибок подряд запросы не отправляются
+# YOLO_BREAKER_RESET секунд, а задачи откладываются. Так же откладываются задачи при ошибке соединения
+# и ответах 502/503/504 (задержка растёт от YOLO_HTTP_BACKOFF до YOLO_BREAKER_RESET), не больше
+# YOLO_BREAKER_MAX_REQUEUES раз
+YOLO_HTTP_POOL_SIZE = int(os.getenv('YOLO_HTTP_POOL_SIZE', '4'))
+YOLO_HTTP_TIMEOUT = float(os.getenv('YOLO_HTTP_TIMEOUT', '30'))  # с
+YOLO_HTTP_RETRIES = int(os.getenv('YOLO_HTTP_RETRIES', '3'))
+YOLO_HTTP_BACKOFF = float(os.getenv('YOLO_HTTP_BACKOFF', '0.5'))  # с, удваивается с каждой попыткой
+YOLO_BREAKER_THRESHOLD = int(os.getenv('YOLO_BREAKER_THRESHOLD', '5'))
+YOLO_BREAKER_RESET = float(os.getenv('YOLO_BREAKER_RESET', '30'))  # с
+YOLO_BREAKER_MAX_REQUEUES = int(os.getenv('YOLO_BREAKER_MAX_REQUEUES', '120'))
+
+# Выбор срезов: 'auto' — самые информативные срезы тома, 'fixed' — диапазон (124, 180)
+NII_SLICE_SELECTION = os.getenv('NII_SLICE_SELECTION', 'auto')
+NII_SLICE_TOP_K = int(os.getenv('NII_SLICE_TOP_K', '57'))
+NII_SLICE_MIN_FOREGROUND = float(os.getenv('NII_SLICE_MIN_FOREGROUND', '0.05'))  # доля среза
+NII_FOREGROUND_LEVEL = float(os.getenv('NII_FOREGROUND_LEVEL', '0.1'))  # порог интенсивности
+
+# Превью срезов для страницы просмотра
+NII_PREVIEW_SIZE = int(os.getenv('NII_PREVIEW_SIZE', '256'))  # большая сторона превью, px
+NII_PREVIEW_FORMAT = os.getenv('NII_PREVIEW_FORMAT', 'webp')  # 'webp' или 'jpeg'
+NII_PREVIEW_QUALITY = int(os.getenv('NII_PREVIEW_QUALITY', '75'))
+
+# Кэш конвертации и предсказаний (MEDIA_ROOT/cache)
+NII_CACHE_ENABLED = os.getenv('NII_CACHE_ENABLED', 'True').lower() in ('true', '1', 't')
+NII_CACHE_MAX_BYTES = int(os.getenv('NII_CACHE_MAX_BYTES', str(5 * 1024 ** 3)))
+# Версия модели берётся с сервера YOLO (хэш весов); тег добавляется к ней для ручного сброса кэша
+NII_CACHE_MODEL_TAG = os.getenv('NII_CACHE_MODEL_TAG', 'default')
+
 # Application definition
 
 INSTALLED_APPS = [
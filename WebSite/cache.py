@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def copy_file(src, dst):
+    """
+    Копирует файл, заменяя существующий.
+
+    Жёсткие ссылки не используются: файлы пациента потом перезаписываются
+    на месте (например, визуализации YOLO в predict/), и общий с кэшем inode
+    испортил бы запись для всех остальных пациентов.
+
+    Args:
+        src (str): Исходный файл.
+        dst (str): Путь назначения (существующий файл удаляется, а не перезаписывается).
+    """
+
+    if os.path.lexists(dst):
+        os.remove(dst)
+    shutil.copy2(src, dst)
+
+
+class ConversionCache:
+    """
+    Контентно-адресуемый кэш результатов конвертации и инференса.
+
+    Записи лежат в MEDIA_ROOT/cache/<ключ>/<стадия>/, где ключ — хэш от
+    содержимого тома и параметров конвертации. Давность использования записи
+    хранится во времени модификации её папки; при превышении лимита размера
+    evict удаляет записи, которые дольше всего не использовались (LRU).
+    Вытеснение обходит весь кэш, поэтому store его не вызывает: после
+    сохранения ставится задача evict_conversion_cache в очередь maintenance.
+    """
+
+    RAW = "raw"
+    PREDICT = "predict"
+
+    def __init__(self, root=None, max_bytes=None):
+        self.root = root or os.path.join(settings.MEDIA_ROOT, "cache")
+        self.max_bytes = settings.NII_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    @staticmethod
+    def make_key(checksum, params):
+        """
+        Вычисляет ключ записи кэша.
+
+        Args:
+            checksum (str): SHA-256 содержимого NIfTI файла.
+            params (dict): Параметры, влияющие на результат (диапазон срезов, версия рендерера и т.д.).
+
+        Returns:
+            str: Ключ записи.
+        """
+
+        payload = json.dumps({"checksum": checksum, **params}, sort_keys=True, default=list)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def restore(self, key, stage, dest_folder):
+        """
+        Восстанавливает файлы стадии из кэша в папку пациента.
+
+        Args:
+            key (str): Ключ записи.
+            stage (str): Стадия ("raw" или "predict").
+            dest_folder (str): Абсолютный путь к папке назначения.
+
+        Returns:
+            bool: True, если запись найдена и восстановлена.
+        """
+
+        entry = self._entry_path(key)
+        stage_folder = os.path.join(entry, stage)
+        if not os.path.isdir(stage_folder):
+            return False
+
+        try:
+            os.makedirs(dest_folder, exist_ok=True)
+            for name in os.listdir(stage_folder):
+                copy_file(os.path.join(stage_folder, name), os.path.join(dest_folder, name))
+            os.utime(entry)
+        except FileNotFoundError:
+            # Запись удалили при вытеснении во время восстановления
+            logger.warning(f"Запись кэша {key}/{stage} исчезла во время восстановления")
+            return False
+
+        logger.info(f"Кэш: восстановлено {stage} из {key} в {dest_folder}")
+        return True
+
+    def store(self, key, stage, src_folder):
+        """
+        Сохраняет файлы стадии в кэш.
+
+        Args:
+            key (str): Ключ записи.
+            stage (str): Стадия ("raw" или "predict").
+            src_folder (str): Абсолютный путь к папке с результатами.
+
+        Returns:
+            bool: True, если запись добавлена (False, если она уже была).
+        """
+
+        entry = self._entry_path(key)
+        if os.path.isdir(os.path.join(entry, stage)):
+            return False
+
+        os.makedirs(self.root, exist_ok=True)
+        tmp_folder = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+        try:
+            for name in os.listdir(src_folder):
+                src = os.path.join(src_folder, name)
+                if os.path.isfile(src):
+                    copy_file(src, os.path.join(tmp_folder, name))
+            os.makedirs(entry, exist_ok=True)
+            # Переименование атомарно: параллельные воркеры не увидят неполную запись
+            os.rename(tmp_folder, os.path.join(entry, stage))
+        except OSError:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            if os.path.isdir(os.path.join(entry, stage)):
+                return False
+            raise
+
+        os.utime(entry)
+        logger.info(f"Кэш: сохранено {stage} в {key}")
+        return True
+
+    @staticmethod
+    def _folder_size(folder):
+        total = 0
+        for dirpath, _, filenames in os.walk(folder):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+
+    def evict(self):
+        """
+        Удаляет давно не использованные записи, пока размер кэша превышает лимит.
+
+        Returns:
+            list: Ключи удалённых записей.
+        """
+
+        if not os.path.isdir(self.root):
+            return []
+
+        entries = []
+        for key in os.listdir(self.root):
+            entry = self._entry_path(key)
+            if key.startswith(".") or not os.path.isdir(entry):
+                continue
+            try:
+                entries.append((os.path.getmtime(entry), key, self._folder_size(entry)))
+            except OSError:
+                continue
+
+        total = sum(size for _, _, size in entries)
+        evicted = []
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+            total -= size
+            evicted.append(key)
+
+        if evicted:
+            logger.info(f"Кэш: вытеснено записей: {len(evicted)}, размер: {total} байт")
+        return evicted
@@ -0,0 +1,208 @@
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import tempfile
+import time
+from datetime import datetime, timezone
+from itertools import product
+
+import nibabel as nib
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from WebSite.utils import (AUTO_SLICE_RANGE, NII_LOADERS, SLICE_RENDERERS,
+                           convert_nii_to_png)
+
+
+def parse_shape(value):
+    """
+    Разбирает форму тома вида "240x240x155".
+
+    Args:
+        value (str): Форма тома.
+
+    Returns:
+        tuple: Форма тома.
+    """
+
+    try:
+        shape = tuple(int(dim) for dim in value.lower().split("x"))
+    except ValueError:
+        raise CommandError(f"Некорректная форма тома: {value}")
+    if len(shape) not in (3, 4):
+        raise CommandError(f"Ожидался 3D или 4D том: {value}")
+    return shape
+
+
+def make_synthetic_volume(shape, dtype, seed=0):
+    """
+    Создаёт синтетический том МРТ: зашумлённый эллипсоид «мозга» на нулевом фоне.
+
+    Args:
+        shape (tuple): Форма тома (x, y, z) или (x, y, z, t).
+        dtype (str): Тип данных, например "int16" или "float32".
+        seed (int): Зерно генератора случайных чисел.
+
+    Returns:
+        np.ndarray: Том заданной формы и типа.
+    """
+
+    rng = np.random.default_rng(seed)
+    x, y, z = (np.linspace(-1, 1, dim, dtype=np.float32) for dim in shape[:3])
+    radius = x[:, None, None] ** 2 / 0.8 + y[None, :, None] ** 2 / 0.6 + z[None, None, :] ** 2 / 0.9
+    brain = (radius < 1).astype(np.float32)
+    volume = brain * (500 + 300 * (1 - radius)) + rng.normal(0, 20, size=shape[:3]).astype(np.float32) * brain
+    if len(shape) == 4:
+        volume = np.repeat(volume[..., None], shape[3], axis=3)
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        volume = np.clip(np.rint(volume), np.iinfo(dtype).min, np.iinfo(dtype).max)
+    return volume.astype(dtype)
+
+
+def folder_size(folder):
+    """
+    Считает суммарный размер файлов папки в байтах.
+    """
+
+    return sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder))
+
+
+def run_case(connection, nii_path, output_folder, case, slice_range, workers, executor):
+    """
+    Выполняет один замер в отдельном процессе и отправляет результат через pipe.
+
+    Отдельный процесс нужен, чтобы пик RSS относился только к этому замеру.
+    """
+
+    try:
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        report = convert_nii_to_png(nii_path, output_folder, os.path.basename(nii_path),
+                                    slice_range=slice_range, renderer=case["renderer"],
+                                    loader=case["loader"], workers=workers, executor=executor)
+        wall_time = time.perf_counter() - started
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        slices = len(report["files"])
+        connection.send({
+            "slices": slices,
+            "wall_time": round(wall_time, 4),
+            "slices_per_sec": round(slices / wall_time, 2) if wall_time else None,
+            # ru_maxrss в Linux измеряется в килобайтах
+            "peak_rss_mb": round(peak_rss / 1024, 1),
+            "peak_rss_delta_mb": round((peak_rss - baseline_rss) / 1024, 1),
+            "bytes_written": folder_size(output_folder),
+        })
+    except Exception as e:
+        connection.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    """
+    Бенчмарк конвертации NIfTI -> PNG на синтетических томах.
+
+    Для каждой комбинации формы, типа данных, сжатия, рендерера и загрузчика
+    выводит срезы в секунду, пик RSS и объём записанных данных в JSON.
+    """
+
+    help = "Бенчмарк convert_nii_to_png на синтетических томах, результат в JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shapes", default="240x240x155,256x256x256",
+                            help="Формы томов через запятую, например 240x240x155,256x256x256x2")
+        parser.add_argument("--dtypes", default="int16,float32", help="Типы данных через запятую")
+        parser.add_argument("--compression", default="gz,none",
+                            help="Варианты файла: gz (.nii.gz) и/или none (.nii)")
+        parser.add_argument("--renderers", default=",".join(SLICE_RENDERERS),
+                            help="Рендереры через запятую")
+        parser.add_argument("--loaders", default=",".join(NII_LOADERS), help="Загрузчики через запятую")
+        parser.add_argument("--slice-range", default="124-180",
+                            help='Диапазон срезов "начало-конец" или "auto"')
+        parser.add_argument("--workers", type=int, default=None, help="Воркеры кодирования срезов")
+        parser.add_argument("--executor", default=None, help='Тип пула: "thread" или "process"')
+        parser.add_argument("--repeat", type=int, default=1, help="Число повторов каждого замера")
+        parser.add_argument("--output", default=None, help="Файл для JSON (по умолчанию stdout)")
+
+    def handle(self, *args, **options):
+        shapes = [parse_shape(value) for value in options["shapes"].split(",")]
+        dtypes = options["dtypes"].split(",")
+        compressions = options["compression"].split(",")
+        renderers = options["renderers"].split(",")
+        loaders = options["loaders"].split(",")
+
+        unknown = ([r for r in renderers if r not in SLICE_RENDERERS]
+                   + [l for l in loaders if l not in NII_LOADERS]
+                   + [c for c in compressions if c not in ("gz", "none")])
+        if unknown:
+            raise CommandError(f"Неизвестные варианты: {', '.join(unknown)}")
+
+        if options["slice_range"] == AUTO_SLICE_RANGE:
+            slice_range = AUTO_SLICE_RANGE
+        else:
+            try:
+                slice_range = tuple(int(n) for n in options["slice_range"].split("-"))
+            except ValueError:
+                raise CommandError(f"Некорректный диапазон срезов: {options['slice_range']}")
+
+        results = []
+        context = multiprocessing.get_context("fork")
+        with tempfile.TemporaryDirectory(prefix="bench_convert_") as tmp:
+            for shape, dtype, compression in product(shapes, dtypes, compressions):
+                extension = ".nii.gz" if compression == "gz" else ".nii"
+                nii_path = os.path.join(tmp, f"{'x'.join(map(str, shape))}_{dtype}{extension}")
+                nib.save(nib.Nifti1Image(make_synthetic_volume(shape, dtype), np.eye(4)), nii_path)
+
+                for renderer, loader, attempt in product(renderers, loaders, range(options["repeat"])):
+                    case = {
+                        "shape": list(shape),
+                        "dtype": dtype,
+                        "compressed": compression == "gz",
+                        "file_bytes": os.path.getsize(nii_path),
+                        "renderer": renderer,
+                        "loader": loader,
+                        "attempt": attempt,
+                    }
+                    # Абсолютный путь: os.path.join(MEDIA_ROOT, ...) его не изменит
+                    output_folder = tempfile.mkdtemp(dir=tmp)
+                    parent, child = context.Pipe(duplex=False)
+                    process = context.Process(target=run_case, args=(
+                        child, nii_path, output_folder, case, slice_range,
+                        options["workers"], options["executor"]))
+                    process.start()
+                    child.close()
+                    try:
+                        case.update(parent.recv())
+                    except EOFError:
+                        # Процесс умер, не отправив результат (например, убит по OOM)
+                        process.join()
+                        case["error"] = f"case process died with exit code {process.exitcode}"
+                    process.join()
+                    results.append(case)
+                    self.stderr.write(f"{case['shape']} {dtype} {compression} {renderer}/{loader}: "
+                                      f"{case.get('slices_per_sec', case.get('error'))} slices/s")
+
+        report = {
+            "meta": {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "nibabel": nib.__version__,
+                "cpu_count": os.cpu_count(),
+                "slice_range": slice_range,
+                "workers": options["workers"] or settings.NII_CONVERT_WORKERS,
+                "executor": options["executor"] or settings.NII_CONVERT_EXECUTOR,
+                "output_size": settings.NII_OUTPUT_SIZE,
+                "normalization": settings.NII_NORMALIZATION,
+            },
+            "results": results,
+        }
+        payload = json.dumps(report, indent=2, ensure_ascii=False)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(payload)
+        else:
+            self.stdout.write(payload)
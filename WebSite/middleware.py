@@ -17,7 +17,8 @@ def redirect_if_not_authenticated_middleware(get_response):
         HttpResponse: Ответ HTTP
     """
 
-    allowed_paths = ['/', '/login/', '/signup/']
+    # Callback сервера YOLO проверяет подписанный токен вместо сессии
+    allowed_paths = ['/', '/login/', '/signup/', '/inference/callback/']
 
     def middleware_sync(request):
         if (not request.user.is_authenticated and
@@ -0,0 +1,228 @@
+import functools
+import json
+import logging
+import uuid
+
+import redis
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_redis():
+    """
+    Возвращает клиент Redis для служебного состояния обработки (settings.REDIS_URL).
+    """
+
+    return redis.Redis.from_url(settings.REDIS_URL)
+
+
+class StudyProgress:
+    """
+    Состояние обработки исследования в Redis, пока его части выполняются независимо.
+
+    Запуск регистрирует количество частей и контекст для завершающей стадии.
+    Каждая часть (рендеринг или инференс, результат которого приходит через
+    callback сервера YOLO) сохраняет свой результат; та часть, которая
+    оказалась последней, получает True и запускает сборку исследования.
+    Повторный результат той же части не учитывается. Ключи удаляются через
+    settings.STUDY_PROGRESS_TTL секунд, если исследование так и не завершилось.
+
+    Args:
+        run_id (str): Идентификатор запуска обработки.
+        client (redis.Redis or None): Клиент Redis (по умолчанию get_redis()).
+    """
+
+    def __init__(self, run_id, client=None):
+        self.run_id = run_id
+        self.client = client or get_redis()
+        self.meta_key = f"study:{run_id}:meta"
+        self.parts_key = f"study:{run_id}:parts"
+
+    def start(self, expected, context):
+        """
+        Регистрирует запуск.
+
+        Args:
+            expected (int): Количество частей.
+            context (dict): Данные для завершающей стадии (пациент, ключи кэша).
+        """
+
+        pipe = self.client.pipeline()
+        pipe.hset(self.meta_key, mapping={"expected": expected, "context": json.dumps(context)})
+        pipe.expire(self.meta_key, settings.STUDY_PROGRESS_TTL)
+        pipe.execute()
+
+    def context(self):
+        """
+        Контекст запуска или None, если запуск не найден (истёк или уже собран).
+        """
+
+        context = self.client.hget(self.meta_key, "context")
+        return json.loads(context) if context else None
+
+    def complete(self, part, result):
+        """
+        Сохраняет результат части.
+
+        Args:
+            part (str): Имя части, например "render" или "infer:0003".
+            result (dict): Результат части.
+
+        Returns:
+            bool: True, если это последняя недостающая часть.
+        """
+
+        pipe = self.client.pipeline()
+        pipe.hsetnx(self.parts_key, part, json.dumps(result))
+        pipe.hlen(self.parts_key)
+        pipe.hget(self.meta_key, "expected")
+        pipe.expire(self.parts_key, settings.STUDY_PROGRESS_TTL)
+        added, done, expected, _ = pipe.execute()
+        if not added:
+            logger.info(f"Study run {self.run_id}: duplicate result for {part} ignored")
+            return False
+        return expected is not None and done == int(expected)
+
+    def results(self):
+        """
+        Результаты частей в порядке их имён.
+
+        Returns:
+            list: Результаты частей.
+        """
+
+        parts = self.client.hgetall(self.parts_key)
+        return [json.loads(parts[name]) for name in sorted(parts)]
+
+    def has_part(self, part):
+        """
+        Проверяет, сохранён ли уже результат части.
+        """
+
+        return bool(self.client.hexists(self.parts_key, part))
+
+    def clear(self):
+        """
+        Удаляет состояние запуска.
+        """
+
+        self.client.delete(self.meta_key, self.parts_key)
+
+
+class StageBusy(Exception):
+    """
+    Стадия выполняется другим воркером.
+
+    Args:
+        retry_after (int): Через сколько секунд истечёт блокировка.
+    """
+
+    def __init__(self, key, retry_after):
+        super().__init__(f"Стадия {key} выполняется, повтор через {retry_after} с")
+        self.retry_after = retry_after
+
+
+class StageLock:
+    """
+    Ключ идемпотентности стадии обработки пациента в Redis.
+
+    Пока стадия выполняется, ключ хранит токен владельца и истекает через
+    settings.NII_STAGE_LOCK_TTL секунд: если воркер умер, повторно доставленная
+    задача дожидается истечения блокировки и забирает стадию. Завершённая
+    стадия помечается на settings.NII_STAGE_DONE_TTL секунд, и повторная
+    доставка её пропускает.
+
+    Args:
+        patient_id (int or str): Уникальный идентификатор пациента.
+        stage (str): Стадия, например "convert" или "finalize".
+        client (redis.Redis or None): Клиент Redis (по умолчанию get_redis()).
+    """
+
+    DONE = "done"
+
+    def __init__(self, patient_id, stage, client=None):
+        self.key = f"stage:{patient_id}:{stage}"
+        self.client = client or get_redis()
+        self.token = uuid.uuid4().hex
+
+    def acquire(self):
+        """
+        Забирает стадию.
+
+        Returns:
+            bool: True, если стадия забрана, False, если она уже выполнена.
+
+        Raises:
+            StageBusy: Стадия выполняется другим воркером.
+        """
+
+        if self.client.set(self.key, self.token, nx=True, ex=settings.NII_STAGE_LOCK_TTL):
+            return True
+        if self.client.get(self.key) in (self.DONE, self.DONE.encode()):
+            logger.info(f"Stage {self.key} already completed, skipped")
+            return False
+        # Ключ мог истечь между set и ttl: тогда стадию можно забрать почти сразу
+        retry_after = max(self.client.ttl(self.key), 1)
+        logger.info(f"Stage {self.key} is running in another worker, retry in {retry_after} s")
+        raise StageBusy(self.key, retry_after)
+
+    def done(self):
+        """
+        Помечает стадию выполненной.
+        """
+
+        self.client.set(self.key, self.DONE, ex=settings.NII_STAGE_DONE_TTL)
+
+    def release(self):
+        """
+        Снимает блокировку, если она всё ещё принадлежит этому владельцу, чтобы стадию можно было повторить.
+        """
+
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                if pipe.get(self.key) in (self.token, self.token.encode()):
+                    pipe.multi()
+                    pipe.delete(self.key)
+                    pipe.execute()
+                else:
+                    pipe.unwatch()
+            except redis.WatchError:
+                pass
+
+
+def run_once(stage_of):
+    """
+    Декоратор задачи: выполняет её не больше одного раза для пациента и стадии (StageLock).
+
+    Если задача упала (в том числе ушла на повтор через retry), блокировка
+    снимается и стадия может выполниться снова. Уже выполненная стадия
+    пропускается (задача возвращает None). Если стадию держит другой воркер,
+    задача откладывается через retry до истечения его блокировки: держатель
+    мог умереть, и тогда стадию выполнит повтор. Задача должна быть
+    объявлена с bind=True.
+
+    Args:
+        stage_of (callable): По аргументам задачи возвращает (patient_id, stage).
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(task, *args, **kwargs):
+            lock = StageLock(*stage_of(task, *args, **kwargs))
+            try:
+                if not lock.acquire():
+                    return None
+            except StageBusy as e:
+                raise task.retry(countdown=e.retry_after)
+            try:
+                result = func(task, *args, **kwargs)
+            except BaseException:
+                lock.release()
+                raise
+            lock.done()
+            return result
+        return wrapper
+    return decorator
@@ -1,31 +1,205 @@
 import logging
 import os
-import requests
+import uuid
+from urllib.parse import urlencode
 
-from celery import shared_task
+import requests
+from celery import chord, shared_task
 from django.conf import settings
+from django.core import signing
 
-from .utils import convert_nii_to_png, get_patient, update_patient_server_path
+from .cache import ConversionCache
+from .progress import StudyProgress, run_once
+from .utils import (AUTO_SLICE_RANGE, HANDOFF_ARRAY, STACK_FILENAME, STUDY_FAILED, build_previews,
+                    conversion_cache_params, convert_nii_to_stack, file_checksum, get_patient,
+                    load_detections, render_stack_to_png, update_patient_diagnosis,
+                    update_patient_server_path)
+from .yolo_client import YoloUnavailable, get_client
 
 
 logger = logging.getLogger(__name__)
 
 
-# URL сервера YOLO, который можно переопределить через переменную окружения
-YOLO_SERVER_URL = os.getenv("YOLO_SERVER_URL",
-                            "http://yoloserver:8001/inference/")
+# URL сервера YOLO, которые можно переопределить через переменные окружения:
+# сохранение итога исследования по детекциям всех частей
+YOLO_SUMMARY_URL = os.getenv("YOLO_SUMMARY_URL",
+                             "http://yoloserver:8001/summary/")
+# URL очереди задач сервера YOLO и адрес сайта, на который сервер присылает их результат
+YOLO_JOBS_URL = os.getenv("YOLO_JOBS_URL",
+                          "http://yoloserver:8001/jobs/")
+YOLO_CALLBACK_URL = os.getenv("YOLO_CALLBACK_URL",
+                              "http://web:8000/inference/callback/")
+# Состояние сервера YOLO, в том числе версия загруженной модели (для ключа кэша предсказаний)
+YOLO_READY_URL = os.getenv("YOLO_READY_URL",
+                           "http://yoloserver:8001/ready")
+# Соль подписи токена callback (django.core.signing)
+CALLBACK_SALT = "inference-callback"
+
+# Ответы сервера YOLO (или прокси перед ним), означающие, что он перезапускается или перегружен
+YOLO_UNAVAILABLE_STATUSES = (502, 503, 504)
+
+# Диапазон срезов для NII_SLICE_SELECTION="fixed"
+FIXED_SLICE_RANGE = (124, 180)
+
+
+def split_chunks(items, chunk_size):
+    """
+    Делит список на части не длиннее chunk_size.
+
+    Args:
+        items (list): Элементы.
+        chunk_size (int): Максимальный размер части.
+
+    Returns:
+        list: Части списка в исходном порядке.
+    """
+
+    chunk_size = max(1, chunk_size)
+    return [items[start:start + chunk_size] for start in range(0, len(items), chunk_size)]
+
+
+def post_to_yolo(task, url, **kwargs):
+    """
+    Отправляет POST на сервер YOLO через пул соединений воркера.
+
+    Пока сервер недоступен (ошибка соединения, ответ 502/503/504) или автомат
+    отключения не пропускает запросы, задача откладывается с экспоненциальной
+    задержкой не дольше YOLO_BREAKER_RESET (до пробного запроса автомата), но
+    не больше YOLO_BREAKER_MAX_REQUEUES раз. После этого, как и при остальных
+    ошибках, исключение запроса передаётся вызывающему.
+
+    Args:
+        task (celery.Task): Текущая задача (bind=True).
+        url (str): Адрес.
+        **kwargs: Аргументы запроса.
+
+    Returns:
+        requests.Response: Успешный ответ.
+    """
+
+    try:
+        return get_client().post(url, **kwargs)
+    except YoloUnavailable as e:
+        error, countdown = e, e.retry_after
+    except requests.ConnectionError as e:
+        error, countdown = e, None
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code not in YOLO_UNAVAILABLE_STATUSES:
+            raise
+        error, countdown = e, None
+    if countdown is None:
+        countdown = min(settings.YOLO_HTTP_BACKOFF * 2 ** task.request.retries, settings.YOLO_BREAKER_RESET)
+    logger.warning(f"YOLO server unavailable ({error}), task {task.name} requeued in {countdown:.1f} s")
+    raise task.retry(exc=error, countdown=countdown, max_retries=settings.YOLO_BREAKER_MAX_REQUEUES)
+
+
+def model_cache_tag():
+    """
+    Версия модели сервера YOLO для ключа кэша предсказаний.
+
+    Версия вычисляется сервером по содержимому файла весов, поэтому после
+    горячей перезагрузки модели старые предсказания из кэша не используются.
+    К ней добавляется settings.NII_CACHE_MODEL_TAG для ручного сброса кэша.
+
+    Returns:
+        str or None: Тег модели или None, если сервер не сообщил версию (кэш предсказаний не используется).
+    """
+
+    try:
+        version = get_client().get(YOLO_READY_URL).json()["model_version"]
+    except (requests.RequestException, YoloUnavailable, ValueError, KeyError) as e:
+        logger.warning(f"YOLO model version unavailable, prediction cache skipped: {e}")
+        return None
+    return f"{version}:{settings.NII_CACHE_MODEL_TAG}"
+
+
+def inference_part(index):
+    """
+    Имя части инференса в состоянии обработки (сортируется в порядке частей).
+    """
+
+    return f"infer:{index:04d}"
+
+
+def complete_part(run_id, part, result):
+    """
+    Сохраняет результат части и, если она последняя, запускает сборку исследования.
+
+    Args:
+        run_id (str): Идентификатор запуска обработки.
+        part (str): Имя части.
+        result (dict): Результат части.
+    """
+
+    progress = StudyProgress(run_id)
+    if progress.complete(part, result):
+        context = progress.context()
+        results = progress.results()
+        progress.clear()
+        finalize_study.delay(results, **context)
+
+
+def retry_inference_part(run_id, index, server_path, image_names, attempt, reason):
+    """
+    Отправляет часть инференса повторно, а когда попытки исчерпаны, записывает
+    пациенту, что анализ не выполнен, и закрывает запуск.
+
+    Повторная отправка одной и той же попытки (callback с ошибкой и проверка
+    по таймауту) выполняется один раз: dispatch_inference идемпотентна по номеру попытки.
+
+    Args:
+        run_id (str): Идентификатор запуска обработки.
+        index (int): Номер части.
+        server_path (str): ID папки пациента на сервере.
+        image_names (list): Имена срезов части.
+        attempt (int): Номер неудавшейся попытки.
+        reason (str): Причина для журнала и диагноза.
+    """
+
+    progress = StudyProgress(run_id)
+    context = progress.context()
+    if context is None or progress.has_part(inference_part(index)):
+        return
+
+    next_attempt = attempt + 1
+    if next_attempt < settings.NII_INFERENCE_CHUNK_ATTEMPTS:
+        logger.warning(f"YOLO chunk {index} of folder {server_path}: {reason}, retry {next_attempt}")
+        dispatch_inference.apply_async((run_id, index, server_path, image_names, next_attempt),
+                                       countdown=2 ** next_attempt)
+        return
+
+    logger.error(f"YOLO chunk {index} of folder {server_path}: {reason} after {next_attempt} attempts, "
+                 f"study failed")
+    progress.clear()
+    update_patient_diagnosis(context["patient_id"], {
+        "diagnosis": STUDY_FAILED,
+        "error": f"часть {index + 1} не обработана сервером YOLO ({reason})"})
 
 
 @shared_task(bind=True)
-def convert_patient_nii(self, patient_id, full_path, filename):
+@run_once(lambda self, patient_id, *args, **kwargs: (patient_id, "convert"))
+def convert_patient_nii(self, patient_id, full_path, filename, checksum=None):
     """
-    Асинхронная задача для конвертации NIfTI файла в PNG и отправки на обработку YOLO-серверу.
+    Асинхронная задача для конвертации NIfTI файла и запуска обработки исследования.
+
+    Первая стадия workflow: том загружается и нормализуется один раз, выбранные
+    срезы сохраняются массивом raw/slices.npz. Затем параллельно запускаются
+    рендеринг PNG частями (chord из render_slices) и инференс частями
+    (dispatch_inference). Задача не ждёт сервер YOLO: он присылает результат
+    каждой части на callback, и последняя завершившаяся часть запускает
+    finalize_study. Упавшая часть повторяется отдельно, без повторной обработки
+    всего исследования.
+
+    Если такой же том уже обрабатывался с теми же параметрами, PNG и предсказания
+    берутся из кэша конвертации вместо повторного расчёта. Повторно доставленная
+    задача пропускается, если конвертация пациента уже выполнена или выполняется.
 
     Args:
         self (Celery task instance): Экземпляр задачи Celery.
         patient_id (int): Уникальный идентификатор пациента.
         full_path (str): Полный путь к NIfTI файлу.
         filename (str): Имя файла.
+        checksum (str or None): SHA-256 содержимого файла (вычисляется, если не передан).
     """
 
     logger.info(f"Start converting patient {patient_id}, file: {full_path}")
@@ -39,6 +213,8 @@ def convert_patient_nii(self, patient_id, full_path, filename):
         # Новый путь: media/png/<ID>/raw/
         raw_folder_name = os.path.join(str(patient.id), "raw")
         output_folder = os.path.join("png", raw_folder_name)
+        abs_raw_folder = os.path.join(settings.MEDIA_ROOT, output_folder)
+        abs_predict_folder = os.path.join(settings.MEDIA_ROOT, "png", str(patient.id), "predict")
 
         # Сохраняем "ID" как server_path
         server_path = str(patient.id)
@@ -46,23 +222,249 @@ def convert_patient_nii(self, patient_id, full_path, filename):
         logger.info(f"Путь к nii файлу: {nii_path}")
         logger.info(f"Папка вывода: {output_folder}")
 
-        # Конвертация
-        convert_nii_to_png(nii_path, output_folder, filename, slice_range=(124, 180))
+        if settings.NII_SLICE_SELECTION == "auto":
+            slice_range = AUTO_SLICE_RANGE
+        else:
+            slice_range = FIXED_SLICE_RANGE
+
+        cache = None
+        raw_key = predict_key = None
+        if settings.NII_CACHE_ENABLED:
+            cache = ConversionCache()
+            checksum = checksum or file_checksum(nii_path)
+            # PNG рендерятся из массива срезов рендерером settings.NII_RENDERER
+            params = conversion_cache_params(slice_range)
+            raw_key = cache.make_key(checksum, params)
+            model_tag = model_cache_tag()
+            if model_tag:
+                predict_key = cache.make_key(checksum, {**params, "model": model_tag})
+
+        # Загрузка и выбор срезов
+        render_chunks = []
+        if cache and cache.restore(raw_key, ConversionCache.RAW, abs_raw_folder):
+            logger.info(f"Cache hit for patient {patient_id}: PNG restored from {raw_key}")
+            build_previews(raw_folder_name)
+            slice_names = sorted((name for name in os.listdir(abs_raw_folder) if name.endswith(".png")),
+                                 key=lambda name: int(os.path.splitext(name)[0]))
+        else:
+            report = convert_nii_to_stack(nii_path, output_folder, slice_range=slice_range)
+            logger.info(f"Packed {len(report['slice_numbers'])} slices in {report['wall_time']:.2f}s")
+            slice_names = [f"{number}.png" for number in report["slice_numbers"]]
+            render_chunks = split_chunks(report["slice_numbers"], settings.NII_RENDER_CHUNK_SIZE)
 
         # Обновляем путь пациента
         update_patient_server_path(patient, server_path)
 
-        logger.info(f"Successfully converted patient {patient_id}, folder: {output_folder}")
+        inference_chunks = []
+        if predict_key and cache.restore(predict_key, ConversionCache.PREDICT, abs_predict_folder):
+            logger.info(f"Cache hit for patient {patient_id}: predictions restored, YOLO skipped")
+        else:
+            inference_chunks = split_chunks(slice_names, settings.NII_INFERENCE_CHUNK_SIZE)
 
-        # Отправка запроса на YOLO-сервер для начала инференса
-        logger.info(f"Sending inference request to YOLO server for folder: {server_path}")
-        response = requests.post(YOLO_SERVER_URL, params={"folder_id": f"{server_path}"}, timeout=600)
+        context = {"patient_id": patient.id,
+                   "raw_key": raw_key if render_chunks else None,
+                   "predict_key": predict_key if inference_chunks else None}
+        parts = (["render"] if render_chunks else []) + [inference_part(i) for i in range(len(inference_chunks))]
+        logger.info(f"Patient {patient_id}: {len(render_chunks)} render and "
+                    f"{len(inference_chunks)} inference chunks for folder {server_path}")
+        if not parts:
+            finalize_study.delay([], **context)
+            return
 
-        if response.status_code == 200:
-            logger.info(f"YOLO inference started for folder {server_path}")
-        else:
-            logger.warning(f"YOLO server returned status {response.status_code}: {response.text}")
+        run_id = uuid.uuid4().hex
+        StudyProgress(run_id).start(len(parts), context)
+        if render_chunks:
+            chord([render_slices.s(output_folder, chunk) for chunk in render_chunks])(render_done.s(run_id))
+        for index, chunk in enumerate(inference_chunks):
+            dispatch_inference.delay(run_id, index, server_path, chunk)
 
     except Exception as e:
         logger.error(f"Error converting patient {patient_id}: {e}", exc_info=True)
         raise
+
+
+@shared_task(autoretry_for=(OSError,), retry_backoff=True, max_retries=3)
+def render_slices(output_folder, slice_numbers):
+    """
+    Рендерит часть срезов из slices.npz в PNG для просмотра.
+
+    Args:
+        output_folder (str): Папка (относительно MEDIA_ROOT) с файлом slices.npz.
+        slice_numbers (list): Номера срезов части.
+
+    Returns:
+        dict: Пути к сохранённым PNG ("files").
+    """
+
+    return {"files": render_stack_to_png(output_folder, slice_numbers=slice_numbers)}
+
+
+@shared_task
+def render_done(results, run_id):
+    """
+    Отмечает рендеринг всех частей PNG в состоянии обработки.
+
+    Args:
+        results (list): Результаты render_slices.
+        run_id (str): Идентификатор запуска обработки.
+    """
+
+    complete_part(run_id, "render", {"files": [path for result in results for path in result["files"]]})
+
+
+@shared_task(bind=True)
+@run_once(lambda self, run_id, index, server_path, image_names, attempt=0:
+          (server_path, f"dispatch:{run_id}:{inference_part(index)}:{attempt}"))
+def dispatch_inference(self, run_id, index, server_path, image_names, attempt=0):
+    """
+    Ставит часть срезов исследования в очередь сервера YOLO и сразу завершается.
+
+    Сервер присылает результат на YOLO_CALLBACK_URL с подписанным токеном части,
+    воркер Celery не ждёт окончания инференса. Через NII_INFERENCE_TIMEOUT секунд
+    check_inference_part проверяет, что результат пришёл. Если часть так и не
+    удалось поставить в очередь (post_to_yolo исчерпал повторы), она
+    обрабатывается как упавшая.
+
+    Args:
+        run_id (str): Идентификатор запуска обработки.
+        index (int): Номер части.
+        server_path (str): ID папки пациента на сервере.
+        image_names (list): Имена срезов части.
+        attempt (int): Номер повторной отправки части (каждая попытка отправляется один раз).
+    """
+
+    priority = (self.request.delivery_info or {}).get("priority")
+    token = signing.dumps({"run_id": run_id, "index": index, "folder": server_path, "images": image_names,
+                           "attempt": attempt, "priority": priority}, salt=CALLBACK_SALT, compress=True)
+    callback_url = f"{YOLO_CALLBACK_URL}?{urlencode({'token': token})}"
+    try:
+        response = post_to_yolo(self, YOLO_JOBS_URL, params={"folder_id": server_path, "images": image_names,
+                                                             "callback_url": callback_url})
+    except (requests.RequestException, YoloUnavailable) as e:
+        retry_inference_part(run_id, index, server_path, image_names, attempt, f"not queued: {e}")
+        return
+    logger.info(f"Chunk {index} of folder {server_path} ({len(image_names)} slices) "
+                f"queued as YOLO job {response.json()['job_id']}")
+    check_inference_part.apply_async((run_id, index, server_path, image_names, attempt),
+                                     countdown=settings.NII_INFERENCE_TIMEOUT)
+
+
+@shared_task
+def check_inference_part(run_id, index, server_path, image_names, attempt):
+    """
+    Отправляет часть повторно, если её результат так и не пришёл.
+
+    Callback может не дойти: сервер YOLO отказывается от уведомления после
+    нескольких неудачных попыток, а очередь задач сервера хранится в памяти и
+    теряется при перезапуске. Тогда часть обрабатывается как упавшая.
+
+    Args:
+        run_id (str): Идентификатор запуска обработки.
+        index (int): Номер части.
+        server_path (str): ID папки пациента на сервере.
+        image_names (list): Имена срезов части.
+        attempt (int): Номер проверяемой попытки.
+    """
+
+    retry_inference_part(run_id, index, server_path, image_names, attempt,
+                         f"no result within {settings.NII_INFERENCE_TIMEOUT} s")
+
+
+@shared_task
+def handle_inference_result(run_id, index, server_path, image_names, status, images=None, error=None, attempt=0):
+    """
+    Обрабатывает результат части, присланный сервером YOLO на callback.
+
+    Успешная часть сохраняется в состоянии обработки, упавшая отправляется
+    повторно, пока не исчерпано NII_INFERENCE_CHUNK_ATTEMPTS попыток, после
+    чего исследование завершается с ошибкой.
+
+    Args:
+        run_id (str): Идентификатор запуска обработки.
+        index (int): Номер части.
+        server_path (str): ID папки пациента на сервере.
+        image_names (list): Имена срезов части.
+        status (str): Статус задачи сервера ("done", "failed" или "cancelled").
+        images (list or None): Детекции по срезам части.
+        error (str or None): Текст ошибки сервера.
+        attempt (int): Номер попытки, результат которой пришёл.
+    """
+
+    if status == "done":
+        complete_part(run_id, inference_part(index), {"images": images or []})
+        return
+
+    retry_inference_part(run_id, index, server_path, image_names, attempt, f"{status}: {error}")
+
+
+@shared_task(bind=True)
+@run_once(lambda self, results, patient_id, **kwargs: (patient_id, "finalize"))
+def finalize_study(self, results, patient_id, raw_key=None, predict_key=None):
+    """
+    Собирает результаты частей исследования: превью, кэш, итог и диагноз пациента.
+
+    Если итог так и не удалось получить от сервера YOLO (post_to_yolo исчерпал
+    повторы), пациенту записывается, что анализ не выполнен: состояние запуска
+    к этому моменту уже удалено и повторить сборку некому.
+
+    Args:
+        results (list): Результаты частей рендеринга ("files") и инференса ("images") в порядке частей.
+        patient_id (int): Уникальный идентификатор пациента.
+        raw_key (str or None): Ключ кэша для PNG, если они рендерились.
+        predict_key (str or None): Ключ кэша для предсказаний, если был инференс.
+    """
+
+    raw_folder_name = os.path.join(str(patient_id), "raw")
+    predict_folder_name = os.path.join(str(patient_id), "predict")
+    abs_raw_folder = os.path.join(settings.MEDIA_ROOT, "png", raw_folder_name)
+    abs_predict_folder = os.path.join(settings.MEDIA_ROOT, "png", predict_folder_name)
+
+    stored = False
+    if any("files" in result for result in results):
+        build_previews(raw_folder_name)
+        stack_path = os.path.join(abs_raw_folder, STACK_FILENAME)
+        if settings.NII_HANDOFF != HANDOFF_ARRAY and os.path.exists(stack_path):
+            os.remove(stack_path)
+        if raw_key:
+            stored = ConversionCache().store(raw_key, ConversionCache.RAW, abs_raw_folder)
+
+    verdict = None
+    if any("images" in result for result in results):
+        images = [image for result in results for image in result.get("images", [])]
+        try:
+            response = post_to_yolo(self, YOLO_SUMMARY_URL, params={"folder_id": str(patient_id)},
+                                    json={"images": images})
+            verdict = response.json()["verdict"]
+        except (requests.RequestException, YoloUnavailable) as e:
+            logger.error(f"Summary of patient {patient_id} failed: {e}")
+            verdict = {"diagnosis": STUDY_FAILED, "error": f"итог не получен от сервера YOLO ({e})"}
+            # Без итога папка predict неполная, в кэш она не попадает
+            predict_key = None
+    else:
+        detections = load_detections(predict_folder_name)
+        if detections:
+            verdict = detections["verdict"]
+
+    if os.path.isdir(abs_predict_folder):
+        build_previews(predict_folder_name)
+        if predict_key:
+            stored = ConversionCache().store(predict_key, ConversionCache.PREDICT, abs_predict_folder) or stored
+    if stored:
+        evict_conversion_cache.delay()
+    if verdict:
+        update_patient_diagnosis(patient_id, verdict)
+    logger.info(f"Study of patient {patient_id} finalized")
+
+
+@shared_task
+def evict_conversion_cache():
+    """
+    Вытесняет давно не использованные записи кэша конвертации сверх NII_CACHE_MAX_BYTES.
+
+    Выполняется в очереди maintenance: обход всего кэша не задерживает сборку исследований.
+
+    Returns:
+        list: Ключи удалённых записей.
+    """
+
+    return ConversionCache().evict()
@@ -1,9 +1,146 @@
-from django.test import TestCase, Client
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+from unittest import mock
+
+import nibabel as nib
+import numpy as np
+import requests
+from PIL import Image
+from celery.exceptions import Retry
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, Client, override_settings
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.urls import reverse
 
+from .cache import ConversionCache
 from .models import Patient
-from .tasks import convert_patient_nii
+from .progress import StudyProgress
+from .tasks import (check_inference_part, convert_patient_nii, dispatch_inference, evict_conversion_cache,
+                    finalize_study, handle_inference_result, model_cache_tag, post_to_yolo)
+from .upload_handlers import UploadSizeLimitHandler
+from .utils import (build_previews, convert_nii_to_png, convert_nii_to_stack, load_nii_slab,
+                    normalize_volume, render_stack_to_png, score_slices, select_informative_slices,
+                    update_patient_diagnosis)
+from .views import NiiFileHandler
+from .yolo_client import CircuitBreaker, YoloClient, YoloUnavailable, read_metrics
+
+
+class FakeRedis:
+    """
+    Строки и хэши Redis в памяти для тестов состояния обработки исследования.
+    Строки истекают по ex относительно часов now, которые тест сдвигает сам.
+    """
+
+    def __init__(self):
+        self.hashes = {}
+        self.values = {}
+        self.deadlines = {}
+        self.now = 0
+
+    def pipeline(self):
+        return FakeRedisPipeline(self)
+
+    def _expire_stale(self, key):
+        if key in self.deadlines and self.deadlines[key] <= self.now:
+            self.values.pop(key, None)
+            self.deadlines.pop(key)
+
+    def set(self, key, value, nx=False, ex=None):
+        self._expire_stale(key)
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        self.deadlines.pop(key, None)
+        if ex is not None:
+            self.deadlines[key] = self.now + ex
+        return True
+
+    def get(self, key):
+        self._expire_stale(key)
+        return self.values.get(key)
+
+    def ttl(self, key):
+        self._expire_stale(key)
+        if key not in self.values:
+            return -2
+        return self.deadlines[key] - self.now if key in self.deadlines else -1
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update(mapping)
+
+    def hsetnx(self, key, field, value):
+        fields = self.hashes.setdefault(key, {})
+        if field in fields:
+            return False
+        fields[field] = value
+        return True
+
+    def hexists(self, key, field):
+        return field in self.hashes.get(key, {})
+
+    def hlen(self, key):
+        return len(self.hashes.get(key, {}))
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hincrby(self, key, field, amount):
+        fields = self.hashes.setdefault(key, {})
+        fields[field] = int(fields.get(field, 0)) + amount
+        return fields[field]
+
+    def expire(self, key, ttl):
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key, None)
+            self.values.pop(key, None)
+            self.deadlines.pop(key, None)
+
+
+class FakeRedisPipeline:
+    """
+    Конвейер FakeRedis: команды выполняются по execute(), а после watch() и до multi() — сразу.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+        self.immediate = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def watch(self, *keys):
+        self.immediate = True
+
+    def unwatch(self):
+        self.immediate = False
+
+    def multi(self):
+        self.immediate = False
+
+    def __getattr__(self, name):
+        if self.immediate:
+            return getattr(self.client, name)
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
 
 
 class PatientModelTest(TestCase):
@@ -47,6 +184,43 @@ class PatientViewsTest(TestCase):
         response = self.client.get('/patients/')
         self.assertEqual(response.status_code, 302)  # redirect to /
 
+    def test_view_pngs_uses_previews(self):
+        """
+        Проверяет, что страница срезов показывает превью из манифеста и ссылается на полный PNG.
+        """
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            raw_folder = os.path.join(media_root, 'png', '1', 'raw')
+            os.makedirs(raw_folder)
+            Image.new('L', (640, 640), 128).save(os.path.join(raw_folder, '124.png'))
+            manifest = build_previews('1/raw', size=64, image_format='webp')
+
+            self.client.login(username='doc', password='pass')
+            response = self.client.get('/patients/1/raw/')
+
+            with Image.open(os.path.join(media_root, 'preview', '1', 'raw', '124.webp')) as preview:
+                self.assertEqual(preview.size, (64, 64))
+
+        self.assertEqual(manifest['images'][0]['preview'], '124.webp')
+        self.assertContains(response, 'src="/media/preview/1/raw/124.webp"')
+        self.assertContains(response, 'href="/media/png/1/raw/124.png"')
+
+    def test_view_pngs_shows_verdict_from_sidecar(self):
+        """
+        Проверяет, что страница предсказаний показывает итог исследования из detections.json.
+        """
+        verdict = {'diagnosis': 'Glioma', 'confidence': 0.87, 'best_slice': '130.png',
+                   'slices': 57, 'tumor_slices': 12, 'classes': {'Glioma': 12}}
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            predict_folder = os.path.join(media_root, 'png', '1', 'predict')
+            os.makedirs(predict_folder)
+            with open(os.path.join(predict_folder, 'detections.json'), 'w') as f:
+                json.dump({'verdict': verdict, 'images': []}, f)
+
+            self.client.login(username='doc', password='pass')
+            response = self.client.get('/patients/1/predict/')
+
+        self.assertContains(response, 'Глиома (уверенность 0.87, срезов с опухолью: 12 из 57)')
+
     def test_patients_view_logged_in(self):
         """
         Проверяет, что представление /patients/ доступно для авторизованного пользователя и содержит имя пациента.
@@ -57,6 +231,113 @@ class PatientViewsTest(TestCase):
         self.assertContains(response, 'Пациент')
 
 
+class UploadTest(TestCase):
+    """
+    Тесты для потоковой загрузки NIfTI файлов.
+    """
+
+    def setUp(self):
+        """
+        Настройка клиента с авторизованным пользователем и временной MEDIA_ROOT.
+        """
+        self.client = Client()
+        User.objects.create_user(username='doc', password='pass')
+        self.client.login(username='doc', password='pass')
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        self.form = {'name': 'Пациент', 'age': '40', 'gender': 'male', 'doctor_diagnosis': 'ОК'}
+
+    def test_upload_is_streamed_with_checksum(self):
+        """
+        Проверяет, что файл сохраняется по частям, а в задачу передаётся его SHA-256.
+        """
+        content = os.urandom(5000)
+        upload = SimpleUploadedFile('scan.nii.gz', content)
+        with override_settings(MEDIA_ROOT=self.media_root.name, NII_UPLOAD_CHUNK_SIZE=1024,
+                               CELERY_TASK_DEFAULT_PRIORITY=5), \
+                mock.patch('WebSite.views.convert_patient_nii.apply_async') as apply_async:
+            response = self.client.post('/convert/', {**self.form, 'nii_file': upload})
+
+        self.assertEqual(response.status_code, 302)
+        patient_id, full_path, filename, checksum = apply_async.call_args[0][0]
+        self.assertEqual(apply_async.call_args.kwargs['priority'], 5)
+        self.assertEqual(checksum, hashlib.sha256(content).hexdigest())
+        with open(full_path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_upload_over_limit_is_rejected(self):
+        """
+        Проверяет, что файл больше NII_UPLOAD_MAX_SIZE отклоняется и не сохраняется.
+        """
+        upload = SimpleUploadedFile('scan.nii.gz', b'x' * 5000)
+        with override_settings(MEDIA_ROOT=self.media_root.name, NII_UPLOAD_MAX_SIZE=1000), \
+                mock.patch('WebSite.views.convert_patient_nii.apply_async') as apply_async:
+            response = self.client.post('/convert/', {**self.form, 'nii_file': upload})
+
+        self.assertEqual(response.status_code, 400)
+        apply_async.assert_not_called()
+        self.assertFalse(Patient.objects.exists())
+
+    def test_upload_over_limit_is_rejected_before_csrf_reads_body(self):
+        """
+        Проверяет, что лимит срабатывает при разборе тела в CsrfViewMiddleware, до представления,
+        а тело без Content-Length обрывается, как только принятые части превысят лимит.
+        """
+        client = Client(enforce_csrf_checks=True)
+        client.login(username='doc', password='pass')
+        client.get('/convert/')
+        token = client.cookies['csrftoken'].value
+        upload = SimpleUploadedFile('scan.nii.gz', b'x' * 5000)
+        with override_settings(MEDIA_ROOT=self.media_root.name, NII_UPLOAD_MAX_SIZE=1000), \
+                mock.patch('WebSite.views.NiiFileHandler.save_file') as save_file, \
+                mock.patch('django.core.files.uploadhandler.MemoryFileUploadHandler.receive_data_chunk') \
+                as spool:
+            response = client.post('/convert/', {**self.form, 'csrfmiddlewaretoken': token, 'nii_file': upload})
+
+            handler = UploadSizeLimitHandler()
+            handler.handle_raw_input(None, {}, 0, b'boundary')
+            handler.receive_data_chunk(b'x' * 600, 0)
+            with self.assertRaises(RequestDataTooBig):
+                handler.receive_data_chunk(b'x' * 600, 600)
+
+        self.assertEqual(response.status_code, 400)
+        save_file.assert_not_called()
+        spool.assert_not_called()
+        self.assertFalse(Patient.objects.exists())
+
+    def test_streamed_over_limit_upload_deletes_only_its_own_file(self):
+        """
+        Проверяет, что при превышении лимита во время записи удаляется файл этой загрузки,
+        а не одноимённый файл, сохранённый раньше.
+        """
+        user = User.objects.get(username='doc')
+        upload = SimpleUploadedFile('scan.nii.gz', b'x' * 5000)
+        upload.size = None
+        with override_settings(MEDIA_ROOT=self.media_root.name, NII_UPLOAD_MAX_SIZE=1000,
+                               NII_UPLOAD_CHUNK_SIZE=512):
+            existing = os.path.join(self.media_root.name, 'nii', 'doc', 'scan.nii.gz')
+            os.makedirs(os.path.dirname(existing))
+            with open(existing, 'wb') as f:
+                f.write(b'other upload')
+            with self.assertRaises(RequestDataTooBig):
+                NiiFileHandler.save_file(user, upload)
+
+        self.assertEqual(os.listdir(os.path.dirname(existing)), ['scan.nii.gz'])
+        with open(existing, 'rb') as f:
+            self.assertEqual(f.read(), b'other upload')
+
+    def test_urgent_upload_gets_higher_priority(self):
+        """
+        Проверяет, что срочное исследование ставится в очередь с NII_URGENT_PRIORITY.
+        """
+        upload = SimpleUploadedFile('scan.nii.gz', b'x' * 100)
+        with override_settings(MEDIA_ROOT=self.media_root.name, NII_URGENT_PRIORITY=0), \
+                mock.patch('WebSite.views.convert_patient_nii.apply_async') as apply_async:
+            self.client.post('/convert/', {**self.form, 'priority': 'urgent', 'nii_file': upload})
+
+        self.assertEqual(apply_async.call_args.kwargs['priority'], 0)
+
+
 class CeleryTaskTest(TestCase):
     """
     Тесты для задач Celery.
@@ -75,6 +356,10 @@ class CeleryTaskTest(TestCase):
             neural_diagnosis='',
             server_path=''
         )
+        self.redis = FakeRedis()
+        patcher = mock.patch('WebSite.progress.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_convert_task_raises_on_missing_file(self):
         """
@@ -85,6 +370,645 @@ class CeleryTaskTest(TestCase):
                 self.patient.id, 'non_existing_path.nii', 'file.nii'
             )
 
+    def test_convert_workflow_dispatches_chunks_and_finalizes_on_callbacks(self):
+        """
+        Проверяет, что срезы рендерятся и ставятся в очередь YOLO частями без ожидания,
+        упавшая часть отправляется повторно, а после callback последней части итог
+        записывается в neural_diagnosis.
+        """
+        verdict = {'diagnosis': 'No tumor', 'confidence': None, 'best_slice': None,
+                   'slices': 2, 'tumor_slices': 0, 'classes': {}}
+
+        def post(url, params=None, json=None, timeout=None):
+            response = mock.Mock(status_code=200)
+            if json is None:
+                response.json.return_value = {'job_id': 'job', 'status': 'queued'}
+            else:
+                response.json.return_value = {'folder_id': params['folder_id'], 'verdict': verdict}
+            return response
+
+        post_mock = mock.Mock(side_effect=post)
+
+        def callback(params, status):
+            result = {'images': [{'image': name, 'avg_confidence': 'N/A', 'detections': []}
+                                 for name in params['images']]}
+            return self.client.post(params['callback_url'], data=json.dumps({
+                'job_id': 'job', 'status': status, 'error': None if status == 'done' else 'boom',
+                'result': result if status == 'done' else None}), content_type='application/json')
+
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root, NII_SLICE_SELECTION='fixed', NII_CACHE_ENABLED=False,
+                                  NII_HANDOFF='png', NII_RENDER_CHUNK_SIZE=1, NII_INFERENCE_CHUNK_SIZE=1), \
+                mock.patch('WebSite.tasks.FIXED_SLICE_RANGE', (2, 3)), \
+                mock.patch('WebSite.tasks.check_inference_part.apply_async') as schedule_check, \
+                mock.patch('WebSite.tasks.get_client', return_value=YoloClient(
+                    session=mock.Mock(post=post_mock), metrics_client=FakeRedis())):
+            nib.save(nib.Nifti1Image(np.ones((16, 16, 4), dtype=np.float32), np.eye(4)),
+                     os.path.join(media_root, 'scan.nii.gz'))
+            convert_patient_nii(self.patient.id, 'scan.nii.gz', 'scan.nii.gz')
+            dispatched = [call.kwargs['params'] for call in post_mock.call_args_list]
+            self.patient.refresh_from_db()
+            pending_diagnosis = self.patient.neural_diagnosis
+
+            self.assertEqual(callback(dispatched[1], 'failed').status_code, 202)
+            redispatched = post_mock.call_args_list[-1].kwargs['params']
+            callback(dispatched[0], 'done')
+            callback(redispatched, 'done')
+            raw_files = sorted(os.listdir(os.path.join(media_root, 'png', str(self.patient.id), 'raw')))
+
+        self.assertEqual([params['images'] for params in dispatched], [['2.png'], ['3.png']])
+        self.assertEqual(redispatched['images'], ['3.png'])
+        self.assertEqual([call.args[0][1:] for call in schedule_check.call_args_list],
+                         [(0, str(self.patient.id), ['2.png'], 0), (1, str(self.patient.id), ['3.png'], 0),
+                          (1, str(self.patient.id), ['3.png'], 1)])
+        self.assertEqual(raw_files, ['2.png', '3.png'])
+        self.assertEqual(pending_diagnosis, '')
+        self.assertEqual(post_mock.call_args_list[-1].kwargs['json'], {
+            'images': [{'image': '2.png', 'detections': []}, {'image': '3.png', 'detections': []}]})
+        self.patient.refresh_from_db()
+        self.assertEqual(self.patient.neural_diagnosis, 'Опухоль не обнаружена (срезов: 2)')
+        self.assertEqual(self.patient.server_path, str(self.patient.id))
+
+    def test_inference_callback_rejects_bad_token(self):
+        """
+        Проверяет, что callback без верного подписанного токена отклоняется.
+        """
+        with mock.patch('WebSite.views.handle_inference_result.apply_async') as apply_async:
+            response = self.client.post('/inference/callback/?token=forged', data='{}',
+                                        content_type='application/json')
+
+        self.assertEqual(response.status_code, 403)
+        apply_async.assert_not_called()
+
+    def test_redelivered_convert_is_skipped_and_failed_one_can_rerun(self):
+        """
+        Проверяет, что после падения задачи блокировка снимается, выполненная
+        конвертация пациента не повторяется, а выполняемая откладывается до
+        истечения блокировки и забирается повтором, если держатель не завершил её.
+        """
+        key = f'stage:{self.patient.id}:convert'
+        with self.assertRaises(Exception):
+            convert_patient_nii(self.patient.id, 'non_existing_path.nii', 'file.nii')
+        self.assertNotIn(key, self.redis.values)
+
+        with override_settings(NII_STAGE_LOCK_TTL=600), \
+                mock.patch('WebSite.tasks.get_patient', side_effect=RuntimeError('reclaimed')) as get_patient, \
+                mock.patch.object(convert_patient_nii, 'retry', side_effect=Retry()) as retry:
+            self.redis.set(key, 'done', ex=60)
+            self.assertIsNone(convert_patient_nii(self.patient.id, 'scan.nii.gz', 'scan.nii.gz'))
+
+            self.redis.set(key, 'dead-worker', ex=600)
+            self.redis.now = 200
+            with self.assertRaises(Retry):
+                convert_patient_nii(self.patient.id, 'scan.nii.gz', 'scan.nii.gz')
+            retry.assert_called_once_with(countdown=400)
+            get_patient.assert_not_called()
+
+            self.redis.now = 600
+            with self.assertRaises(RuntimeError):
+                convert_patient_nii(self.patient.id, 'scan.nii.gz', 'scan.nii.gz')
+
+        get_patient.assert_called_once()
+        self.assertNotIn(key, self.redis.values)
+
+    def test_lost_inference_part_is_redispatched_then_study_fails(self):
+        """
+        Проверяет, что часть без результата к сроку проверки отправляется повторно,
+        а после исчерпания попыток пациенту записывается, что анализ не выполнен.
+        """
+        progress = StudyProgress('run')
+        progress.start(2, {'patient_id': self.patient.id, 'raw_key': None, 'predict_key': None})
+        progress.complete('infer:0000', {'images': []})
+
+        with override_settings(NII_INFERENCE_CHUNK_ATTEMPTS=3, NII_INFERENCE_TIMEOUT=900), \
+                mock.patch('WebSite.tasks.dispatch_inference.apply_async') as dispatch:
+            check_inference_part('run', 0, '7', ['2.png'], 0)
+            dispatch.assert_not_called()
+
+            check_inference_part('run', 1, '7', ['3.png'], 0)
+            handle_inference_result('run', 1, '7', ['3.png'], 'failed', error='boom', attempt=1)
+            self.patient.refresh_from_db()
+            self.assertEqual(self.patient.neural_diagnosis, '')
+
+            check_inference_part('run', 1, '7', ['3.png'], 2)
+            check_inference_part('run', 1, '7', ['3.png'], 2)
+
+        self.assertEqual([call.args[0] for call in dispatch.call_args_list],
+                         [('run', 1, '7', ['3.png'], 1), ('run', 1, '7', ['3.png'], 2)])
+        self.patient.refresh_from_db()
+        self.assertEqual(self.patient.neural_diagnosis,
+                         'Анализ не выполнен: часть 2 не обработана сервером YOLO (no result within 900 s)')
+        self.assertIsNone(progress.context())
+
+    def test_unreachable_yolo_fails_study_instead_of_hanging(self):
+        """
+        Проверяет, что часть, которую не удалось поставить в очередь YOLO, отправляется
+        повторно до исчерпания попыток, а затем, как и несобранный итог, даёт
+        пациенту диагноз «Анализ не выполнен».
+        """
+        session = mock.Mock(post=mock.Mock(side_effect=requests.ConnectionError('refused')))
+        client = YoloClient(session=session, breaker=CircuitBreaker(100, 30), metrics_client=FakeRedis())
+        StudyProgress('run').start(1, {'patient_id': self.patient.id, 'raw_key': None, 'predict_key': None})
+
+        with override_settings(NII_INFERENCE_CHUNK_ATTEMPTS=3, YOLO_BREAKER_MAX_REQUEUES=0), \
+                mock.patch('WebSite.tasks.get_client', return_value=client), \
+                mock.patch('WebSite.tasks.check_inference_part.apply_async') as schedule_check:
+            dispatch_inference('run', 0, str(self.patient.id), ['2.png'])
+            self.patient.refresh_from_db()
+            dispatch_diagnosis = self.patient.neural_diagnosis
+
+            Patient.objects.filter(id=self.patient.id).update(neural_diagnosis='')
+            with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+                finalize_study([{'images': []}], self.patient.id)
+
+        self.assertEqual(session.post.call_count, 4)
+        schedule_check.assert_not_called()
+        self.assertEqual(dispatch_diagnosis,
+                         'Анализ не выполнен: часть 1 не обработана сервером YOLO (not queued: refused)')
+        self.patient.refresh_from_db()
+        self.assertEqual(self.patient.neural_diagnosis,
+                         'Анализ не выполнен: итог не получен от сервера YOLO (refused)')
+
+    def test_update_patient_diagnosis_is_single_query(self):
+        """
+        Проверяет, что диагноз записывается одним запросом к базе.
+        """
+        verdict = {'diagnosis': 'Meningioma', 'confidence': 0.5, 'best_slice': '124.png',
+                   'slices': 3, 'tumor_slices': 1, 'classes': {'Meningioma': 1}}
+        with self.assertNumQueries(1):
+            update_patient_diagnosis(self.patient.id, verdict)
+
+        self.patient.refresh_from_db()
+        self.assertEqual(self.patient.neural_diagnosis,
+                         'Менингиома (уверенность 0.50, срезов с опухолью: 1 из 3)')
+
+
+class YoloClientTest(TestCase):
+    """
+    Тесты HTTP-клиента сервера YOLO и автомата отключения.
+    """
+
+    def test_breaker_opens_after_failures_and_recovers_after_probe(self):
+        """
+        Проверяет, что после серии ошибок запросы отклоняются до пробного запроса.
+        """
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=lambda: now[0])
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+
+        with self.assertRaises(YoloUnavailable) as rejected:
+            breaker.before_call()
+        self.assertEqual(rejected.exception.retry_after, 30)
+
+        now[0] = 31.0
+        breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(YoloUnavailable):
+            breaker.before_call()
+        breaker.record_success()
+        breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_lost_probe_does_not_block_requests_forever(self):
+        """
+        Проверяет, что пробный запрос без ответа через reset_timeout сменяется новым.
+        """
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=lambda: now[0])
+        breaker.record_failure()
+        now[0] = 31.0
+        breaker.before_call()
+
+        now[0] = 60.0
+        with self.assertRaises(YoloUnavailable):
+            breaker.before_call()
+        now[0] = 62.0
+        breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(YoloUnavailable):
+            breaker.before_call()
+
+    def test_outage_requeues_task_and_client_errors_do_not(self):
+        """
+        Проверяет, что ошибка соединения и ответ 503 откладывают задачу с растущей задержкой,
+        а ответ 400 передаётся вызывающему сразу.
+        """
+        task = mock.Mock(request=mock.Mock(retries=3), retry=mock.Mock(side_effect=Retry()))
+        task.name = 'WebSite.tasks.dispatch_inference'
+        session = mock.Mock(post=mock.Mock(side_effect=requests.ConnectionError('refused')))
+        client = YoloClient(session=session, breaker=CircuitBreaker(100, 30), metrics_client=FakeRedis())
+
+        with override_settings(YOLO_HTTP_BACKOFF=0.5, YOLO_BREAKER_RESET=30, YOLO_BREAKER_MAX_REQUEUES=120), \
+                mock.patch('WebSite.tasks.get_client', return_value=client):
+            with self.assertRaises(Retry):
+                post_to_yolo(task, 'http://yolo/jobs/')
+            self.assertEqual(task.retry.call_args.kwargs['countdown'], 4.0)
+            self.assertEqual(task.retry.call_args.kwargs['max_retries'], 120)
+
+            task.request.retries = 10
+            session.post.side_effect = None
+            session.post.return_value = mock.Mock(status_code=503, raise_for_status=mock.Mock(
+                side_effect=requests.HTTPError(response=mock.Mock(status_code=503))))
+            with self.assertRaises(Retry):
+                post_to_yolo(task, 'http://yolo/jobs/')
+            self.assertEqual(task.retry.call_args.kwargs['countdown'], 30)
+
+            session.post.return_value = mock.Mock(status_code=400, raise_for_status=mock.Mock(
+                side_effect=requests.HTTPError(response=mock.Mock(status_code=400))))
+            with self.assertRaises(requests.HTTPError):
+                post_to_yolo(task, 'http://yolo/jobs/')
+        self.assertEqual(task.retry.call_count, 2)
+
+    def test_session_does_not_resend_job_after_gateway_error(self):
+        """
+        Проверяет, что ответ 502/504 повторяется только для GET: повтор POST поставил бы задачу дважды.
+        """
+        retry = YoloClient._make_session().get_adapter('http://yoloserver:8001/jobs/').max_retries
+
+        self.assertTrue(retry.is_retry('GET', 504))
+        self.assertFalse(retry.is_retry('POST', 504))
+        self.assertFalse(retry.is_retry('POST', 502))
+
+    def test_client_counts_failures_and_fast_fails_when_open(self):
+        """
+        Проверяет, что ответы 5xx учитываются как ошибки, а при отключении запрос не отправляется.
+        """
+        metrics = FakeRedis()
+        session = mock.Mock()
+        session.post.return_value = mock.Mock(status_code=503, raise_for_status=mock.Mock(
+            side_effect=requests.HTTPError('503')))
+        client = YoloClient(session=session, breaker=CircuitBreaker(1, 30), metrics_client=metrics)
+
+        with self.assertRaises(requests.HTTPError):
+            client.post('http://yolo/jobs/')
+        with self.assertRaises(YoloUnavailable):
+            client.post('http://yolo/jobs/')
+
+        self.assertEqual(session.post.call_count, 1)
+        stats = read_metrics(metrics)
+        self.assertEqual((stats['requests'], stats['failures'], stats['rejected']), (1, 1, 1))
+        self.assertEqual(sum(stats['latency_ms'].values()), 1)
+
+
+class ConvertNiiTest(TestCase):
+    """
+    Тесты для конвертации NIfTI в PNG.
+    """
+
+    def setUp(self):
+        """
+        Создание синтетического NIfTI тома и временной MEDIA_ROOT.
+        """
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        volume = np.zeros((32, 24, 8), dtype=np.float32)
+        volume[0, :, :] = 100.0  # яркая нулевая строка каждого среза
+        self.nii_path = os.path.join(self.media_root.name, 'volume.nii.gz')
+        nib.save(nib.Nifti1Image(volume, np.eye(4)), self.nii_path)
+
+    def test_pil_renderer_keeps_orientation_and_size(self):
+        """
+        Проверяет, что рендерер "pil" сохраняет ориентацию origin="lower" и заданный размер.
+        """
+        with override_settings(MEDIA_ROOT=self.media_root.name):
+            saved = convert_nii_to_png(self.nii_path, 'out', 'volume.nii.gz',
+                                       slice_range=(2, 3), renderer='pil', output_size=64)['files']
+
+        self.assertEqual([os.path.basename(f) for f in saved], ['2.png', '3.png'])
+        with Image.open(saved[0]) as image:
+            self.assertEqual(image.mode, 'L')
+            self.assertEqual(image.size, (48, 64))
+            pixels = np.asarray(image)
+        self.assertEqual(pixels[-1].min(), 255)
+        self.assertEqual(pixels[0].max(), 0)
+
+    def test_process_and_thread_pools_produce_same_slices(self):
+        """
+        Проверяет, что параллельное кодирование в потоках и процессах даёт одинаковые PNG.
+        """
+        with override_settings(MEDIA_ROOT=self.media_root.name):
+            threaded = convert_nii_to_png(self.nii_path, 'threads', 'volume.nii.gz', slice_range=(0, 7),
+                                          workers=3, executor='thread')
+            forked = convert_nii_to_png(self.nii_path, 'processes', 'volume.nii.gz', slice_range=(0, 7),
+                                        workers=3, executor='process')
+
+        self.assertEqual(sorted(threaded['slice_timings']), list(range(8)))
+        for threaded_file, forked_file in zip(threaded['files'], forked['files']):
+            with open(threaded_file, 'rb') as a, open(forked_file, 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+
+    def test_range_outside_volume_produces_no_slices(self):
+        """
+        Проверяет, что диапазон срезов за пределами тома не роняет конвертацию.
+        """
+        with override_settings(MEDIA_ROOT=self.media_root.name):
+            for normalization in ('percentile', 'minmax'):
+                report = convert_nii_to_png(self.nii_path, 'empty', 'volume.nii.gz', slice_range=(124, 180),
+                                            normalization=normalization)
+                self.assertEqual(report['files'], [])
+
+    def test_process_executor_falls_back_to_threads_in_daemon(self):
+        """
+        Проверяет, что в демоническом процессе (как в prefork-воркере Celery) конвертация
+        с NII_CONVERT_EXECUTOR=process выполняется в потоках, а не падает.
+        """
+        def convert(queue):
+            with override_settings(MEDIA_ROOT=self.media_root.name):
+                report = convert_nii_to_png(self.nii_path, 'daemon', 'volume.nii.gz', slice_range=(0, 3),
+                                            workers=2, executor='process')
+            queue.put(len(report['files']))
+
+        context = multiprocessing.get_context('fork')
+        queue = context.Queue()
+        process = context.Process(target=convert, args=(queue,), daemon=True)
+        process.start()
+        process.join(60)
+
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(queue.get(timeout=5), 4)
+
+    def test_stack_handoff_matches_png_renderer(self):
+        """
+        Проверяет, что массив срезов и PNG, отрисованные из него, совпадают с рендерером "pil".
+        """
+        volume = np.random.default_rng(0).random((32, 24, 8), dtype=np.float32)
+        nib.save(nib.Nifti1Image(volume, np.eye(4)), self.nii_path)
+        with override_settings(MEDIA_ROOT=self.media_root.name):
+            pngs = convert_nii_to_png(self.nii_path, 'png', 'volume.nii.gz', slice_range=(2, 4),
+                                      renderer='pil', output_size=64)['files']
+            stack = convert_nii_to_stack(self.nii_path, 'array', slice_range=(2, 4), output_size=64)
+            rendered = render_stack_to_png('array')
+
+        self.assertEqual(stack['slice_numbers'], [2, 3, 4])
+        with np.load(stack['path']) as data:
+            self.assertEqual(data['slices'].shape, (3, 64, 48))
+            self.assertEqual(data['slices'].dtype, np.uint8)
+        for png_file, rendered_file in zip(pngs, rendered):
+            with Image.open(png_file) as a, Image.open(rendered_file) as b:
+                np.testing.assert_array_equal(np.asarray(a), np.asarray(b))
+
+    def test_stack_rendering_follows_renderer_and_executor_settings(self):
+        """
+        Проверяет, что PNG для просмотра кодируются рендерером и пулом из настроек,
+        а пул процессов даёт тот же результат, что и потоки.
+        """
+        nib.save(nib.Nifti1Image(np.random.default_rng(0).random((32, 24, 8), dtype=np.float32), np.eye(4)),
+                 self.nii_path)
+        matplotlib_renderer = mock.Mock()
+        with override_settings(MEDIA_ROOT=self.media_root.name):
+            convert_nii_to_stack(self.nii_path, 'array', slice_range=(2, 4), output_size=64)
+            threaded = render_stack_to_png('array', workers=2)
+            expected = []
+            for path in threaded[1:]:
+                with Image.open(path) as image:
+                    expected.append(np.asarray(image))
+            forked = render_stack_to_png('array', workers=2, executor='process', slice_numbers=[3, 4])
+            with override_settings(NII_RENDERER='matplotlib', NII_CONVERT_WORKERS=1), \
+                    mock.patch.dict('WebSite.utils.SLICE_RENDERERS', {'matplotlib': matplotlib_renderer}):
+                render_stack_to_png('array', slice_numbers=[4])
+
+            for pixels, path in zip(expected, forked):
+                with Image.open(path) as image:
+                    np.testing.assert_array_equal(np.asarray(image), pixels)
+        pixels, output_file, output_size = matplotlib_renderer.call_args.args
+        self.assertEqual(pixels.shape, (64, 48))
+        self.assertTrue(output_file.endswith('4.png'))
+
+    def test_load_slab_reads_only_requested_slices(self):
+        """
+        Проверяет, что загрузчик возвращает float32 только для существующих срезов диапазона.
+        """
+        slab, slice_numbers = load_nii_slab(self.nii_path, (6, 10))
+        self.assertEqual(slab.dtype, np.float32)
+        self.assertEqual(slab.shape, (32, 24, 2))
+        self.assertEqual(slice_numbers, [6, 7])
+
+
+class NormalizationTest(TestCase):
+    """
+    Тесты для нормализации интенсивности тома.
+    """
+
+    def setUp(self):
+        """
+        Создание тома, срезы которого различаются по яркости.
+        """
+        self.slab = np.stack([np.full((4, 4), 10.0), np.full((4, 4), 20.0)], axis=2).astype(np.float32)
+        self.slab[0, 0, :] = 0.0
+
+    def test_minmax_keeps_contrast_between_slices(self):
+        """
+        Проверяет, что общий min/max сохраняет разницу яркости между срезами.
+        """
+        pixels = normalize_volume(self.slab.copy(), 'minmax')
+        self.assertEqual(pixels.dtype, np.uint8)
+        self.assertEqual(pixels[1, 1, 0], 128)
+        self.assertEqual(pixels[1, 1, 1], 255)
+        self.assertEqual(pixels[0, 0, 0], 0)
+
+    def test_slice_mode_matches_per_slice_normalization(self):
+        """
+        Проверяет, что режим "slice" растягивает каждый срез до 0..255 отдельно.
+        """
+        pixels = normalize_volume(self.slab.copy(), 'slice')
+        self.assertEqual(pixels[1, 1, 0], 255)
+        self.assertEqual(pixels[1, 1, 1], 255)
+
+    def test_writes_into_buffer_and_handles_constant_volume(self):
+        """
+        Проверяет запись в переданный буфер и нулевой результат для однородного тома.
+        """
+        out = np.full((4, 4, 2), 7, dtype=np.uint8)
+        result = normalize_volume(np.ones((4, 4, 2), dtype=np.float32), 'zscore', out=out)
+        self.assertIs(result, out)
+        self.assertEqual(out.max(), 0)
+
+
+class SliceSelectionTest(TestCase):
+    """
+    Тесты для автоматического выбора информативных срезов.
+    """
+
+    def test_selects_top_foreground_slices(self):
+        """
+        Проверяет, что выбираются срезы с наибольшей долей переднего плана, по возрастанию номера.
+        """
+        volume = np.zeros((20, 20, 10), dtype=np.float32)
+        volume[5:15, 5:15, 3] = 1.0
+        volume[2:18, 2:18, 4] = 1.0
+        volume[8:12, 8:12, 7] = 1.0
+        volume[0, 0, 9] = 1.0  # одиночный воксель ниже порога доли
+
+        scores = score_slices(volume, foreground_level=0.5)
+
+        self.assertEqual(select_informative_slices(scores, top_k=2, min_score=0.01), [3, 4])
+        self.assertEqual(select_informative_slices(scores, top_k=5, min_score=0.01), [3, 4, 7])
+
+    def test_auto_range_in_loader(self):
+        """
+        Проверяет, что загрузчик с slice_range="auto" возвращает только выбранные срезы.
+        """
+        volume = np.zeros((20, 20, 10), dtype=np.float32)
+        volume[2:18, 2:18, 6] = 5.0
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'auto.nii')
+            nib.save(nib.Nifti1Image(volume, np.eye(4)), path)
+            with override_settings(NII_SLICE_TOP_K=3, NII_SLICE_MIN_FOREGROUND=0.1):
+                slab, slice_numbers = load_nii_slab(path, 'auto')
+
+        self.assertEqual(slice_numbers, [6])
+        self.assertEqual(slab.shape, (20, 20, 1))
+
+
+class ConversionCacheTest(TestCase):
+    """
+    Тесты для кэша конвертации.
+    """
+
+    def setUp(self):
+        """
+        Создание временной папки с результатами конвертации.
+        """
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.src = os.path.join(self.tmp.name, 'src')
+        os.makedirs(self.src)
+        for name in ('124.png', '125.png'):
+            with open(os.path.join(self.src, name), 'wb') as f:
+                f.write(b'x' * 100)
+
+    def test_store_and_restore(self):
+        """
+        Проверяет, что сохранённая стадия восстанавливается в новую папку, а ключ зависит от параметров.
+        """
+        cache = ConversionCache(root=os.path.join(self.tmp.name, 'cache'), max_bytes=10 ** 6)
+        key = cache.make_key('abc', {'slice_range': [124, 180]})
+        self.assertNotEqual(key, cache.make_key('abc', {'slice_range': [100, 180]}))
+
+        self.assertFalse(cache.restore(key, ConversionCache.RAW, os.path.join(self.tmp.name, 'dst')))
+        self.assertTrue(cache.store(key, ConversionCache.RAW, self.src))
+        self.assertFalse(cache.store(key, ConversionCache.RAW, self.src))
+        self.assertTrue(cache.restore(key, ConversionCache.RAW, os.path.join(self.tmp.name, 'dst')))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp.name, 'dst'))), ['124.png', '125.png'])
+
+    def test_rewriting_restored_file_keeps_cache_entry(self):
+        """
+        Проверяет, что перезапись файла пациента на месте не портит запись кэша.
+        """
+        cache = ConversionCache(root=os.path.join(self.tmp.name, 'cache'), max_bytes=10 ** 6)
+        dst = os.path.join(self.tmp.name, 'dst')
+        cache.store('key', ConversionCache.PREDICT, self.src)
+        cache.restore('key', ConversionCache.PREDICT, dst)
+        with open(os.path.join(dst, '124.png'), 'wb') as f:
+            f.write(b'rewritten')
+        with open(os.path.join(self.src, '125.png'), 'wb') as f:
+            f.write(b'rewritten')
+
+        for name in ('124.png', '125.png'):
+            with open(os.path.join(cache.root, 'key', ConversionCache.PREDICT, name), 'rb') as f:
+                self.assertEqual(f.read(), b'x' * 100)
+
+    def test_model_tag_follows_yolo_model_version(self):
+        """
+        Проверяет, что тег модели для кэша предсказаний берётся из версии модели сервера YOLO,
+        а без ответа сервера кэш предсказаний не используется.
+        """
+        client = mock.Mock()
+        client.get.return_value.json.return_value = {'ready': True, 'model_version': 'abc-pytorch-fp32'}
+        with mock.patch('WebSite.tasks.get_client', return_value=client), \
+                override_settings(NII_CACHE_MODEL_TAG='v2'):
+            self.assertEqual(model_cache_tag(), 'abc-pytorch-fp32:v2')
+            client.get.side_effect = requests.ConnectionError('down')
+            self.assertIsNone(model_cache_tag())
+
+    def test_evicts_least_recently_used(self):
+        """
+        Проверяет, что при превышении лимита удаляется давно не использованная запись.
+        """
+        cache = ConversionCache(root=os.path.join(self.tmp.name, 'cache'), max_bytes=450)
+        cache.store('old', ConversionCache.RAW, self.src)
+        cache.store('recent', ConversionCache.RAW, self.src)
+        os.utime(os.path.join(cache.root, 'old'), (1, 1))
+        os.utime(os.path.join(cache.root, 'recent'), (2, 2))
+
+        cache.store('new', ConversionCache.RAW, self.src)
+        self.assertEqual(sorted(os.listdir(cache.root)), ['new', 'old', 'recent'])
+
+        self.assertEqual(cache.evict(), ['old'])
+        self.assertEqual(sorted(os.listdir(cache.root)), ['new', 'recent'])
+
+    def test_finalize_defers_eviction_to_maintenance_queue(self):
+        """
+        Проверяет, что сборка исследования не вытесняет кэш сама, а ставит задачу в очередь maintenance.
+        """
+        raw_folder = os.path.join(self.tmp.name, 'png', '7', 'raw')
+        os.makedirs(raw_folder)
+        Image.new('L', (64, 64), 128).save(os.path.join(raw_folder, '124.png'))
+        with override_settings(MEDIA_ROOT=self.tmp.name, NII_CACHE_MAX_BYTES=0), \
+                mock.patch('WebSite.progress.get_redis', return_value=FakeRedis()), \
+                mock.patch('WebSite.tasks.evict_conversion_cache.delay') as evict:
+            finalize_study([{'files': []}], 7, raw_key='key')
+            cached = os.listdir(os.path.join(self.tmp.name, 'cache'))
+            evicted = evict_conversion_cache()
+
+        evict.assert_called_once_with()
+        self.assertEqual(cached, ['key'])
+        self.assertEqual(evicted, ['key'])
+        self.assertEqual(settings.CELERY_TASK_ROUTES['WebSite.tasks.evict_conversion_cache'],
+                         {'queue': 'maintenance'})
+
+
+class BenchConvertCommandTest(TestCase):
+    """
+    Тесты для команды бенчмарка конвертации.
+    """
+
+    def test_reports_json_per_case(self):
+        """
+        Проверяет, что команда выводит JSON с метриками для каждого загрузчика и варианта файла.
+        """
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        output = os.path.join(tmp.name, 'bench.json')
+        call_command('bench_convert', shapes='16x16x12', dtypes='int16', compression='gz,none',
+                     renderers='pil', slice_range='2-5', workers=1, output=output, stderr=io.StringIO())
+
+        with open(output) as f:
+            report = json.load(f)
+
+        self.assertEqual(len(report['results']), 4)
+        for case in report['results']:
+            self.assertNotIn('error', case)
+            self.assertEqual(case['slices'], 4)
+            self.assertGreater(case['slices_per_sec'], 0)
+            self.assertGreater(case['bytes_written'], 0)
+            self.assertGreater(case['peak_rss_mb'], 0)
+        self.assertEqual({case['loader'] for case in report['results']}, {'lazy', 'full'})
+
+    def test_case_process_dying_is_recorded_as_failed(self):
+        """
+        Проверяет, что замер, процесс которого умер без результата, записывается с ошибкой,
+        а бенчмарк продолжается.
+        """
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        output = os.path.join(tmp.name, 'bench.json')
+        with mock.patch('WebSite.management.commands.bench_convert.convert_nii_to_png',
+                        side_effect=lambda *args, **kwargs: os._exit(3)):
+            call_command('bench_convert', shapes='16x16x12', dtypes='int16', compression='none',
+                         renderers='pil', slice_range='2-5', workers=1, output=output, stderr=io.StringIO())
+
+        with open(output) as f:
+            report = json.load(f)
+
+        self.assertEqual(len(report['results']), 2)
+        for case in report['results']:
+            self.assertEqual(case['error'], 'case process died with exit code 3')
+
 
 class MiddlewareTest(TestCase):
     """
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+class UploadSizeLimitHandler(FileUploadHandler):
+    """
+    Обработчик загрузки, который ограничивает размер тела запроса NII_UPLOAD_MAX_SIZE.
+
+    Стоит первым в FILE_UPLOAD_HANDLERS, поэтому срабатывает при любом разборе
+    тела, в том числе при чтении request.POST в CsrfViewMiddleware до вызова
+    представления. Запрос с большим Content-Length отклоняется до чтения
+    тела, остальные — как только принятые части файлов превысят лимит, до
+    записи следующей части во временный файл.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.received = 0
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length > settings.NII_UPLOAD_MAX_SIZE:
+            raise RequestDataTooBig(f"Запрос больше {settings.NII_UPLOAD_MAX_SIZE} байт")
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > settings.NII_UPLOAD_MAX_SIZE:
+            raise RequestDataTooBig(f"Запрос больше {settings.NII_UPLOAD_MAX_SIZE} байт")
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
@@ -13,5 +13,7 @@ urlpatterns = [
     path('convert/', views.convert, name='convert'),
     path('patients/', views.patients, name='patients'),
     path('patients/<path:folder>/', views.view_pngs, name='view_pngs'),
+    path('inference/callback/', views.inference_callback, name='inference_callback'),
+    path('inference/metrics/', views.inference_metrics, name='inference_metrics'),
 
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,11 +1,18 @@
+import hashlib
+import json
 import os
 import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import nibabel as nib
 import numpy as np
+from PIL import Image
 from django.conf import settings
 
 from .models import Patient
@@ -14,7 +21,394 @@ from .models import Patient
 logger = logging.getLogger(__name__)
 
 
-def convert_nii_to_png(input_path, output_base_folder, filename, slice_range=(124, 180)):
+# Рендереры срезов: принимают срез uint8 и путь к PNG
+RENDERER_PIL = "pil"
+RENDERER_MATPLOTLIB = "matplotlib"
+
+# Передача срезов на инференс: PNG в папке raw или один массив срезов (см. convert_nii_to_stack)
+HANDOFF_PNG = "png"
+HANDOFF_ARRAY = "array"
+STACK_FILENAME = "slices.npz"
+
+# Превью срезов для страницы просмотра: MEDIA_ROOT/preview/<ID>/<raw|predict>/
+PREVIEW_ROOT = "preview"
+PREVIEW_MANIFEST = "manifest.json"
+PREVIEW_EXTENSIONS = {"webp": "webp", "jpeg": "jpg"}
+# Расширения изображений срезов и визуализаций предсказаний (YOLO_ANNOTATION_FORMAT)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+
+# Детекции по срезам и итог исследования, которые сервер YOLO сохраняет в папке predict
+DETECTIONS_FILENAME = "detections.json"
+NO_TUMOR = "No tumor"
+# Итог исследования, инференс которого не удалось выполнить (error — причина)
+STUDY_FAILED = "Failed"
+DIAGNOSIS_LABELS = {
+    "Glioma": "Глиома",
+    "Meningioma": "Менингиома",
+    "Pituitary": "Опухоль гипофиза",
+    NO_TUMOR: "Опухоль не обнаружена",
+    STUDY_FAILED: "Анализ не выполнен",
+}
+
+# Загрузчики срезов: ленивое чтение нужных срезов или весь том через get_fdata()
+LOADER_LAZY = "lazy"
+LOADER_FULL = "full"
+
+# Значение slice_range для автоматического выбора информативных срезов
+AUTO_SLICE_RANGE = "auto"
+
+# Версия формата выходных PNG: увеличивать при любом изменении результата рендеринга,
+# чтобы записи кэша конвертации со старым результатом больше не использовались
+RENDERER_VERSION = 2
+
+# Режимы нормализации интенсивности (см. normalize_volume)
+NORMALIZATION_MINMAX = "minmax"
+NORMALIZATION_PERCENTILE = "percentile"
+NORMALIZATION_ZSCORE = "zscore"
+NORMALIZATION_SLICE = "slice"
+
+# Уровень сжатия zlib для PNG: 3 заметно быстрее стандартного 6 при почти том же размере
+PNG_COMPRESS_LEVEL = 3
+
+
+def normalize_volume(slab, mode=None, out=None):
+    """
+    Нормализует срезы тома к 8 битам одним векторизованным проходом.
+
+    Режимы:
+        "minmax" — общий минимум и максимум по всем срезам;
+        "percentile" — общие перцентили NII_NORMALIZATION_PERCENTILES с обрезкой выбросов;
+        "zscore" — среднее ± NII_NORMALIZATION_ZSCORE стандартных отклонений;
+        "slice" — минимум и максимум каждого среза отдельно (прежнее поведение).
+
+    Все режимы, кроме "slice", дают одинаковый контраст для всех срезов исследования.
+    Вычисления выполняются на месте в slab (если он доступен для записи),
+    без временных массивов на каждый срез.
+
+    Args:
+        slab (np.ndarray): Том float32 формы (x, y, k); может быть изменён на месте.
+        mode (str or None): Режим нормализации. По умолчанию settings.NII_NORMALIZATION.
+        out (np.ndarray or None): Буфер uint8 той же формы для результата.
+
+    Returns:
+        np.ndarray: Том uint8 со значениями 0..255.
+    """
+
+    mode = mode or settings.NII_NORMALIZATION
+    if mode == NORMALIZATION_SLICE:
+        low = slab.min(axis=(0, 1), keepdims=True)
+        high = slab.max(axis=(0, 1), keepdims=True)
+    elif mode == NORMALIZATION_MINMAX:
+        low, high = slab.min(), slab.max()
+    elif mode == NORMALIZATION_PERCENTILE:
+        # Перцентили по прореженному тому: почти тот же результат без копии всего тома
+        low, high = np.percentile(slab[::2, ::2, :], settings.NII_NORMALIZATION_PERCENTILES)
+    elif mode == NORMALIZATION_ZSCORE:
+        mean, std = slab.mean(dtype=np.float64), slab.std(dtype=np.float64)
+        low = mean - settings.NII_NORMALIZATION_ZSCORE * std
+        high = mean + settings.NII_NORMALIZATION_ZSCORE * std
+    else:
+        raise ValueError(f"Неизвестный режим нормализации: {mode}")
+
+    low = np.asarray(low, dtype=np.float32)
+    value_range = np.asarray(high, dtype=np.float32) - low
+    # Однородный срез или том становится нулевым
+    scale = np.divide(np.float32(255), value_range, out=np.zeros_like(value_range),
+                      where=value_range > 0)
+
+    # Данные из .nii.gz доступны только для чтения: тогда один рабочий буфер на весь том
+    work = np.subtract(slab, low, out=slab if slab.flags.writeable else None, dtype=np.float32)
+    np.multiply(work, scale, out=work)
+    np.clip(work, 0, 255, out=work)
+    np.rint(work, out=work)
+    if out is None:
+        out = np.empty(work.shape, dtype=np.uint8)
+    np.copyto(out, work, casting="unsafe")
+    return out
+
+
+def _slice_to_image(pixels, output_size=None):
+    """
+    Превращает нормализованный срез в 8-битное изображение в оттенках серого.
+
+    Ориентация совпадает с imshow(..., origin="lower"): нулевая строка массива
+    оказывается внизу изображения.
+
+    Args:
+        pixels (np.ndarray): Срез uint8 из normalize_volume.
+        output_size (int or None): Длина большей стороны изображения в пикселях
+            (None — исходное разрешение среза).
+
+    Returns:
+        PIL.Image.Image: Изображение в режиме "L".
+    """
+
+    image = Image.fromarray(np.ascontiguousarray(np.flipud(pixels)))
+    if output_size:
+        scale = output_size / max(image.size)
+        new_size = (max(1, round(image.width * scale)),
+                    max(1, round(image.height * scale)))
+        if new_size != image.size:
+            image = image.resize(new_size, Image.BILINEAR)
+    return image
+
+
+def _render_slice_pil(pixels, output_file, output_size=None):
+    """
+    Сохраняет срез в PNG напрямую из массива, без создания фигуры matplotlib.
+
+    Args:
+        pixels (np.ndarray): Срез uint8 из normalize_volume.
+        output_file (str): Путь к выходному PNG.
+        output_size (int or None): Длина большей стороны изображения в пикселях.
+    """
+
+    image = _slice_to_image(pixels, output_size)
+    image.save(output_file, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+
+
+def _render_slice_matplotlib(pixels, output_file, output_size=None):
+    """
+    Сохраняет срез в PNG через фигуру matplotlib (исходный способ, 300 dpi).
+
+    Args:
+        pixels (np.ndarray): Срез uint8 из normalize_volume.
+        output_file (str): Путь к выходному PNG.
+        output_size (int or None): Не используется, размер задаётся фигурой и dpi.
+    """
+
+    # Figure без pyplot: глобальное состояние pyplot не потокобезопасно
+    fig = Figure(figsize=(6, 6))
+    ax = fig.add_subplot()
+    ax.imshow(pixels, cmap="gray", origin="lower", vmin=0, vmax=255)
+    ax.axis("off")
+    fig.savefig(output_file, bbox_inches="tight", pad_inches=0, dpi=300)
+
+
+SLICE_RENDERERS = {
+    RENDERER_PIL: _render_slice_pil,
+    RENDERER_MATPLOTLIB: _render_slice_matplotlib,
+}
+
+# Пулы для параллельного кодирования срезов
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+
+# Том, унаследованный процессом пула при fork (без копирования и pickle)
+_WORKER_SLAB = None
+
+
+def _init_slab_worker(slab):
+    """
+    Инициализатор процесса пула: запоминает общий том.
+
+    Args:
+        slab (np.ndarray): Загруженный том, доступный через copy-on-write после fork.
+    """
+
+    global _WORKER_SLAB
+    _WORKER_SLAB = slab
+
+
+def _encode_slab_slice(slab, position, output_file, renderer, output_size):
+    """
+    Кодирует один срез нормализованного тома.
+
+    Args:
+        slab (np.ndarray): Том uint8 формы (x, y, k).
+        position (int): Индекс среза в томе.
+        output_file (str): Путь к выходному PNG.
+        renderer (str): Имя рендерера из SLICE_RENDERERS.
+        output_size (int or None): Длина большей стороны PNG в пикселях.
+
+    Returns:
+        float: Время обработки среза в секундах.
+    """
+
+    started = time.perf_counter()
+    SLICE_RENDERERS[renderer](slab[:, :, position], output_file, output_size)
+    return time.perf_counter() - started
+
+
+def _encode_worker_slice(position, output_file, renderer, output_size):
+    """
+    Кодирует срез в процессе пула, используя том из _init_slab_worker.
+    """
+
+    return _encode_slab_slice(_WORKER_SLAB, position, output_file, renderer, output_size)
+
+
+def _make_slice_executor(executor, workers, slab):
+    """
+    Создаёт пул для кодирования срезов.
+
+    Процессный пул запускается через fork, поэтому том передаётся в процессы
+    без копирования. Демонический процесс (дочерний процесс prefork-воркера
+    Celery) не может запускать свои процессы, поэтому в нём, как и при ошибке
+    создания пула, используется пул потоков.
+
+    Args:
+        executor (str): "thread" или "process".
+        workers (int): Количество воркеров.
+        slab (np.ndarray): Загруженный том.
+
+    Returns:
+        tuple: Пул и признак того, что это пул процессов.
+    """
+
+    if executor == EXECUTOR_PROCESS and multiprocessing.current_process().daemon:
+        logger.warning("Демонический процесс не может создать пул процессов, используем потоки")
+    elif executor == EXECUTOR_PROCESS:
+        try:
+            pool = ProcessPoolExecutor(max_workers=workers,
+                                       mp_context=multiprocessing.get_context("fork"),
+                                       initializer=_init_slab_worker,
+                                       initargs=(slab,))
+            return pool, True
+        except (AssertionError, OSError, ValueError) as e:
+            logger.warning(f"Не удалось создать пул процессов ({e}), используем потоки")
+    elif executor != EXECUTOR_THREAD:
+        raise ValueError(f"Неизвестный тип пула: {executor}")
+    return ThreadPoolExecutor(max_workers=workers), False
+
+
+def score_slices(volume, foreground_level=None):
+    """
+    Оценивает информативность каждого среза тома долей воксельного переднего плана.
+
+    Порог переднего плана общий для всего тома: уровень между минимумом и
+    99.5-м перцентилем интенсивности. Расчёт векторизован по всем срезам сразу.
+
+    Args:
+        volume (np.ndarray): Том формы (x, y, z).
+        foreground_level (float or None): Положение порога между минимумом и перцентилем
+            (0..1). По умолчанию settings.NII_FOREGROUND_LEVEL.
+
+    Returns:
+        np.ndarray: Доля переднего плана для каждого среза, форма (z,).
+    """
+
+    foreground_level = settings.NII_FOREGROUND_LEVEL if foreground_level is None else foreground_level
+    # Перцентиль по прореженному тому: почти тот же результат в десятки раз быстрее
+    low = float(volume.min())
+    high = float(np.percentile(volume[::4, ::4, :], 99.5))
+    threshold = low + foreground_level * (high - low)
+    return (volume > threshold).mean(axis=(0, 1))
+
+
+def select_informative_slices(scores, top_k=None, min_score=None):
+    """
+    Выбирает срезы с долей переднего плана не ниже порога, не более top_k лучших.
+
+    Args:
+        scores (np.ndarray): Оценки срезов из score_slices.
+        top_k (int or None): Максимальное число срезов. По умолчанию settings.NII_SLICE_TOP_K.
+        min_score (float or None): Минимальная доля переднего плана.
+            По умолчанию settings.NII_SLICE_MIN_FOREGROUND.
+
+    Returns:
+        list: Номера выбранных срезов по возрастанию.
+    """
+
+    top_k = top_k or settings.NII_SLICE_TOP_K
+    min_score = settings.NII_SLICE_MIN_FOREGROUND if min_score is None else min_score
+
+    candidates = np.flatnonzero(scores >= min_score)
+    if candidates.size == 0:
+        logger.warning(f"Нет срезов с долей переднего плана >= {min_score}, берём {top_k} лучших")
+        candidates = np.arange(scores.size)
+    if candidates.size > top_k:
+        # Устойчивая сортировка: при равных оценках сохраняется порядок срезов
+        order = np.argsort(-scores[candidates], kind="stable")[:top_k]
+        candidates = candidates[order]
+    return sorted(int(slice_number) for slice_number in candidates)
+
+
+def load_nii_slab(input_path, slice_range):
+    """
+    Лениво загружает из NIfTI только нужные срезы по оси z.
+
+    Данные читаются через прокси dataobj (для несжатого .nii — через memory map)
+    в float32, без материализации тома в float64. Для 4D томов берётся первый
+    объём. При slice_range="auto" том читается целиком, и из него выбираются
+    наиболее информативные срезы (см. select_informative_slices).
+
+    Args:
+        input_path (str): Путь к NIfTI файлу.
+        slice_range (tuple or str): Диапазон срезов (включительно), например (124, 180),
+            или "auto" для автоматического выбора.
+
+    Returns:
+        tuple: Массив float32 формы (x, y, k) и список номеров загруженных срезов.
+    """
+
+    nifti_image = nib.load(input_path, mmap=True)
+    shape = nifti_image.shape
+    if len(shape) < 3:
+        raise ValueError(f"Ожидался 3D/4D том, получена форма {shape}")
+    z_dim = shape[2]
+    extra_dims = (0,) * (len(shape) - 3)
+
+    if slice_range == AUTO_SLICE_RANGE:
+        volume = np.asarray(nifti_image.dataobj[(Ellipsis,) + extra_dims], dtype=np.float32)
+        slice_numbers = select_informative_slices(score_slices(volume))
+        logger.info(f"Автоматически выбраны срезы {slice_numbers[0]}..{slice_numbers[-1]} "
+                    f"({len(slice_numbers)} из {z_dim})")
+        return volume[:, :, slice_numbers], slice_numbers
+
+    start_slice, end_slice = slice_range
+    slice_numbers = []
+    for slice_number in range(start_slice, end_slice + 1):
+        if slice_number >= z_dim:
+            logger.warning(f"Slice {slice_number} превышает размерность {z_dim}")
+            continue
+        slice_numbers.append(slice_number)
+
+    if not slice_numbers:
+        return np.empty(shape[:2] + (0,), dtype=np.float32), slice_numbers
+
+    slicer = (slice(None), slice(None), slice(slice_numbers[0], slice_numbers[-1] + 1))
+    slab = np.asarray(nifti_image.dataobj[slicer + extra_dims], dtype=np.float32)
+    return slab, slice_numbers
+
+
+def load_nii_full(input_path, slice_range):
+    """
+    Загружает срезы прежним способом: весь том через get_fdata() в float64.
+
+    Оставлен для сравнения с load_nii_slab в бенчмарке конвертации.
+
+    Args:
+        input_path (str): Путь к NIfTI файлу.
+        slice_range (tuple or str): Диапазон срезов (включительно) или "auto".
+
+    Returns:
+        tuple: Массив float32 формы (x, y, k) и список номеров загруженных срезов.
+    """
+
+    volume = nib.load(input_path).get_fdata()
+    if volume.ndim < 3:
+        raise ValueError(f"Ожидался 3D/4D том, получена форма {volume.shape}")
+    volume = volume[(Ellipsis,) + (0,) * (volume.ndim - 3)]
+    z_dim = volume.shape[2]
+
+    if slice_range == AUTO_SLICE_RANGE:
+        slice_numbers = select_informative_slices(score_slices(volume))
+    else:
+        start_slice, end_slice = slice_range
+        slice_numbers = [n for n in range(start_slice, end_slice + 1) if n < z_dim]
+    return volume[:, :, slice_numbers].astype(np.float32), slice_numbers
+
+
+NII_LOADERS = {
+    LOADER_LAZY: load_nii_slab,
+    LOADER_FULL: load_nii_full,
+}
+
+
+def convert_nii_to_png(input_path, output_base_folder, filename, slice_range=(124, 180),
+                       renderer=None, output_size=None, workers=None, executor=None,
+                       normalization=None, loader=LOADER_LAZY):
     """
     Конвертирует NIfTI файл в серию изображений PNG.
 
@@ -22,51 +416,337 @@ def convert_nii_to_png(input_path, output_base_folder, filename, slice_range=(12
         input_path (str): Путь к входному NIfTI файлу.
         output_base_folder (str): Базовая папка для сохранения изображений PNG.
         filename (str): Имя файла (не используется в текущей реализации).
-        slice_range (tuple): Диапазон срезов для конвертации (по умолчанию от 124 до 180).
+        slice_range (tuple or str): Диапазон срезов для конвертации (по умолчанию от 124 до 180)
+            или "auto" для автоматического выбора информативных срезов.
+        renderer (str or None): Способ кодирования срезов: "pil" (напрямую из массива)
+            или "matplotlib" (через фигуру). По умолчанию settings.NII_RENDERER.
+        output_size (int or None): Длина большей стороны PNG в пикселях для рендерера "pil".
+            По умолчанию settings.NII_OUTPUT_SIZE.
+        workers (int or None): Количество параллельных воркеров кодирования.
+            По умолчанию settings.NII_CONVERT_WORKERS.
+        executor (str or None): Тип пула: "thread" или "process".
+            По умолчанию settings.NII_CONVERT_EXECUTOR.
+        normalization (str or None): Режим нормализации интенсивности (см. normalize_volume).
+            По умолчанию settings.NII_NORMALIZATION.
+        loader (str): Загрузчик срезов: "lazy" (load_nii_slab) или "full" (load_nii_full).
+
+    Returns:
+        dict: Пути к сохранённым PNG ("files"), время обработки каждого среза
+            в секундах ("slice_timings") и общее время конвертации ("wall_time").
     """
 
-    logger.info(f"Начинаем конвертацию {input_path}")
+    renderer = renderer or settings.NII_RENDERER
+    output_size = output_size or settings.NII_OUTPUT_SIZE
+    workers = max(1, workers or settings.NII_CONVERT_WORKERS)
+    executor = executor or settings.NII_CONVERT_EXECUTOR
+    if renderer not in SLICE_RENDERERS:
+        raise ValueError(f"Неизвестный рендерер срезов: {renderer}")
+    if loader not in NII_LOADERS:
+        raise ValueError(f"Неизвестный загрузчик срезов: {loader}")
+
+    logger.info(f"Начинаем конвертацию {input_path} (рендерер: {renderer})")
+    started = time.perf_counter()
     try:
         if not os.path.exists(input_path):
             logger.error(f"Файл не найден: {input_path}")
             raise FileNotFoundError(f"Нет такого файла: {input_path}")
 
-        nifti_image = nib.load(input_path)
-        image_data = nifti_image.get_fdata()
-        _, _, z_dim = image_data.shape
+        slab, slice_numbers = NII_LOADERS[loader](input_path, slice_range)
+        if not slice_numbers:
+            # Как и раньше, срезы вне тома пропускаются с предупреждением, а не роняют конвертацию
+            logger.warning(f"Нет срезов {slice_range} в {input_path}, конвертировать нечего")
+            return {"files": [], "slice_timings": {}, "wall_time": time.perf_counter() - started}
+        slab = normalize_volume(slab, normalization)
 
         abs_output_folder = os.path.join(settings.MEDIA_ROOT, output_base_folder)
         os.makedirs(abs_output_folder, exist_ok=True)
         logger.info(f"Папка для PNG: {abs_output_folder}")
 
-        start_slice, end_slice = slice_range
-        for slice_number in range(start_slice, end_slice + 1):
-            if slice_number >= z_dim:
-                logger.warning(f"Slice {slice_number} превышает размерность {z_dim}")
-                continue
-
-            slice_data = image_data[:, :, slice_number]
-            min_val, max_val = np.min(slice_data), np.max(slice_data)
-            if max_val != min_val:
-                slice_data_normalized = (slice_data - min_val) / (max_val - min_val)
-            else:
-                slice_data_normalized = np.zeros_like(slice_data)
-
-            plt.figure(figsize=(6, 6))
-            plt.imshow(slice_data_normalized, cmap="gray", origin="lower")
-            plt.axis("off")
-
-            output_file = os.path.join(abs_output_folder, f"{slice_number}.png")
-            plt.savefig(output_file, bbox_inches="tight", pad_inches=0, dpi=300)
-            plt.close()
-            logger.info(f"Сохранён срез: {output_file}")
+        output_files = [os.path.join(abs_output_folder, f"{slice_number}.png")
+                         for slice_number in slice_numbers]
+        positions = range(len(slice_numbers))
 
+        if workers == 1 or len(slice_numbers) < 2:
+            timings = [_encode_slab_slice(slab, position, output_file, renderer, output_size)
+                       for position, output_file in zip(positions, output_files)]
+        else:
+            renderers = [renderer] * len(output_files)
+            output_sizes = [output_size] * len(output_files)
+            pool, is_process_pool = _make_slice_executor(executor, workers, slab)
+            with pool:
+                # Потоки разделяют том напрямую, процессы получают его при fork
+                encode = _encode_worker_slice if is_process_pool else partial(_encode_slab_slice, slab)
+                timings = list(pool.map(encode, positions, output_files, renderers, output_sizes))
+
+        wall_time = time.perf_counter() - started
+        slice_timings = dict(zip(slice_numbers, timings))
+        for slice_number, output_file in zip(slice_numbers, output_files):
+            logger.info(f"Сохранён срез: {output_file} ({slice_timings[slice_number] * 1000:.1f} мс)")
+        logger.info(f"Рендерер {renderer}: {len(output_files)} срезов за {wall_time:.2f} с "
+                    f"({executor}, воркеров: {workers})")
         logger.info("Конвертация завершена успешно")
+        return {
+            "files": output_files,
+            "slice_timings": slice_timings,
+            "wall_time": wall_time,
+        }
     except Exception as e:
         logger.error(f"Ошибка конвертации nii в png: {e}", exc_info=True)
         raise
 
 
+def convert_nii_to_stack(input_path, output_base_folder, slice_range=(124, 180), output_size=None,
+                         normalization=None):
+    """
+    Сохраняет выбранные срезы NIfTI одним массивом для передачи на инференс без PNG.
+
+    Срезы нормализуются, ориентируются и масштабируются так же, как PNG рендерера
+    "pil", и записываются в <output_base_folder>/slices.npz: массив uint8 "slices"
+    формы (k, высота, ширина) и номера срезов "slice_numbers".
+
+    Args:
+        input_path (str): Путь к входному NIfTI файлу.
+        output_base_folder (str): Папка (относительно MEDIA_ROOT) для файла срезов.
+        slice_range (tuple or str): Диапазон срезов или "auto".
+        output_size (int or None): Длина большей стороны среза в пикселях.
+            По умолчанию settings.NII_OUTPUT_SIZE.
+        normalization (str or None): Режим нормализации интенсивности (см. normalize_volume).
+            По умолчанию settings.NII_NORMALIZATION.
+
+    Returns:
+        dict: Путь к файлу ("path"), номера срезов ("slice_numbers") и время ("wall_time").
+    """
+
+    output_size = output_size or settings.NII_OUTPUT_SIZE
+    logger.info(f"Начинаем упаковку срезов {input_path}")
+    started = time.perf_counter()
+    try:
+        if not os.path.exists(input_path):
+            logger.error(f"Файл не найден: {input_path}")
+            raise FileNotFoundError(f"Нет такого файла: {input_path}")
+
+        slab, slice_numbers = load_nii_slab(input_path, slice_range)
+        if not slice_numbers:
+            raise ValueError(f"Нет срезов для конвертации в {input_path}")
+        pixels = normalize_volume(slab, normalization)
+        stack = np.stack([
+            np.asarray(_slice_to_image(pixels[:, :, position], output_size))
+            for position in range(len(slice_numbers))
+        ])
+
+        abs_output_folder = os.path.join(settings.MEDIA_ROOT, output_base_folder)
+        os.makedirs(abs_output_folder, exist_ok=True)
+        stack_path = os.path.join(abs_output_folder, STACK_FILENAME)
+        np.savez(stack_path, slices=stack, slice_numbers=np.asarray(slice_numbers, dtype=np.int32))
+
+        wall_time = time.perf_counter() - started
+        logger.info(f"Сохранено {len(slice_numbers)} срезов в {stack_path} за {wall_time:.2f} с")
+        return {"path": stack_path, "slice_numbers": slice_numbers, "wall_time": wall_time}
+    except Exception as e:
+        logger.error(f"Ошибка упаковки срезов nii: {e}", exc_info=True)
+        raise
+
+
+def render_stack_to_png(output_base_folder, workers=None, slice_numbers=None, renderer=None, executor=None):
+    """
+    Кодирует срезы из файла slices.npz в PNG для просмотра.
+
+    Срезы в файле уже ориентированы и масштабированы, поэтому рендерер "pil"
+    сохраняет их как есть, а "matplotlib" строит фигуру из того же среза.
+
+    Args:
+        output_base_folder (str): Папка (относительно MEDIA_ROOT) с файлом срезов;
+            PNG сохраняются туда же.
+        workers (int or None): Количество параллельных воркеров кодирования.
+            По умолчанию settings.NII_CONVERT_WORKERS.
+        slice_numbers (list or None): Номера срезов для рендеринга (по умолчанию все срезы файла).
+        renderer (str or None): "pil" или "matplotlib". По умолчанию settings.NII_RENDERER.
+        executor (str or None): Тип пула: "thread" или "process".
+            По умолчанию settings.NII_CONVERT_EXECUTOR.
+
+    Returns:
+        list: Пути к сохранённым PNG.
+    """
+
+    workers = max(1, workers or settings.NII_CONVERT_WORKERS)
+    renderer = renderer or settings.NII_RENDERER
+    executor = executor or settings.NII_CONVERT_EXECUTOR
+    if renderer not in SLICE_RENDERERS:
+        raise ValueError(f"Неизвестный рендерер срезов: {renderer}")
+
+    started = time.perf_counter()
+    abs_output_folder = os.path.join(settings.MEDIA_ROOT, output_base_folder)
+    with np.load(os.path.join(abs_output_folder, STACK_FILENAME)) as data:
+        stack = data["slices"]
+        positions = {int(n): position for position, n in enumerate(data["slice_numbers"])}
+
+    slice_numbers = list(positions) if slice_numbers is None else slice_numbers
+    output_files = [os.path.join(abs_output_folder, f"{slice_number}.png")
+                    for slice_number in slice_numbers]
+    slice_positions = [positions[slice_number] for slice_number in slice_numbers]
+    # Представление (x, y, k) без копии: рендереры ждут срез в ориентации тома и сами его переворачивают
+    slab = stack[:, ::-1, :].transpose(1, 2, 0)
+    renderers = [renderer] * len(output_files)
+    output_sizes = [None] * len(output_files)
+
+    if workers == 1 or len(output_files) < 2:
+        timings = list(map(partial(_encode_slab_slice, slab), slice_positions, output_files, renderers,
+                           output_sizes))
+    else:
+        pool, is_process_pool = _make_slice_executor(executor, workers, slab)
+        with pool:
+            encode = _encode_worker_slice if is_process_pool else partial(_encode_slab_slice, slab)
+            timings = list(pool.map(encode, slice_positions, output_files, renderers, output_sizes))
+
+    for output_file, timing in zip(output_files, timings):
+        logger.info(f"Сохранён срез: {output_file} ({timing * 1000:.1f} мс)")
+    logger.info(f"Рендерер {renderer}: {len(output_files)} PNG для просмотра в {abs_output_folder} "
+                f"за {time.perf_counter() - started:.2f} с ({executor}, воркеров: {workers})")
+    return output_files
+
+
+def preview_folder(folder):
+    """
+    Возвращает абсолютный путь к папке превью для папки со срезами.
+
+    Превью хранятся в отдельном дереве MEDIA_ROOT/preview/<folder>, чтобы
+    в папках png не появлялись подпапки.
+
+    Args:
+        folder (str): Папка относительно MEDIA_ROOT/png, например "<ID>/raw".
+
+    Returns:
+        str: Абсолютный путь к папке превью.
+    """
+
+    return os.path.join(settings.MEDIA_ROOT, PREVIEW_ROOT, folder)
+
+
+def build_previews(folder, size=None, image_format=None, quality=None):
+    """
+    Создаёт уменьшенные превью для PNG папки и манифест manifest.json.
+
+    Манифест содержит для каждого PNG имя превью и его размеры, по нему
+    страница просмотра показывает превью вместо полноразмерных изображений.
+
+    Args:
+        folder (str): Папка относительно MEDIA_ROOT/png, например "<ID>/raw" или "<ID>/predict".
+        size (int or None): Длина большей стороны превью. По умолчанию settings.NII_PREVIEW_SIZE.
+        image_format (str or None): "webp" или "jpeg". По умолчанию settings.NII_PREVIEW_FORMAT.
+        quality (int or None): Качество сжатия (1-100). По умолчанию settings.NII_PREVIEW_QUALITY.
+
+    Returns:
+        dict: Манифест превью.
+    """
+
+    size = size or settings.NII_PREVIEW_SIZE
+    image_format = (image_format or settings.NII_PREVIEW_FORMAT).lower()
+    quality = quality or settings.NII_PREVIEW_QUALITY
+    if image_format not in PREVIEW_EXTENSIONS:
+        raise ValueError(f"Неизвестный формат превью: {image_format}")
+
+    source_folder = os.path.join(settings.MEDIA_ROOT, "png", folder)
+    target_folder = preview_folder(folder)
+    os.makedirs(target_folder, exist_ok=True)
+
+    entries = []
+    for name in sorted(os.listdir(source_folder)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        preview_name = f"{os.path.splitext(name)[0]}.{PREVIEW_EXTENSIONS[image_format]}"
+        with Image.open(os.path.join(source_folder, name)) as image:
+            image.thumbnail((size, size), Image.BILINEAR)
+            if image_format == "jpeg" and image.mode not in ("L", "RGB"):
+                image = image.convert("RGB")
+            image.save(os.path.join(target_folder, preview_name), format=image_format.upper(),
+                       quality=quality)
+            entries.append({"image": name, "preview": preview_name,
+                            "width": image.width, "height": image.height})
+
+    manifest = {"format": image_format, "size": size, "images": entries}
+    manifest_path = os.path.join(target_folder, PREVIEW_MANIFEST)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+    logger.info(f"Создано превью: {len(entries)} в {target_folder}")
+    return manifest
+
+
+def load_preview_manifest(folder):
+    """
+    Читает манифест превью для папки со срезами.
+
+    Args:
+        folder (str): Папка относительно MEDIA_ROOT/png.
+
+    Returns:
+        dict: Соответствие имени PNG записи манифеста (пустой словарь, если превью нет).
+    """
+
+    manifest_path = os.path.join(preview_folder(folder), PREVIEW_MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {entry["image"]: entry for entry in manifest.get("images", [])}
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    """
+    Вычисляет SHA-256 файла, читая его по частям.
+
+    Args:
+        path (str): Путь к файлу.
+        chunk_size (int): Размер читаемого блока в байтах.
+
+    Returns:
+        str: Шестнадцатеричный SHA-256.
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def conversion_cache_params(slice_range, renderer=None, output_size=None, normalization=None):
+    """
+    Собирает параметры конвертации, от которых зависит результат, для ключа кэша.
+
+    Args:
+        slice_range (tuple or str): Диапазон срезов или "auto".
+        renderer (str or None): Рендерер (по умолчанию settings.NII_RENDERER).
+        output_size (int or None): Размер PNG (по умолчанию settings.NII_OUTPUT_SIZE).
+        normalization (str or None): Режим нормализации (по умолчанию settings.NII_NORMALIZATION).
+
+    Returns:
+        dict: Параметры конвертации.
+    """
+
+    normalization = normalization or settings.NII_NORMALIZATION
+    params = {
+        "renderer_version": RENDERER_VERSION,
+        "renderer": renderer or settings.NII_RENDERER,
+        "output_size": output_size or settings.NII_OUTPUT_SIZE,
+        "normalization": normalization,
+    }
+    if normalization == NORMALIZATION_PERCENTILE:
+        params["normalization_percentiles"] = list(settings.NII_NORMALIZATION_PERCENTILES)
+    elif normalization == NORMALIZATION_ZSCORE:
+        params["normalization_zscore"] = settings.NII_NORMALIZATION_ZSCORE
+    if slice_range == AUTO_SLICE_RANGE:
+        params["slice_range"] = AUTO_SLICE_RANGE
+        params["slice_selection"] = [settings.NII_SLICE_TOP_K,
+                                     settings.NII_SLICE_MIN_FOREGROUND,
+                                     settings.NII_FOREGROUND_LEVEL]
+    else:
+        params["slice_range"] = list(slice_range)
+    return params
+
+
 def get_patient(patient_id):
     """
     Получает объект пациента по его ID.
@@ -92,3 +772,61 @@ def update_patient_server_path(patient, server_path):
 
     patient.server_path = server_path
     patient.save()
+
+
+def load_detections(folder):
+    """
+    Читает детекции и итог исследования, сохранённые сервером YOLO.
+
+    Args:
+        folder (str): Папка относительно MEDIA_ROOT/png, например "<ID>/predict".
+
+    Returns:
+        dict or None: Содержимое detections.json ("verdict" и "images") или None, если файла нет.
+    """
+
+    path = os.path.join(settings.MEDIA_ROOT, "png", folder, DETECTIONS_FILENAME)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def format_neural_diagnosis(verdict):
+    """
+    Формирует текст диагноза нейросети из итога исследования.
+
+    Args:
+        verdict (dict): Итог исследования от сервера YOLO (diagnosis, confidence, slices, tumor_slices)
+            или {"diagnosis": STUDY_FAILED, "error": ...}.
+
+    Returns:
+        str: Диагноз для поля Patient.neural_diagnosis.
+    """
+
+    label = DIAGNOSIS_LABELS.get(verdict["diagnosis"], verdict["diagnosis"])
+    if verdict["diagnosis"] == STUDY_FAILED:
+        return f"{label}: {verdict['error']}"
+    if verdict["diagnosis"] == NO_TUMOR:
+        return f"{label} (срезов: {verdict['slices']})"
+    return (f"{label} (уверенность {verdict['confidence']:.2f}, "
+            f"срезов с опухолью: {verdict['tumor_slices']} из {verdict['slices']})")
+
+
+def update_patient_diagnosis(patient_id, verdict):
+    """
+    Записывает диагноз нейросети пациенту одним UPDATE, не перезаписывая остальные поля.
+
+    Args:
+        patient_id (int): Уникальный идентификатор пациента.
+        verdict (dict): Итог исследования от сервера YOLO.
+
+    Returns:
+        str: Записанный диагноз.
+    """
+
+    diagnosis = format_neural_diagnosis(verdict)
+    Patient.objects.filter(id=patient_id).update(neural_diagnosis=diagnosis)
+    logger.info(f"Patient {patient_id} neural diagnosis: {diagnosis}")
+    return diagnosis
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import os
 
 import matplotlib
@@ -10,16 +12,22 @@ from django.contrib import messages
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.core.exceptions import SuspiciousOperation
-from django.core.files.base import ContentFile
+from django.core import signing
+from django.core.exceptions import RequestDataTooBig, SuspiciousOperation
+from django.core.files.base import File
 from django.core.files.storage import default_storage
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-from django.http import Http404
+from django.http import Http404, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
 from django.shortcuts import render, redirect
 from django.utils.text import get_valid_filename
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 from .models import Patient
-from .tasks import convert_patient_nii
+from .tasks import CALLBACK_SALT, convert_patient_nii, handle_inference_result
+from .utils import (IMAGE_EXTENSIONS, PREVIEW_ROOT, format_neural_diagnosis, load_detections,
+                    load_preview_manifest)
+from .yolo_client import read_metrics
 
 
 # === User registration ===
@@ -190,6 +198,39 @@ def patients(request):
 
 # === NII file handling service ===
 
+class ChecksumUploadFile(File):
+    """
+    Обёртка над загруженным файлом, которая отдаёт его хранилищу по частям,
+    попутно считая SHA-256 и размер и проверяя лимит размера.
+
+    При превышении лимита запись обрывается без исключения и выставляется
+    too_large: так хранилище возвращает имя, под которым на самом деле
+    сохранило файл, и удаляется именно он.
+
+    Args:
+        upload (UploadedFile): Загруженный файл.
+        max_size (int): Максимально допустимый размер в байтах.
+        chunk_size (int): Размер части в байтах.
+    """
+
+    def __init__(self, upload, max_size, chunk_size):
+        super().__init__(upload, name=upload.name)
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.sha256 = hashlib.sha256()
+        self.bytes_read = 0
+        self.too_large = False
+
+    def chunks(self, chunk_size=None):
+        for chunk in self.file.chunks(self.chunk_size):
+            self.bytes_read += len(chunk)
+            if self.bytes_read > self.max_size:
+                self.too_large = True
+                return
+            self.sha256.update(chunk)
+            yield chunk
+
+
 class NiiFileHandler:
     """
     Класс для обработки NIfTI файлов.
@@ -224,18 +265,27 @@ class NiiFileHandler:
             file (UploadedFile): Загруженный файл.
 
         Returns:
-            tuple: Кортеж с именем файла и полным путем к файлу.
+            tuple: Кортеж с именем файла, полным путем к файлу и SHA-256 его содержимого.
         """
 
         filename = get_valid_filename(file.name)
         if not NiiFileHandler.is_valid_extension(filename):
             raise SuspiciousOperation(f"Invalid file type: {filename}")
 
+        max_size = settings.NII_UPLOAD_MAX_SIZE
+        if file.size is not None and file.size > max_size:
+            raise RequestDataTooBig(f"Файл больше {max_size} байт: {filename}")
+
         user_folder = os.path.join("nii", user.username)
-        file_path = os.path.join(user_folder, filename)
-        saved_path = default_storage.save(file_path, ContentFile(file.read()))
+
+        # Пишем файл по частям: память не зависит от размера загрузки
+        upload = ChecksumUploadFile(file, max_size, settings.NII_UPLOAD_CHUNK_SIZE)
+        saved_path = default_storage.save(os.path.join(user_folder, filename), upload)
+        if upload.too_large:
+            default_storage.delete(saved_path)
+            raise RequestDataTooBig(f"Файл больше {max_size} байт: {filename}")
         full_path = default_storage.path(saved_path)
-        return filename, full_path
+        return filename, full_path, upload.sha256.hexdigest()
 
 
 def create_patient_record(data, doctor_name):
@@ -272,6 +322,7 @@ def convert(request):
         HttpResponse: Ответ HTTP с отображением страницы загрузки файла или перенаправлением на ту же страницу.
     """
 
+    # Слишком большой запрос отклоняется ещё при разборе тела (UploadSizeLimitHandler)
     if request.method == "POST" and request.FILES.get("nii_file"):
         nii_file = request.FILES["nii_file"]
 
@@ -283,9 +334,15 @@ def convert(request):
         }
         doctor_name = request.user.username
 
-        filename, full_path = NiiFileHandler.save_file(request.user, nii_file)
+        # Срочное исследование обгоняет в очередях Celery уже поставленные обычные
+        if request.POST.get("priority") == "urgent":
+            priority = settings.NII_URGENT_PRIORITY
+        else:
+            priority = settings.CELERY_TASK_DEFAULT_PRIORITY
+
+        filename, full_path, checksum = NiiFileHandler.save_file(request.user, nii_file)
         patient = create_patient_record(patient_data, doctor_name)
-        convert_patient_nii.delay(patient.id, full_path, filename)
+        convert_patient_nii.apply_async((patient.id, full_path, filename, checksum), priority=priority)
 
         return redirect("convert")
 
@@ -322,13 +379,20 @@ def view_pngs(request, folder):
         }
         return render(request, 'WebSite/folder_list.html', context)
 
-    png_files = sorted([f for f in files if f.lower().endswith('.png')])
+    png_files = sorted([f for f in files if f.lower().endswith(IMAGE_EXTENSIONS)])
     png_file_urls = [
         os.path.join(settings.MEDIA_URL, 'png', folder, f)
         for f in png_files
     ]
+    # Превью из манифеста, а для срезов без превью — полноразмерное изображение
+    previews = load_preview_manifest(folder)
+    preview_urls = [
+        os.path.join(settings.MEDIA_URL, PREVIEW_ROOT, folder, previews[f]['preview'])
+        if f in previews else url
+        for f, url in zip(png_files, png_file_urls)
+    ]
     page = request.GET.get('page', 1)
-    paginator = Paginator(list(zip(png_file_urls, png_files)), 20)
+    paginator = Paginator(list(zip(png_file_urls, png_files, preview_urls)), 20)
     try:
         page_obj = paginator.page(page)
     except PageNotAnInteger:
@@ -336,10 +400,69 @@ def view_pngs(request, folder):
     except EmptyPage:
         page_obj = paginator.page(paginator.num_pages)
 
+    # Итог исследования берётся из detections.json, а не из имён файлов визуализаций
+    detections = load_detections(folder)
     context = {
         'folder': folder,
         'png_files': page_obj.object_list,
         'media_url': settings.MEDIA_URL,
         'page_obj': page_obj,
+        'verdict': format_neural_diagnosis(detections['verdict']) if detections else None,
     }
     return render(request, 'WebSite/view_pngs.html', context)
+
+
+# === YOLO server callback ===
+
+@csrf_exempt
+@require_POST
+def inference_callback(request):
+    """
+    Принимает результат задачи инференса от сервера YOLO и передаёт его задаче Celery.
+
+    Часть исследования определяется подписанным токеном из адреса callback,
+    который сайт передал серверу вместе с задачей.
+
+    Args:
+        request (HttpRequest): POST с JSON {"job_id", "status", "error", "result"}.
+
+    Returns:
+        JsonResponse: 202, если результат принят; 403 при неверном токене.
+    """
+
+    try:
+        chunk = signing.loads(request.GET.get('token', ''), salt=CALLBACK_SALT,
+                              max_age=settings.STUDY_PROGRESS_TTL)
+    except signing.BadSignature:
+        return HttpResponseForbidden("Неверный токен")
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest("Ожидался JSON")
+
+    # Для сборки исследования нужны только детекции срезов
+    images = [{'image': image['image'], 'detections': image.get('detections', [])}
+              for image in (payload.get('result') or {}).get('images', [])]
+    # Приоритет исследования передаётся в токене: у запроса сервера YOLO нет родительской задачи
+    handle_inference_result.apply_async(
+        (chunk['run_id'], chunk['index'], chunk['folder'], chunk['images'],
+         payload.get('status'), images, payload.get('error'), chunk.get('attempt', 0)),
+        priority=chunk.get('priority'))
+    return JsonResponse({'status': 'accepted'}, status=202)
+
+
+@login_required
+def inference_metrics(request):
+    """
+    Метрики запросов воркеров Celery к серверу YOLO (только для сотрудников).
+
+    Args:
+        request (HttpRequest): Запрос.
+
+    Returns:
+        JsonResponse: Счётчики запросов, ошибок, отклонённых автоматом отключения и гистограмма задержек.
+    """
+
+    if not request.user.is_staff:
+        return HttpResponseForbidden("Доступ только для сотрудников")
+    return JsonResponse(read_metrics())
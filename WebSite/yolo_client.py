@@ -0,0 +1,248 @@
+import logging
+import os
+import threading
+import time
+
+import redis
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .progress import get_redis
+
+
+logger = logging.getLogger(__name__)
+
+
+# Хэш Redis со счётчиками запросов к серверу YOLO от всех воркеров
+METRICS_KEY = "yolo_client:metrics"
+# Границы корзин гистограммы задержек, мс
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class YoloUnavailable(Exception):
+    """
+    Сервер YOLO считается недоступным: запрос не отправлялся.
+
+    Args:
+        retry_after (float): Через сколько секунд имеет смысл повторить.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Сервер YOLO недоступен, повтор через {retry_after:.0f} с")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Автомат отключения запросов к серверу, который раз за разом не отвечает.
+
+    После failure_threshold ошибок подряд запросы сразу отклоняются
+    (YoloUnavailable) в течение reset_timeout секунд. Затем пропускается один
+    пробный запрос: успех возвращает обычный режим, ошибка снова отключает
+    запросы на reset_timeout. Если о пробном запросе не сообщили за
+    reset_timeout (воркер погиб посреди запроса), пропускается новый.
+
+    Args:
+        failure_threshold (int): Ошибок подряд до отключения.
+        reset_timeout (float): Время отключения, с.
+        clock (callable): Источник времени (для тестов).
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Проверяет, можно ли отправить запрос.
+
+        Raises:
+            YoloUnavailable: Запросы отключены или пробный запрос уже выполняется.
+        """
+
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            now = self.clock()
+            remaining = self.opened_at + self.reset_timeout - now
+            if remaining <= 0:
+                if self.state == self.HALF_OPEN:
+                    logger.warning("YOLO circuit probe did not report back, sending a new probe request")
+                else:
+                    logger.info("YOLO circuit half-open, sending a probe request")
+                self.state = self.HALF_OPEN
+                self.opened_at = now
+                return
+            raise YoloUnavailable(max(remaining, 1.0))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("YOLO circuit closed")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"YOLO circuit open for {self.reset_timeout} s after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class YoloClient:
+    """
+    HTTP-клиент сервера YOLO для воркера Celery.
+
+    Соединения переиспользуются (keep-alive, пул YOLO_HTTP_POOL_SIZE).
+    Ошибки соединения повторяются до YOLO_HTTP_RETRIES раз с экспоненциальной
+    задержкой, ответы 502/503/504 — только для GET: постановка задачи (POST)
+    не идемпотентна, и шлюз мог ответить 502/504, когда сервер её уже принял.
+    Ошибка чтения ответа не повторяется, потому что запрос уже мог дойти до
+    сервера. Ошибки соединения и ответы 5xx учитываются автоматом отключения.
+    Число запросов, ошибок и гистограмма задержек копятся в Redis
+    (METRICS_KEY) по всем воркерам.
+
+    Args:
+        session (requests.Session or None): Сессия (по умолчанию создаётся с пулом и повторами).
+        breaker (CircuitBreaker or None): Автомат отключения.
+        metrics_client (redis.Redis or None): Клиент Redis для метрик (по умолчанию get_redis()).
+    """
+
+    def __init__(self, session=None, breaker=None, metrics_client=None):
+        self.session = session or self._make_session()
+        self.breaker = breaker or CircuitBreaker(settings.YOLO_BREAKER_THRESHOLD, settings.YOLO_BREAKER_RESET)
+        self.metrics_client = metrics_client or get_redis()
+
+    @staticmethod
+    def _make_session():
+        retry = Retry(total=settings.YOLO_HTTP_RETRIES, read=0, backoff_factor=settings.YOLO_HTTP_BACKOFF,
+                      status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET"}),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.YOLO_HTTP_POOL_SIZE, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def post(self, url, **kwargs):
+        """
+        Отправляет POST на сервер YOLO.
+
+        Args:
+            url (str): Адрес.
+            **kwargs: Аргументы requests (params, json, timeout — по умолчанию YOLO_HTTP_TIMEOUT).
+
+        Returns:
+            requests.Response: Успешный ответ.
+
+        Raises:
+            YoloUnavailable: Запросы к серверу временно отключены.
+            requests.RequestException: Ошибка соединения или ответ с ошибкой.
+        """
+
+        return self._request("post", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        """
+        Отправляет GET на сервер YOLO (аргументы и ошибки как у post).
+        """
+
+        return self._request("get", url, **kwargs)
+
+    def _request(self, method, url, **kwargs):
+        try:
+            self.breaker.before_call()
+        except YoloUnavailable:
+            self._record(rejected=True)
+            raise
+
+        kwargs.setdefault("timeout", settings.YOLO_HTTP_TIMEOUT)
+        started = time.perf_counter()
+        try:
+            response = getattr(self.session, method)(url, **kwargs)
+        except requests.RequestException:
+            self.breaker.record_failure()
+            self._record(failed=True, elapsed=time.perf_counter() - started)
+            raise
+
+        failed = response.status_code >= 500
+        if failed:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        self._record(failed=failed, elapsed=time.perf_counter() - started)
+        response.raise_for_status()
+        return response
+
+    def _record(self, failed=False, rejected=False, elapsed=None):
+        try:
+            pipe = self.metrics_client.pipeline()
+            if rejected:
+                pipe.hincrby(METRICS_KEY, "rejected", 1)
+            else:
+                elapsed_ms = int(elapsed * 1000)
+                bucket = next((f"le_{bound}" for bound in LATENCY_BUCKETS_MS if elapsed_ms <= bound), "le_inf")
+                pipe.hincrby(METRICS_KEY, "requests", 1)
+                pipe.hincrby(METRICS_KEY, "failures", int(failed))
+                pipe.hincrby(METRICS_KEY, "latency_ms_total", elapsed_ms)
+                pipe.hincrby(METRICS_KEY, bucket, 1)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Could not record YOLO client metrics: {e}")
+
+
+def read_metrics(client=None):
+    """
+    Метрики запросов к серверу YOLO, накопленные всеми воркерами.
+
+    Args:
+        client (redis.Redis or None): Клиент Redis (по умолчанию get_redis()).
+
+    Returns:
+        dict: requests, failures, rejected, avg_latency_ms и гистограмма latency_ms {граница: число запросов}.
+    """
+
+    raw = {(k.decode() if isinstance(k, bytes) else k): int(v)
+           for k, v in (client or get_redis()).hgetall(METRICS_KEY).items()}
+    requests_count = raw.get("requests", 0)
+    return {
+        "requests": requests_count,
+        "failures": raw.get("failures", 0),
+        "rejected": raw.get("rejected", 0),
+        "avg_latency_ms": round(raw.get("latency_ms_total", 0) / requests_count, 1) if requests_count else None,
+        "latency_ms": {str(bound): raw.get(f"le_{bound}", 0) for bound in LATENCY_BUCKETS_MS + ("inf",)},
+    }
+
+
+_client = None
+_client_pid = None
+
+
+def get_client():
+    """
+    Клиент сервера YOLO текущего процесса (создаётся заново после fork, чтобы
+    дочерние процессы не делили сокеты пула).
+
+    Returns:
+        YoloClient: Клиент.
+    """
+
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = YoloClient()
+        _client_pid = os.getpid()
+    return _client
@@ -1,3 +1,22 @@
 #!/bin/bash
-echo "Запуск Celery worker..."
-exec celery -A BrainTumor worker --loglevel=info
+# Отдельный воркер на каждую очередь: конвертация не занимает процессы,
+# которые обмениваются с сервером YOLO, и наоборот
+start_worker() {
+    local queue=$1 concurrency=$2 prefetch=$3
+    echo "Запуск Celery worker для очереди ${queue} (процессов: ${concurrency}, prefetch: ${prefetch})..."
+    celery -A BrainTumor worker --loglevel=info -Q "${queue}" -n "${queue}@%h" \
+        --concurrency="${concurrency}" --prefetch-multiplier="${prefetch}" &
+}
+
+start_worker render "${CELERY_RENDER_CONCURRENCY:-2}" "${CELERY_RENDER_PREFETCH:-1}"
+start_worker dispatch "${CELERY_DISPATCH_CONCURRENCY:-8}" "${CELERY_DISPATCH_PREFETCH:-4}"
+start_worker maintenance "${CELERY_MAINTENANCE_CONCURRENCY:-1}" "${CELERY_MAINTENANCE_PREFETCH:-1}"
+
+# Сигнал остановки передаётся всем воркерам; если упал любой из них, останавливаются
+# остальные и контейнер завершается (docker перезапустит его)
+trap 'kill -TERM $(jobs -p) 2>/dev/null; wait' TERM INT
+wait -n
+status=$?
+kill -TERM $(jobs -p) 2>/dev/null
+wait
+exit $status
@@ -0,0 +1,231 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from yolo_train_compare import ModelEvaluator
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatcherOverloaded(RuntimeError):
+    """
+    Очередь микробатчера заполнена, запрос не принят.
+    """
+
+
+class BatchTooLarge(ValueError):
+    """
+    В запросе больше срезов, чем вмещает очередь: он не будет принят никогда.
+    """
+
+
+class MicroBatcher:
+    """
+    Планировщик, объединяющий срезы из параллельных запросов в общие батчи.
+
+    Запрос кладёт свои срезы в очередь и получает по Future на каждый срез.
+    Фоновый поток собирает батч, пока он не наберёт max_batch_size срезов или
+    пока самый старый срез не прождёт max_wait_ms, прогоняет его через модель
+    одним вызовом и раздаёт результаты обратно по Future. Если батч упал
+    целиком (например, из-за одного нечитаемого среза), его срезы прогоняются
+    по одному, чтобы ошибка досталась только своему запросу.
+
+    Args:
+        get_evaluator (Callable[[], ModelEvaluator]): Возвращает текущую модель (например, ModelPool.get).
+        max_batch_size (int): Максимальное количество срезов в батче.
+        max_wait_ms (float): Максимальное ожидание самого старого среза перед запуском батча.
+        max_queue_depth (int): Максимальное количество срезов в очереди.
+    """
+
+    def __init__(self, get_evaluator: Callable[[], ModelEvaluator], max_batch_size: int = 16,
+                 max_wait_ms: float = 10.0, max_queue_depth: int = 1024):
+        self.get_evaluator = get_evaluator
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_depth = max_queue_depth
+
+        # Элементы очереди: (срез, (устройство, вернуть визуализации), Future, время постановки)
+        self._pending: deque = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+        self._counters = {
+            "batches_total": 0,
+            "items_total": 0,
+            "rejected_total": 0,
+            "errors_total": 0,
+            "last_batch_size": 0,
+            "max_queue_depth_seen": 0,
+            "wait_ms_total": 0.0,
+            "inference_ms_total": 0.0,
+        }
+
+    def submit(self, items: List[Tuple[Union[str, np.ndarray], str, Optional[str]]],
+               device: str = "cpu", return_annotations: bool = False) -> List[Future]:
+        """
+        Ставит срезы запроса в очередь.
+
+        Args:
+            items (List[Tuple[Union[str, np.ndarray], str, Optional[str]]]): Тройки
+                (путь или изображение, имя изображения, директория для визуализаций).
+            device (str): Устройство для инференса.
+            return_annotations (bool): Вернуть закодированные визуализации вместе с метриками.
+
+        Returns:
+            List[Future]: Future с метриками для каждого среза в порядке items.
+        """
+
+        if len(items) > self.max_queue_depth:
+            raise BatchTooLarge(f"В запросе {len(items)} срезов, очередь вмещает {self.max_queue_depth}")
+
+        futures = [Future() for _ in items]
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Микробатчер остановлен")
+            if len(self._pending) + len(items) > self.max_queue_depth:
+                self._counters["rejected_total"] += 1
+                raise BatcherOverloaded(f"Очередь инференса заполнена: {len(self._pending)} срезов "
+                                        f"из {self.max_queue_depth}")
+            now = time.monotonic()
+            options = (device, return_annotations)
+            self._pending.extend((item, options, future, now) for item, future in zip(items, futures))
+            self._counters["max_queue_depth_seen"] = max(self._counters["max_queue_depth_seen"],
+                                                         len(self._pending))
+            self._cond.notify()
+        return futures
+
+    def _next_batch(self) -> Optional[list]:
+        """
+        Ждёт и забирает из очереди следующий батч срезов с одинаковыми устройством и опциями.
+
+        Returns:
+            Optional[list]: Элементы очереди или None, если батчер остановлен.
+        """
+
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            if not self._pending:
+                return None
+
+            deadline = self._pending[0][3] + self.max_wait
+            while len(self._pending) < self.max_batch_size and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            options = self._pending[0][1]
+            batch = []
+            while self._pending and len(batch) < self.max_batch_size and self._pending[0][1] == options:
+                entry = self._pending.popleft()
+                # Отменённые Future (клиент ушёл) в батч не попадают
+                if entry[2].set_running_or_notify_cancel():
+                    batch.append(entry)
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if not batch:
+                continue
+
+            started = time.monotonic()
+            device, return_annotations = batch[0][1]
+            try:
+                evaluator = self.get_evaluator()
+            except Exception as e:
+                # Например, неудачная горячая перезагрузка: отказываем батчу, но поток продолжает работу
+                logger.error(f"Модель недоступна, батч из {len(batch)} срезов отклонён: {e}", exc_info=True)
+                with self._cond:
+                    self._counters["errors_total"] += 1
+                for entry in batch:
+                    entry[2].set_exception(e)
+                continue
+            try:
+                results = evaluator.evaluate_batch([entry[0] for entry in batch], device=device,
+                                                   return_annotations=return_annotations)
+            except Exception as e:
+                logger.error(f"Ошибка инференса батча из {len(batch)} срезов: {e}", exc_info=True)
+                with self._cond:
+                    self._counters["errors_total"] += 1
+                if len(batch) == 1:
+                    batch[0][2].set_exception(e)
+                    continue
+                results = None
+
+            if results is None:
+                # Батч упал целиком: прогоняем срезы по одному, чтобы найти виновный
+                for entry in batch:
+                    try:
+                        metrics = evaluator.evaluate_batch([entry[0]], device=device,
+                                                           return_annotations=return_annotations)[0]
+                    except Exception as e:
+                        entry[2].set_exception(e)
+                    else:
+                        entry[2].set_result(metrics)
+            else:
+                for entry, metrics in zip(batch, results):
+                    entry[2].set_result(metrics)
+            finished = time.monotonic()
+            with self._cond:
+                self._counters["batches_total"] += 1
+                self._counters["items_total"] += len(batch)
+                self._counters["last_batch_size"] = len(batch)
+                self._counters["wait_ms_total"] += sum(started - entry[3] for entry in batch) * 1000
+                self._counters["inference_ms_total"] += (finished - started) * 1000
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Настройки и счётчики батчера для эндпоинта метрик.
+
+        Returns:
+            Dict[str, Any]: Конфигурация, текущая глубина очереди и накопленные счётчики.
+        """
+
+        with self._cond:
+            counters = dict(self._counters)
+            queue_depth = len(self._pending)
+
+        batches = counters["batches_total"] or 1
+        items = counters["items_total"] or 1
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "max_queue_depth": self.max_queue_depth,
+            "queue_depth": queue_depth,
+            **counters,
+            "avg_batch_size": round(counters["items_total"] / batches, 2),
+            "avg_wait_ms": round(counters["wait_ms_total"] / items, 2),
+            "avg_inference_ms_per_item": round(counters["inference_ms_total"] / items, 2),
+        }
+
+    def start(self) -> None:
+        """
+        Запускает фоновый поток сборки батчей.
+        """
+
+        if self._thread is None:
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Останавливает приём срезов и дожидается обработки уже поставленных.
+        """
+
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
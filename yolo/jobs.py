@@ -0,0 +1,230 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATUSES = (DONE, FAILED, CANCELLED)
+
+
+class JobQueueFull(RuntimeError):
+    """
+    Превышено допустимое количество задач в очереди.
+    """
+
+
+@dataclass
+class Job:
+    """
+    Задача инференса.
+
+    Args:
+        id (str): Идентификатор задачи.
+        params (Dict[str, Any]): Параметры задачи (папка, устройство и т.д.).
+        status (str): queued, running, done, failed или cancelled.
+        created_at (float): Время постановки в очередь.
+        started_at (Optional[float]): Время начала выполнения.
+        finished_at (Optional[float]): Время завершения.
+        result (Any): Результат выполнения.
+        error (Optional[str]): Текст ошибки.
+        callback_url (Optional[str]): Адрес, на который отправляется результат после завершения.
+    """
+
+    id: str
+    params: Dict[str, Any]
+    status: str = QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Any = None
+    error: Optional[str] = None
+    future: Optional[Future] = field(default=None, repr=False)
+    # Future срезов в микробатчере: отменяются вместе с задачей
+    slice_futures: List[Future] = field(default_factory=list, repr=False)
+    cancel_requested: bool = False
+    callback_url: Optional[str] = field(default=None, repr=False)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Состояние задачи без результата для эндпоинта статуса.
+        """
+
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "params": self.params,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """
+    Очередь задач инференса с ограниченным пулом исполнителей.
+
+    Задачи выполняются функцией run в пуле из max_workers потоков, поэтому
+    event loop сервера не блокируется. В очереди одновременно может ждать не
+    больше max_queued задач. Завершённые задачи хранятся ttl секунд. После
+    завершения задачи с любым статусом вызывается on_finish.
+
+    Args:
+        run (Callable[[Job], Any]): Выполняет задачу и возвращает её результат.
+        max_workers (int): Количество одновременно выполняемых задач.
+        max_queued (int): Максимальное количество задач, ожидающих выполнения.
+        ttl (float): Время хранения завершённых задач в секундах.
+        on_finish (Optional[Callable[[Job], None]]): Вызывается с завершённой задачей.
+    """
+
+    def __init__(self, run: Callable[[Job], Any], max_workers: int = 2, max_queued: int = 32, ttl: float = 3600,
+                 on_finish: Optional[Callable[[Job], None]] = None):
+        self.run = run
+        self.on_finish = on_finish
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference-job")
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def _prune(self) -> None:
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.status in FINISHED_STATUSES and time.time() - job.finished_at > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def submit(self, params: Dict[str, Any], callback_url: Optional[str] = None) -> Job:
+        """
+        Ставит задачу в очередь.
+
+        Args:
+            params (Dict[str, Any]): Параметры задачи.
+            callback_url (Optional[str]): Адрес для уведомления о завершении.
+
+        Returns:
+            Job: Поставленная задача.
+        """
+
+        with self._lock:
+            self._prune()
+            queued = sum(1 for job in self._jobs.values() if job.status == QUEUED)
+            if queued >= self.max_queued:
+                raise JobQueueFull(f"В очереди уже {queued} задач (максимум {self.max_queued})")
+            job = Job(id=uuid.uuid4().hex, params=params, callback_url=callback_url)
+            self._jobs[job.id] = job
+            job.future = self._executor.submit(self._execute, job)
+
+        logger.info(f"Задача {job.id} поставлена в очередь: {params}")
+        return job
+
+    def _finished(self, job: Job) -> None:
+        if self.on_finish is None:
+            return
+        try:
+            self.on_finish(job)
+        except Exception as e:
+            logger.error(f"Ошибка обработчика завершения задачи {job.id}: {e}", exc_info=True)
+
+    def _execute(self, job: Job) -> Any:
+        with self._lock:
+            cancelled = job.cancel_requested
+            if cancelled:
+                job.status = CANCELLED
+                job.finished_at = time.time()
+            else:
+                job.status = RUNNING
+                job.started_at = time.time()
+        if cancelled:
+            self._finished(job)
+            raise CancelledError()
+
+        exception = None
+        try:
+            result = self.run(job)
+            status = CANCELLED if job.cancel_requested else DONE
+        except CancelledError as e:
+            status, result, exception = CANCELLED, None, e
+        except Exception as e:
+            logger.error(f"Задача {job.id} завершилась с ошибкой: {e}", exc_info=True)
+            status, result, exception = FAILED, None, e
+
+        with self._lock:
+            job.status = status
+            job.result = result
+            job.error = str(exception) if status == FAILED else None
+            job.finished_at = time.time()
+        logger.info(f"Задача {job.id}: {status}")
+        self._finished(job)
+        # Future задачи завершается с той же ошибкой, чтобы синхронный эндпоинт мог её разобрать
+        if exception is not None:
+            raise exception
+        if status == CANCELLED:
+            raise CancelledError()
+        return result
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """
+        Возвращает задачу по идентификатору.
+        """
+
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """
+        Отменяет задачу: ожидающая снимается с очереди, у выполняемой
+        отменяются ещё не обработанные срезы.
+
+        Args:
+            job_id (str): Идентификатор задачи.
+
+        Returns:
+            Optional[Job]: Задача или None, если она не найдена.
+        """
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATUSES:
+                return job
+            job.cancel_requested = True
+            dequeued = job.status == QUEUED and job.future.cancel()
+            if dequeued:
+                job.status = CANCELLED
+                job.finished_at = time.time()
+            slice_futures = list(job.slice_futures)
+
+        for future in slice_futures:
+            future.cancel()
+        # Снятая с очереди задача не дойдёт до _execute
+        if dequeued:
+            self._finished(job)
+        return job
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Количество задач по статусам.
+        """
+
+        with self._lock:
+            counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED, CANCELLED)}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return {**counts, "max_queued": self.max_queued}
+
+    def shutdown(self) -> None:
+        """
+        Отменяет ожидающие задачи и дожидается выполняемых.
+        """
+
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,267 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from yolo_train_compare import (BACKEND_PYTORCH, PRECISION_FP32, ModelEvaluator, check_backend_parity,
+                                check_precision_gate, load_validation_images)
+
+
+logger = logging.getLogger(__name__)
+
+
+class ModelPool:
+    """
+    Резидентная модель для сервера инференса.
+
+    Модель загружается один раз, прогревается фиктивным изображением и
+    переиспользуется между запросами. Фоновый поток следит за best_model.txt
+    и файлом весов: при изменении новая модель загружается и прогревается
+    рядом со старой, после чего ссылка на неё подменяется атомарно. Запросы,
+    начатые на старой модели, дорабатывают на ней.
+
+    Если выбран экспортированный бэкенд и задан набор проверочных изображений,
+    после загрузки проверяется паритет с PyTorch; при расхождении сервер
+    остаётся на исходной модели. Режим пониженной точности (bf16/int8)
+    включается только если на проверочных изображениях он согласуется с fp32
+    не хуже precision_min_agreement.
+
+    Args:
+        config_path (str): Путь к best_model.txt с путём к весам.
+        reload_interval (float): Период проверки изменений в секундах (0 — без горячей перезагрузки).
+        warmup_imgsz (int): Размер стороны фиктивного изображения для прогрева.
+        device (str): Устройство для прогрева.
+        evaluator_options (Optional[Dict[str, Any]]): Дополнительные аргументы ModelEvaluator.
+        validation_path (Optional[str]): Папка или slices.npz для проверки паритета бэкенда.
+        min_agreement (float): Минимальное согласие детекций с PyTorch.
+        conf_tolerance (float): Максимальная разница уверенности совпавших боксов.
+        precision_min_agreement (float): Минимальное согласие режима пониженной точности с fp32.
+    """
+
+    def __init__(self, config_path: str, reload_interval: float = 5.0, warmup_imgsz: int = 640,
+                 device: str = "cpu", evaluator_options: Optional[Dict[str, Any]] = None,
+                 validation_path: Optional[str] = None, min_agreement: float = 0.95, conf_tolerance: float = 0.05,
+                 precision_min_agreement: float = 0.9):
+        self.config_path = config_path
+        self.evaluator_options = evaluator_options or {}
+        self.validation_path = validation_path
+        self.min_agreement = min_agreement
+        self.conf_tolerance = conf_tolerance
+        self.precision_min_agreement = precision_min_agreement
+        self.reload_interval = reload_interval
+        self.warmup_imgsz = warmup_imgsz
+        self.device = device
+
+        self._lock = threading.Lock()
+        self._evaluator: Optional[ModelEvaluator] = None
+        self._info: Dict[str, Any] = {}
+        self._signature: Optional[Tuple] = None
+        # Сигнатура весов, которые не удалось загрузить: повторно они не загружаются, пока файлы не изменятся
+        self._failed_signature: Optional[Tuple] = None
+        self._error: Optional[str] = None
+        self._stop = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+
+    def _read_model_path(self) -> str:
+        """
+        Читает путь к весам из best_model.txt.
+
+        Returns:
+            str: Путь к файлу весов.
+        """
+
+        if not os.path.exists(self.config_path):
+            raise FileNotFoundError(f"{self.config_path} не найден. Сначала обучите модель.")
+
+        with open(self.config_path, "r") as f:
+            model_path = f.read().strip()
+
+        if not model_path or not os.path.exists(model_path):
+            raise FileNotFoundError(f"Файл лучшей модели '{model_path}' не найден или "
+                                    f"{os.path.basename(self.config_path)} пуст.")
+        return model_path
+
+    def _signature_of(self, model_path: str) -> Tuple:
+        """
+        Сигнатура версии модели: путь к весам и время изменения файлов.
+        """
+
+        return (model_path, os.path.getmtime(self.config_path), os.path.getmtime(model_path))
+
+    @staticmethod
+    def _file_digest(path: str) -> str:
+        """
+        SHA-256 файла весов (первые 16 символов).
+        """
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()[:16]
+
+    def _warmup(self, evaluator: ModelEvaluator) -> float:
+        """
+        Прогревает модель фиктивным изображением.
+
+        Returns:
+            float: Время прогрева в миллисекундах.
+        """
+
+        dummy = np.zeros((self.warmup_imgsz, self.warmup_imgsz, 3), dtype=np.uint8)
+        started = time.perf_counter()
+        evaluator.predict(dummy, device=self.device, verbose=False)
+        return (time.perf_counter() - started) * 1000
+
+    def _check_parity(self, model_path: str, evaluator: ModelEvaluator) -> Tuple[ModelEvaluator, Optional[Dict]]:
+        """
+        Сверяет экспортированную модель с PyTorch на проверочных изображениях.
+
+        Returns:
+            Tuple[ModelEvaluator, Optional[Dict]]: Модель для работы (исходная при
+                провале проверки) и отчёт проверки.
+        """
+
+        if evaluator.backend == BACKEND_PYTORCH or not self.validation_path:
+            return evaluator, None
+
+        reference = ModelEvaluator(model_path, **{**self.evaluator_options, "backend": BACKEND_PYTORCH})
+        report = check_backend_parity(model_path, evaluator.backend, load_validation_images(self.validation_path),
+                                      min_agreement=self.min_agreement, conf_tolerance=self.conf_tolerance,
+                                      reference=reference, candidate=evaluator)
+        if not report["passed"]:
+            logger.error(f"Бэкенд {evaluator.backend} не прошёл проверку паритета, используем PyTorch")
+            return reference, report
+        return evaluator, report
+
+    def _load_reduced_precision(self, model_path: str) -> Tuple[ModelEvaluator, Optional[Dict]]:
+        """
+        Загружает модель пониженной точности, если она проходит проверку согласия с fp32.
+
+        Returns:
+            Tuple[ModelEvaluator, Optional[Dict]]: Модель для работы (fp32 при провале
+                или отсутствии проверочных изображений) и отчёт проверки.
+        """
+
+        precision = self.evaluator_options["precision"]
+        fp32_options = {**self.evaluator_options, "backend": BACKEND_PYTORCH, "precision": PRECISION_FP32}
+        if not self.validation_path:
+            logger.error(f"Режим {precision} не включён: не заданы проверочные изображения")
+            return ModelEvaluator(model_path, **fp32_options), None
+
+        report, reference, candidate = check_precision_gate(
+            model_path, precision, load_validation_images(self.validation_path),
+            min_agreement=self.precision_min_agreement, imgsz=self.evaluator_options.get("imgsz", 640),
+            evaluator_options=self.evaluator_options)
+        if not report["passed"]:
+            logger.error(f"Режим {precision} не прошёл проверку точности, используем fp32")
+            return reference, report
+        return candidate, report
+
+    def load(self) -> bool:
+        """
+        Загружает и прогревает модель, если она изменилась, и подменяет текущую.
+
+        Если версию не удалось загрузить (битые веса, ошибка экспорта или
+        проверки), она запоминается и не загружается заново при каждой
+        проверке изменений, пока не изменятся best_model.txt или файл весов.
+
+        Returns:
+            bool: True, если модель была (пере)загружена.
+        """
+
+        signature = None
+        try:
+            model_path = self._read_model_path()
+            signature = self._signature_of(model_path)
+            if signature in (self._signature, self._failed_signature):
+                return False
+
+            logger.info(f"Загрузка модели {model_path}")
+            started = time.perf_counter()
+            parity = precision_gate = None
+            if self.evaluator_options.get("precision", PRECISION_FP32) != PRECISION_FP32:
+                evaluator, precision_gate = self._load_reduced_precision(model_path)
+            else:
+                evaluator = ModelEvaluator(model_path, **self.evaluator_options)
+                evaluator, parity = self._check_parity(model_path, evaluator)
+            load_ms = (time.perf_counter() - started) * 1000
+            warmup_ms = self._warmup(evaluator)
+            weights_digest = self._file_digest(model_path)
+        except Exception as e:
+            self._error = str(e)
+            self._failed_signature = signature
+            logger.error(f"Не удалось загрузить модель: {e}", exc_info=True)
+            return False
+
+        with self._lock:
+            self._evaluator = evaluator
+            self._signature = signature
+            self._error = None
+            self._info = {
+                "model_path": model_path,
+                "backend": evaluator.backend,
+                "precision": evaluator.precision,
+                # Версия для ключей кэша предсказаний на стороне сайта
+                "model_version": f"{weights_digest}-{evaluator.backend}-{evaluator.precision}",
+                "parity": parity,
+                "precision_gate": precision_gate,
+                "loaded_at": time.time(),
+                "load_ms": round(load_ms, 1),
+                "warmup_ms": round(warmup_ms, 1),
+            }
+        logger.info(f"Модель {model_path} загружена за {load_ms:.0f} мс, прогрев {warmup_ms:.0f} мс")
+        return True
+
+    def get(self) -> ModelEvaluator:
+        """
+        Возвращает текущую прогретую модель.
+
+        Returns:
+            ModelEvaluator: Оценщик с загруженной моделью.
+        """
+
+        with self._lock:
+            evaluator = self._evaluator
+        if evaluator is None:
+            raise RuntimeError(f"Модель не загружена: {self._error or 'загрузка ещё идёт'}")
+        return evaluator
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Состояние пула для эндпоинта готовности.
+
+        Returns:
+            Dict[str, Any]: ready, сведения о модели и последняя ошибка загрузки.
+        """
+
+        with self._lock:
+            return {"ready": self._evaluator is not None, **self._info, "error": self._error}
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.reload_interval):
+            self.load()
+
+    def start(self) -> None:
+        """
+        Загружает модель и запускает фоновую проверку изменений.
+        """
+
+        self.load()
+        if self.reload_interval > 0 and self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, name="model-reload", daemon=True)
+            self._watcher.start()
+
+    def stop(self) -> None:
+        """
+        Останавливает фоновую проверку изменений.
+        """
+
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join(timeout=self.reload_interval + 1)
+            self._watcher = None
@@ -1,19 +1,233 @@
 import os
+import io
+import json
+import time
+import base64
+import asyncio
 import logging
+import urllib.error
+import urllib.request
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Optional
 
+import cv2
+import numpy as np
 import torch
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
 
-from yolo_train_compare import InferencePipeline 
+from batching import BatcherOverloaded, BatchTooLarge, MicroBatcher
+from jobs import DONE, FINISHED_STATUSES, Job, JobManager, JobQueueFull
+from model_pool import ModelPool
+from workers import WorkerPool
+from yolo_train_compare import InferencePipeline, load_slice_stack, summarize_study
 
 
-app = FastAPI()
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 # Убедитесь, что этот путь существует и доступен
-BEST_MODEL_PATH = "yolo/best_model.txt" 
+BEST_MODEL_PATH = os.getenv("YOLO_CONFIG_PATH", "yolo/best_model.txt")
 MEDIA_ROOT = "./media/png"
+# Период проверки best_model.txt и весов для горячей перезагрузки (0 — отключить)
+MODEL_RELOAD_INTERVAL = float(os.getenv("YOLO_RELOAD_INTERVAL", "5"))
+# Размер фиктивного изображения для прогрева модели
+WARMUP_IMGSZ = int(os.getenv("YOLO_WARMUP_IMGSZ", "640"))
+# Максимальное количество срезов в одном вызове модели (срезы разных запросов объединяются)
+INFERENCE_BATCH_SIZE = int(os.getenv("YOLO_BATCH_SIZE", "16"))
+# Сколько самый старый срез может ждать, пока набирается батч
+BATCH_WAIT_MS = float(os.getenv("YOLO_BATCH_WAIT_MS", "10"))
+# Максимальное количество срезов в очереди; сверх него запросы получают 503
+BATCH_QUEUE_DEPTH = int(os.getenv("YOLO_BATCH_QUEUE_DEPTH", "1024"))
+# Количество процессов инференса (0 — инференс в процессе сервера через микробатчер)
+INFERENCE_WORKERS = int(os.getenv("YOLO_WORKERS", "0"))
+# Потоков torch на процесс; по умолчанию ядра делятся поровну между процессами
+THREADS_PER_WORKER = int(os.getenv("YOLO_THREADS_PER_WORKER") or max(1, (os.cpu_count() or 1) // max(1, INFERENCE_WORKERS)))
+
+# Минимальное количество срезов с опухолью для диагноза исследования
+MIN_TUMOR_SLICES = int(os.getenv("YOLO_MIN_TUMOR_SLICES", "1"))
+
+# Формат визуализаций предсказаний (png, jpeg, webp) и уровень сжатия PNG (0-9) / качество JPEG и WebP
+# (0-100); без YOLO_ANNOTATION_QUALITY берётся значение для формата (DEFAULT_ANNOTATION_QUALITY)
+ANNOTATION_FORMAT = os.getenv("YOLO_ANNOTATION_FORMAT", "png")
+ANNOTATION_QUALITY = int(os.environ["YOLO_ANNOTATION_QUALITY"]) if os.getenv("YOLO_ANNOTATION_QUALITY") else None
+# Бэкенд инференса: pytorch, onnx или torchscript (экспорт кэшируется рядом с весами)
+BACKEND = os.getenv("YOLO_BACKEND", "pytorch")
+EXPORT_IMGSZ = int(os.getenv("YOLO_EXPORT_IMGSZ", "640"))
+# Проверка паритета экспортированной модели с PyTorch: папка с изображениями или slices.npz
+PARITY_IMAGES = os.getenv("YOLO_PARITY_IMAGES") or None
+PARITY_MIN_AGREEMENT = float(os.getenv("YOLO_PARITY_MIN_AGREEMENT", "0.95"))
+PARITY_CONF_TOLERANCE = float(os.getenv("YOLO_PARITY_CONF_TOLERANCE", "0.05"))
+# Точность на CPU: fp32, bf16 или int8; bf16/int8 включаются только после проверки на YOLO_PARITY_IMAGES
+PRECISION = os.getenv("YOLO_PRECISION", "fp32")
+PRECISION_MIN_AGREEMENT = float(os.getenv("YOLO_PRECISION_MIN_AGREEMENT", "0.9"))
+# Максимальный размер тела запроса /predict/ в байтах
+MAX_PAYLOAD_BYTES = int(os.getenv("YOLO_MAX_PAYLOAD_BYTES", str(256 * 1024 * 1024)))
+# Количество одновременно выполняемых задач и ожидающих в очереди
+JOB_WORKERS = int(os.getenv("YOLO_JOB_WORKERS", "4"))
+MAX_QUEUED_JOBS = int(os.getenv("YOLO_MAX_QUEUED_JOBS", "32"))
+# Сколько секунд хранить результаты завершённых задач
+JOB_TTL = float(os.getenv("YOLO_JOB_TTL", "3600"))
+# Уведомление о завершении задачи на callback_url: таймаут запроса и количество попыток
+CALLBACK_TIMEOUT = float(os.getenv("YOLO_CALLBACK_TIMEOUT", "10"))
+CALLBACK_ATTEMPTS = int(os.getenv("YOLO_CALLBACK_ATTEMPTS", "3"))
+
+model_pool = ModelPool(BEST_MODEL_PATH, reload_interval=MODEL_RELOAD_INTERVAL, warmup_imgsz=WARMUP_IMGSZ,
+                       evaluator_options={"annotation_format": ANNOTATION_FORMAT,
+                                          "annotation_quality": ANNOTATION_QUALITY,
+                                          "backend": BACKEND,
+                                          "imgsz": EXPORT_IMGSZ,
+                                          "precision": PRECISION},
+                       validation_path=PARITY_IMAGES, min_agreement=PARITY_MIN_AGREEMENT,
+                       conf_tolerance=PARITY_CONF_TOLERANCE, precision_min_agreement=PRECISION_MIN_AGREEMENT)
+if INFERENCE_WORKERS > 0:
+    # Исследования целиком раздаются свободным процессам, батчи собираются внутри процесса
+    dispatcher = WorkerPool(model_pool.get, workers=INFERENCE_WORKERS, threads_per_worker=THREADS_PER_WORKER,
+                            batch_size=INFERENCE_BATCH_SIZE, max_queue_depth=BATCH_QUEUE_DEPTH,
+                            warmup_imgsz=WARMUP_IMGSZ)
+else:
+    dispatcher = MicroBatcher(model_pool.get, max_batch_size=INFERENCE_BATCH_SIZE, max_wait_ms=BATCH_WAIT_MS,
+                              max_queue_depth=BATCH_QUEUE_DEPTH)
+
+
+def run_folder_job(job: Job) -> dict:
+    """
+    Выполняет задачу инференса папки: срезы отправляются в микробатчер или пул процессов,
+    поток ждёт результатов.
+
+    Если в параметрах задан список images, обрабатываются только эти срезы папки
+    (часть исследования): итог по ним не считается и detections.json не пишется,
+    итог по всем частям сохраняет эндпоинт /summary/.
+
+    Args:
+        job (Job): Задача с параметрами folder_id, device и, для части исследования, images.
+
+    Returns:
+        dict: Итог исследования (None для части) и метрики с детекциями по каждому срезу.
+    """
+
+    folder_id, device = job.params["folder_id"], job.params["device"]
+    image_names = job.params.get("images")
+    logger.info(f"Задача {job.id}: инференс папки {folder_id} на {device}")
+    items = InferencePipeline.prepare_items(MEDIA_ROOT, folder_id)
+    if image_names:
+        # Срезы части в порядке запроса
+        order = {image_name: index for index, image_name in enumerate(image_names)}
+        items = sorted((item for item in items if item[1] in order), key=lambda item: order[item[1]])
+        missing = set(image_names) - {image_name for _, image_name, _ in items}
+        if missing:
+            raise FileNotFoundError(f"Срезы не найдены в папке {folder_id}: {', '.join(sorted(missing))}")
+    # Срезы попадают в общие батчи вместе со срезами параллельных запросов или в свободный процесс
+    job.slice_futures = dispatcher.submit(items, device=device)
+    if job.cancel_requested:
+        for future in job.slice_futures:
+            future.cancel()
+
+    images = []
+    for (_, image_name, _), future in zip(items, job.slice_futures):
+        images.append({"image": image_name, **future.result()})
+    # Все срезы папки лежат в одной папке predict
+    verdict = None if image_names else InferencePipeline.save_detections(items[0][2], images, MIN_TUMOR_SLICES)
+    return {"folder_id": folder_id, "device": device, "verdict": verdict, "images": images}
+
+
+def post_job_callback(job: Job) -> None:
+    """
+    Отправляет статус и результат завершённой задачи на её callback_url.
+
+    Args:
+        job (Job): Завершённая задача.
+    """
+
+    payload = json.dumps({"job_id": job.id, "status": job.status, "error": job.error,
+                          "result": job.result}).encode()
+    for attempt in range(CALLBACK_ATTEMPTS):
+        request = urllib.request.Request(job.callback_url, data=payload, method="POST",
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=CALLBACK_TIMEOUT):
+                logger.info(f"Задача {job.id}: результат отправлен на callback")
+                return
+        except (urllib.error.URLError, OSError) as e:
+            logger.warning(f"Задача {job.id}: callback не доставлен (попытка {attempt + 1}): {e}")
+            if attempt + 1 < CALLBACK_ATTEMPTS:
+                time.sleep(2 ** attempt)
+    logger.error(f"Задача {job.id}: callback не доставлен за {CALLBACK_ATTEMPTS} попыток")
+
+
+# Уведомления отправляются отдельными потоками, чтобы не занимать исполнителей задач
+callbacks = ThreadPoolExecutor(max_workers=2, thread_name_prefix="job-callback")
+
+
+def notify_job_finished(job: Job) -> None:
+    if job.callback_url:
+        callbacks.submit(post_job_callback, job)
+
+
+jobs = JobManager(run_folder_job, max_workers=JOB_WORKERS, max_queued=MAX_QUEUED_JOBS, ttl=JOB_TTL,
+                  on_finish=notify_job_finished)
+
+
+def decode_payload(data: bytes, name: str) -> list:
+    """
+    Декодирует переданные байты: упакованный массив срезов slices.npz или одно изображение.
+
+    Args:
+        data (bytes): Содержимое файла.
+        name (str): Имя изображения (для массива срезов имена берутся из slice_numbers).
+
+    Returns:
+        list: Пары (изображение BGR, имя изображения).
+    """
+
+    # .npz — это zip-архив
+    if data[:4] == b"PK\x03\x04":
+        return load_slice_stack(io.BytesIO(data))
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Не удалось декодировать изображение {name}")
+    return [(image, name)]
+
+
+def submit_job(folder_id: str, device: str, images: Optional[List[str]] = None,
+               callback_url: Optional[str] = None) -> Job:
+    """
+    Проверяет готовность модели и ставит задачу в очередь.
+
+    Raises:
+        HTTPException: 503, если модель не загружена или очередь заполнена.
+    """
+
+    try:
+        model_pool.get()
+        params = {"folder_id": folder_id, "device": device}
+        if images:
+            params["images"] = images
+        return jobs.submit(params, callback_url=callback_url)
+    except (RuntimeError, JobQueueFull) as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Загружает и прогревает модель при старте сервера и останавливает перезагрузку при выходе.
+    """
+
+    model_pool.start()
+    dispatcher.start()
+    yield
+    jobs.shutdown()
+    callbacks.shutdown(wait=True)
+    dispatcher.stop()
+    model_pool.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/")
@@ -28,10 +242,37 @@ async def root():
     return {"status": "YOLO inference server is up and running!"}
 
 
+@app.get("/ready")
+async def ready():
+    """
+    Эндпоинт готовности: модель загружена и прогрета.
+
+    Returns:
+        JSONResponse: Состояние модели, 503 пока модель не готова.
+    """
+
+    status = model_pool.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Эндпоинт метрик микробатчинга или пула процессов.
+
+    Returns:
+        dict: Настройки батчера или пула, глубина очереди и счётчики.
+    """
+
+    key = "workers" if INFERENCE_WORKERS > 0 else "batching"
+    return {key: dispatcher.metrics(), "jobs": jobs.stats()}
+
+
 @app.post("/inference/")
 async def run_inference(
     folder_id: str = Query(..., description="ID папки (например, '007')"),
-    device: str = Query("cpu", description="Устройство для инференса: 'cpu' или 'cuda'")
+    device: str = Query("cpu", description="Устройство для инференса: 'cpu' или 'cuda'"),
+    images: Optional[List[str]] = Query(None, description="Имена срезов части исследования (по умолчанию все)")
 ):
     """
     Эндпоинт для запуска инференса YOLO на заданной папке с изображениями.
@@ -39,32 +280,228 @@ async def run_inference(
     Args:
         folder_id (str): ID папки с изображениями.
         device (str): Устройство для инференса ('cpu' или 'cuda').
+        images (Optional[List[str]]): Имена срезов, если обрабатывается часть исследования.
 
     Returns:
-        dict: Статус инференса.
+        dict: Статус инференса, итог исследования и детекции по срезам.
     """
 
     logger.info(f"Запрос инференса для папки {folder_id} на {device}")
+    job = submit_job(folder_id, device, images)
+
+    try:
+        result = await asyncio.wrap_future(job.future)
+        return {"status": "ok", **result}
+    except BatchTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except BatcherOverloaded as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except CancelledError:
+        raise HTTPException(status_code=409, detail=f"Задача {job.id} отменена")
+    except Exception as e:
+        logger.error(f"Ошибка инференса: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/summary/")
+async def summary(
+    request: Request,
+    folder_id: str = Query(..., description="ID папки (например, '007')")
+):
+    """
+    Сохраняет итог исследования по детекциям всех его частей.
+
+    Тело запроса — JSON {"images": [{"image": ..., "detections": [...]}, ...]} с
+    результатами частей /inference/ в порядке срезов.
+
+    Returns:
+        dict: Итог исследования, записанный в detections.json папки predict.
+    """
+
+    predict_dir = os.path.join(MEDIA_ROOT, folder_id, "predict")
+    if not os.path.isdir(predict_dir):
+        raise HTTPException(status_code=404, detail=f"Папка {predict_dir} не найдена")
+
+    try:
+        images = (await request.json())["images"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Ожидался JSON с полем images")
+
+    verdict = await run_in_threadpool(InferencePipeline.save_detections, predict_dir, images, MIN_TUMOR_SLICES)
+    return {"folder_id": folder_id, "verdict": verdict}
+
+
+def limit_body(request: Request) -> Request:
+    """
+    Оборачивает запрос так, что чтение тела обрывается с 413, как только
+    принято больше MAX_PAYLOAD_BYTES байт (в том числе для chunked-тела без
+    Content-Length).
+
+    Args:
+        request (Request): Исходный запрос.
+
+    Returns:
+        Request: Запрос с ограниченным чтением тела.
+    """
 
-    if not os.path.exists(BEST_MODEL_PATH):
-        raise HTTPException(status_code=500, detail="best_model.txt не найден. Сначала обучите модель.")
+    received = 0
 
-    with open(BEST_MODEL_PATH, "r") as f:
-        best_model = f.read().strip()
+    async def receive():
+        nonlocal received
+        message = await request.receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > MAX_PAYLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=f"Тело запроса больше {MAX_PAYLOAD_BYTES} байт")
+        return message
 
-    # Проверка, что best_model содержит путь и файл существует
-    if not best_model or not os.path.exists(best_model):
-        raise HTTPException(status_code=500, detail=f"Файл лучшей модели '{best_model}' не найден или best_model.txt пуст. Проверьте путь и существование файла.")
+    return Request(request.scope, receive)
+
+
+@app.post("/predict/")
+async def predict(
+    request: Request,
+    device: str = Query("cpu", description="Устройство для инференса: 'cpu' или 'cuda'"),
+    annotate: bool = Query(False, description="Вернуть визуализации лучшего бокса в base64"),
+    name: str = Query("0.png", description="Имя изображения, если тело запроса — одно изображение")
+):
+    """
+    Инференс по байтам из тела запроса, без общей папки media.
+
+    Принимает multipart/form-data с одним или несколькими файлами (PNG/JPEG или
+    slices.npz) либо одно изображение или slices.npz прямо в теле запроса.
+
+    Returns:
+        dict: Итог по всем изображениям запроса, детекции и метрики по каждому,
+            при annotate — визуализации.
+    """
+
+    content_length = request.headers.get("content-length")
+    if content_length and not content_length.isdigit():
+        raise HTTPException(status_code=400, detail="Некорректный заголовок Content-Length")
+    if content_length and int(content_length) > MAX_PAYLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Тело запроса больше {MAX_PAYLOAD_BYTES} байт")
+    # Заголовок может отсутствовать (chunked) или не совпадать с телом: лимит проверяется и при чтении
+    request = limit_body(request)
 
     try:
-        # Вызываем статический метод с корректными параметрами
-        InferencePipeline.run_inference(
-            best_model=best_model,
-            media_root=MEDIA_ROOT,
-            single_folder_id=folder_id,
-            device=device 
-        )
-        return {"status": "ok", "folder_id": folder_id, "device": device}
+        model_pool.get()
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        # Части multipart читаются потоком во временные файлы
+        form = await request.form()
+        uploads = [(await value.read(), value.filename or key)
+                   for key, value in form.multi_items() if isinstance(value, UploadFile)]
+        await form.close()
+    else:
+        uploads = [(await request.body(), name)]
+
+    if not uploads or not any(data for data, _ in uploads):
+        raise HTTPException(status_code=400, detail="Пустое тело запроса")
+
+    try:
+        images = []
+        for data, upload_name in uploads:
+            images.extend(await run_in_threadpool(decode_payload, data, upload_name))
+        futures = dispatcher.submit([(image, image_name, None) for image, image_name in images],
+                                 device=device, return_annotations=annotate)
+    except BatchTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except BatcherOverloaded as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    try:
+        results = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
     except Exception as e:
         logger.error(f"Ошибка инференса: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+    response = []
+    for (_, image_name), metrics in zip(images, results):
+        if annotate:
+            annotated = metrics.pop("annotated")
+            metrics["annotated"] = base64.b64encode(annotated).decode("ascii") if annotated else None
+        response.append({"image": image_name, **metrics})
+    return {"device": device, "annotation_format": ANNOTATION_FORMAT if annotate else None,
+            "verdict": summarize_study(response, MIN_TUMOR_SLICES), "images": response}
+
+
+@app.post("/jobs/", status_code=202)
+async def create_job(
+    folder_id: str = Query(..., description="ID папки (например, '007')"),
+    device: str = Query("cpu", description="Устройство для инференса: 'cpu' или 'cuda'"),
+    images: Optional[List[str]] = Query(None, description="Имена срезов части исследования (по умолчанию все)"),
+    callback_url: Optional[str] = Query(None, description="Адрес для POST с результатом после завершения")
+):
+    """
+    Ставит инференс папки в очередь и сразу возвращает идентификатор задачи.
+
+    Если задан callback_url, после завершения задачи (с любым статусом) на него
+    отправляется POST с JSON {"job_id", "status", "error", "result"}, и опрашивать
+    статус задачи не нужно.
+
+    Args:
+        folder_id (str): ID папки с изображениями.
+        device (str): Устройство для инференса ('cpu' или 'cuda').
+        images (Optional[List[str]]): Имена срезов, если обрабатывается часть исследования.
+        callback_url (Optional[str]): Адрес для уведомления о завершении.
+
+    Returns:
+        dict: Идентификатор и статус задачи.
+    """
+
+    job = submit_job(folder_id, device, images, callback_url)
+    return {"job_id": job.id, "status": job.status}
+
+
+def get_job_or_404(job_id: str) -> Job:
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Задача {job_id} не найдена")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """
+    Статус задачи инференса.
+
+    Returns:
+        dict: Статус, параметры и времена задачи.
+    """
+
+    return get_job_or_404(job_id).to_dict()
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    """
+    Результат задачи инференса.
+
+    Returns:
+        dict: Метрики по срезам; 409, пока задача не завершена успешно.
+    """
+
+    job = get_job_or_404(job_id)
+    if job.status != DONE:
+        raise HTTPException(status_code=409, detail=job.to_dict())
+    return {"job_id": job.id, "status": job.status, "result": job.result}
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """
+    Отменяет задачу: ожидающая снимается с очереди, у выполняемой отменяются необработанные срезы.
+
+    Returns:
+        dict: Статус задачи после отмены.
+    """
+
+    job = get_job_or_404(job_id)
+    if job.status in FINISHED_STATUSES:
+        return job.to_dict()
+    return jobs.cancel(job_id).to_dict()
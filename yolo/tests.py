@@ -0,0 +1,250 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+from batching import BatchTooLarge, MicroBatcher
+from jobs import CANCELLED, DONE, FAILED, JobManager, JobQueueFull
+from model_pool import ModelPool
+from workers import WorkerPool
+from yolo_train_compare import BACKEND_PYTORCH, check_backend_parity, compare_detections
+
+
+class FakeEvaluator:
+    """
+    Оценщик без модели: срез "bad" не декодируется и роняет весь батч.
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def evaluate_batch(self, items, device="cpu", return_annotations=False):
+        images = [image for image, _, _ in items]
+        self.batches.append(images)
+        if "bad" in images:
+            raise ValueError("Не удалось декодировать срез")
+        return [{"image": image} for image in images]
+
+
+class ForkedEvaluator:
+    """
+    Оценщик для пула процессов: срез "die" завершает процесс-воркер.
+    """
+
+    backend = BACKEND_PYTORCH
+    model_path = "fake.pt"
+
+    def predict(self, image, **kwargs):
+        return []
+
+    def evaluate_batch(self, items, device="cpu", return_annotations=False):
+        if any(image == "die" for image, _, _ in items):
+            os._exit(1)
+        return [{"image": image} for image, _, _ in items]
+
+
+class MicroBatcherTest(unittest.TestCase):
+    """
+    Тесты микробатчера.
+    """
+
+    def setUp(self):
+        self.evaluator = FakeEvaluator()
+        self.batcher = MicroBatcher(lambda: self.evaluator, max_batch_size=8, max_wait_ms=50, max_queue_depth=4)
+        self.batcher.start()
+        self.addCleanup(self.batcher.stop)
+
+    def test_bad_slice_fails_only_its_own_request(self):
+        """
+        Проверяет, что нечитаемый срез не роняет срезы других запросов из того же батча.
+        """
+        good = self.batcher.submit([("a", "a.png", None), ("b", "b.png", None)])
+        bad = self.batcher.submit([("bad", "bad.png", None)])
+
+        self.assertEqual([future.result(5) for future in good], [{"image": "a"}, {"image": "b"}])
+        with self.assertRaises(ValueError):
+            bad[0].result(5)
+        self.assertEqual(self.evaluator.batches[0], ["a", "b", "bad"])
+
+    def test_unavailable_model_fails_batch_and_keeps_batcher_running(self):
+        """
+        Проверяет, что ошибка получения модели отклоняет текущий батч, а следующие запросы обрабатываются.
+        """
+        self.batcher.get_evaluator = mock.Mock(side_effect=[RuntimeError("Модель не загружена"), self.evaluator])
+
+        failed = self.batcher.submit([("a", "a.png", None)])
+        with self.assertRaises(RuntimeError):
+            failed[0].result(5)
+        self.assertEqual(self.batcher.submit([("b", "b.png", None)])[0].result(5), {"image": "b"})
+        self.assertEqual(self.batcher.metrics()["errors_total"], 1)
+
+    def test_request_larger_than_queue_is_rejected(self):
+        """
+        Проверяет, что запрос больше всей очереди отклоняется сразу, а не как временная перегрузка.
+        """
+        with self.assertRaises(BatchTooLarge):
+            self.batcher.submit([(str(i), f"{i}.png", None) for i in range(5)])
+        self.assertEqual(self.batcher.metrics()["queue_depth"], 0)
+
+
+class WorkerPoolTest(unittest.TestCase):
+    """
+    Тесты пула процессов инференса.
+    """
+
+    def setUp(self):
+        evaluator = ForkedEvaluator()
+        self.pool = WorkerPool(lambda: evaluator, workers=1, threads_per_worker=1, max_queue_depth=4,
+                               warmup_imgsz=8)
+        self.addCleanup(self.pool.stop)
+
+    def test_pool_is_rebuilt_after_worker_dies(self):
+        """
+        Проверяет, что гибель воркера роняет только его исследование, а следующие обрабатываются новым пулом.
+        """
+        self.pool.start()
+        with self.assertRaises(BrokenProcessPool):
+            self.pool.submit([("die", "die.png", None)])[0].result(30)
+
+        futures = self.pool.submit([("a", "a.png", None)])
+        self.assertEqual(futures[0].result(30), {"image": "a"})
+        metrics = self.pool.metrics()
+        self.assertEqual(metrics["restarts_total"], 1)
+        self.assertEqual(metrics["queue_depth"], 0)
+
+    def test_failed_submit_releases_reserved_slots(self):
+        """
+        Проверяет, что ошибка постановки исследования не оставляет занятые места в очереди.
+        """
+        with mock.patch.object(self.pool, "_current_executor", side_effect=RuntimeError("fork failed")):
+            with self.assertRaises(RuntimeError):
+                self.pool.submit([("a", "a.png", None), ("b", "b.png", None)])
+        self.assertEqual(self.pool.metrics()["queue_depth"], 0)
+
+
+class JobManagerTest(unittest.TestCase):
+    """
+    Тесты очереди задач инференса.
+    """
+
+    def setUp(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.finished = []
+        self.manager = JobManager(self.run_job, max_workers=1, max_queued=1, on_finish=self.finished.append)
+        self.addCleanup(self.manager.shutdown)
+        self.addCleanup(self.release.set)
+
+    def run_job(self, job):
+        if job.params.get("fail"):
+            raise ValueError("Папка не найдена")
+        self.started.set()
+        self.release.wait(5)
+        return {"folder": job.params["folder"]}
+
+    def test_full_queue_rejects_and_queued_job_can_be_cancelled(self):
+        """
+        Проверяет отказ при заполненной очереди и отмену ожидающей задачи с уведомлением о завершении.
+        """
+        running = self.manager.submit({"folder": "a"})
+        self.assertTrue(self.started.wait(5))
+        queued = self.manager.submit({"folder": "b"})
+        with self.assertRaises(JobQueueFull):
+            self.manager.submit({"folder": "c"})
+
+        self.assertEqual(self.manager.cancel(queued.id).status, CANCELLED)
+        self.assertEqual(self.finished, [queued])
+        self.release.set()
+        self.assertEqual(running.future.result(5), {"folder": "a"})
+        self.assertEqual(running.status, DONE)
+
+    def test_failed_job_is_reported(self):
+        """
+        Проверяет, что упавшая задача получает статус failed с текстом ошибки и передаётся в on_finish.
+        """
+        job = self.manager.submit({"folder": "a", "fail": True})
+        with self.assertRaises(ValueError):
+            job.future.result(5)
+        self.assertEqual((job.status, job.error), (FAILED, "Папка не найдена"))
+        self.assertEqual(self.finished, [job])
+
+
+class ModelPoolTest(unittest.TestCase):
+    """
+    Тесты горячей перезагрузки модели.
+    """
+
+    def test_broken_weights_are_not_reloaded_until_they_change(self):
+        """
+        Проверяет, что веса, которые не удалось загрузить, не загружаются на каждой проверке,
+        а после изменения файла загружаются снова.
+        """
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        weights = os.path.join(folder.name, "best.pt")
+        config = os.path.join(folder.name, "best_model.txt")
+        with open(weights, "wb") as f:
+            f.write(b"broken")
+        with open(config, "w") as f:
+            f.write(weights)
+        pool = ModelPool(config, reload_interval=0, warmup_imgsz=8)
+
+        with mock.patch("model_pool.ModelEvaluator", side_effect=RuntimeError("Повреждённые веса")) as evaluator:
+            self.assertFalse(pool.load())
+            self.assertFalse(pool.load())
+            self.assertEqual(evaluator.call_count, 1)
+            self.assertEqual(pool.status()["error"], "Повреждённые веса")
+
+            os.utime(weights, (1, 1))
+            self.assertFalse(pool.load())
+        self.assertEqual(evaluator.call_count, 2)
+
+
+class PayloadLimitTest(unittest.TestCase):
+    """
+    Тесты ограничения размера тела запроса.
+    """
+
+    def test_chunked_body_over_limit_is_rejected_while_reading(self):
+        """
+        Проверяет, что тело без Content-Length обрывается с 413, как только превышен лимит.
+        """
+        messages = [{"type": "http.request", "body": b"x" * 600, "more_body": True}] * 3
+
+        async def receive():
+            return messages.pop(0)
+
+        request = server.limit_body(Request({"type": "http", "method": "POST", "headers": []}, receive))
+        with mock.patch.object(server, "MAX_PAYLOAD_BYTES", 1000), \
+                self.assertRaises(HTTPException) as rejected:
+            asyncio.run(request.body())
+        self.assertEqual(rejected.exception.status_code, 413)
+        self.assertEqual(len(messages), 1)
+
+
+class ParityGateTest(unittest.TestCase):
+    """
+    Тесты проверки паритета бэкендов.
+    """
+
+    def test_empty_validation_set_does_not_pass(self):
+        """
+        Проверяет, что без проверочных изображений проверка паритета не считается пройденной.
+        """
+        evaluator = mock.Mock()
+        with self.assertRaises(ValueError):
+            check_backend_parity("best.pt", "onnx", [], reference=evaluator, candidate=evaluator)
+        with self.assertRaises(ValueError):
+            compare_detections(evaluator, evaluator, [])
+        evaluator.predict.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,276 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+from batching import BatcherOverloaded, BatchTooLarge
+from yolo_train_compare import BACKEND_PYTORCH, ModelEvaluator
+
+
+logger = logging.getLogger(__name__)
+
+# Модель, загруженная в родителе до fork: воркеры получают её веса копированием при записи
+_PARENT_EVALUATOR: Optional[ModelEvaluator] = None
+# Модель воркера (унаследованная или загруженная в самом воркере)
+_WORKER_EVALUATOR: Optional[ModelEvaluator] = None
+
+
+def _init_worker(num_threads: int, evaluator_args: Optional[Dict[str, Any]], warmup_imgsz: int) -> None:
+    """
+    Инициализирует процесс-воркер: фиксирует число потоков torch и прогревает модель.
+
+    Args:
+        num_threads (int): Потоков torch на воркер.
+        evaluator_args (Optional[Dict[str, Any]]): Аргументы ModelEvaluator, если модель
+            нужно загрузить в самом воркере (экспортированные бэкенды), иначе используется
+            модель родителя.
+        warmup_imgsz (int): Размер фиктивного изображения для прогрева.
+    """
+
+    global _WORKER_EVALUATOR
+    torch.set_num_threads(num_threads)
+    _WORKER_EVALUATOR = ModelEvaluator(**evaluator_args) if evaluator_args else _PARENT_EVALUATOR
+    _WORKER_EVALUATOR.predict(np.zeros((warmup_imgsz, warmup_imgsz, 3), dtype=np.uint8), verbose=False)
+    logger.info(f"Воркер {os.getpid()} готов: {num_threads} потоков torch")
+
+
+def _worker_ping() -> int:
+    return os.getpid()
+
+
+def _run_study(items: List[Tuple[Union[str, np.ndarray], str, Optional[str]]], device: str,
+               return_annotations: bool, batch_size: int) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    Прогоняет срезы исследования через модель воркера батчами.
+
+    Returns:
+        Tuple[int, List[Dict[str, Any]]]: PID воркера и метрики по каждому срезу.
+    """
+
+    results = []
+    for start in range(0, len(items), batch_size):
+        results.extend(_WORKER_EVALUATOR.evaluate_batch(items[start:start + batch_size], device=device,
+                                                        return_annotations=return_annotations))
+    return os.getpid(), results
+
+
+class WorkerPool:
+    """
+    Пул процессов инференса с фиксированным числом потоков torch в каждом.
+
+    Модель PyTorch загружается в родителе, воркеры создаются через fork и
+    делят её веса копированием при записи. Экспортированные модели (ONNX,
+    TorchScript) не переживают fork, поэтому воркеры загружают их сами.
+    Исследования раздаются через общую очередь ProcessPoolExecutor: каждое
+    забирает первый освободившийся воркер. При горячей перезагрузке модели
+    пул пересоздаётся, начатые исследования дорабатывают в старых воркерах.
+    Если воркер погиб (OOM, сигнал), ProcessPoolExecutor становится
+    непригодным: исследования в нём завершаются с BrokenProcessPool, а пул
+    пересоздаётся для следующих.
+
+    Интерфейс submit совпадает с MicroBatcher, поэтому сервер использует
+    пул и батчер одинаково.
+
+    Args:
+        get_evaluator (Callable[[], ModelEvaluator]): Возвращает текущую модель (ModelPool.get).
+        workers (int): Количество процессов.
+        threads_per_worker (int): Потоков torch на процесс.
+        batch_size (int): Размер батча внутри воркера.
+        max_queue_depth (int): Максимальное количество срезов в обработке.
+        warmup_imgsz (int): Размер фиктивного изображения для прогрева воркеров.
+    """
+
+    def __init__(self, get_evaluator: Callable[[], ModelEvaluator], workers: int, threads_per_worker: int,
+                 batch_size: int = 16, max_queue_depth: int = 1024, warmup_imgsz: int = 640):
+        self.get_evaluator = get_evaluator
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.batch_size = max(1, batch_size)
+        self.max_queue_depth = max_queue_depth
+        self.warmup_imgsz = warmup_imgsz
+
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._evaluator: Optional[ModelEvaluator] = None
+        self._pending_items = 0
+        self._counters = {
+            "studies_total": 0,
+            "items_total": 0,
+            "rejected_total": 0,
+            "errors_total": 0,
+            "restarts_total": 0,
+            "study_ms_total": 0.0,
+        }
+        self._studies_per_worker: Dict[int, int] = {}
+
+    def _current_executor(self) -> ProcessPoolExecutor:
+        """
+        Возвращает пул для текущей модели, пересоздавая его после горячей перезагрузки.
+        """
+
+        global _PARENT_EVALUATOR
+        evaluator = self.get_evaluator()
+        with self._lock:
+            if self._executor is not None and evaluator is self._evaluator:
+                return self._executor
+
+            old_executor = self._executor
+            evaluator_args = None
+            if evaluator.backend != BACKEND_PYTORCH:
+                evaluator_args = {"model_path": evaluator.model_path, "backend": evaluator.backend,
+                                  "precision": evaluator.precision, "imgsz": evaluator.imgsz,
+                                  "annotation_format": evaluator.annotation_format,
+                                  "annotation_quality": evaluator.annotation_quality}
+            _PARENT_EVALUATOR = evaluator
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("fork"),
+                initializer=_init_worker, initargs=(self.threads_per_worker, evaluator_args, self.warmup_imgsz))
+            self._evaluator = evaluator
+            if old_executor is not None:
+                self._counters["restarts_total"] += 1
+                old_executor.shutdown(wait=False)
+
+        logger.info(f"Пул воркеров: {self.workers} процессов по {self.threads_per_worker} потоков torch, "
+                    f"модель {evaluator.model_path} ({evaluator.backend})")
+        return self._executor
+
+    def _discard_executor(self, executor: ProcessPoolExecutor) -> None:
+        """
+        Убирает сломанный пул, чтобы следующее исследование создало новый.
+
+        Args:
+            executor (ProcessPoolExecutor): Пул, в котором погиб воркер.
+        """
+
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self._counters["restarts_total"] += 1
+        logger.warning("Воркер пула погиб, пул процессов будет пересоздан")
+        executor.shutdown(wait=False)
+
+    def start(self) -> None:
+        """
+        Создаёт процессы заранее, чтобы первый запрос не ждал fork и прогрева.
+        """
+
+        # Родитель сам не считает: без пула потоков OpenMP fork безопасен
+        torch.set_num_threads(1)
+        executor = self._current_executor()
+        pids = {future.result() for future in [executor.submit(_worker_ping) for _ in range(self.workers)]}
+        logger.info(f"Воркеры запущены: {sorted(pids)}")
+
+    def submit(self, items: List[Tuple[Union[str, np.ndarray], str, Optional[str]]],
+               device: str = "cpu", return_annotations: bool = False) -> List[Future]:
+        """
+        Отправляет срезы исследования в свободный воркер.
+
+        Args:
+            items (List[Tuple[Union[str, np.ndarray], str, Optional[str]]]): Тройки
+                (путь или изображение, имя изображения, директория для визуализаций).
+            device (str): Устройство для инференса.
+            return_annotations (bool): Вернуть закодированные визуализации вместе с метриками.
+
+        Returns:
+            List[Future]: Future с метриками для каждого среза; отмена всех срезов
+                снимает исследование с очереди, если оно ещё не начато.
+        """
+
+        if len(items) > self.max_queue_depth:
+            raise BatchTooLarge(f"В исследовании {len(items)} срезов, очередь вмещает {self.max_queue_depth}")
+
+        with self._lock:
+            if self._pending_items + len(items) > self.max_queue_depth:
+                self._counters["rejected_total"] += 1
+                raise BatcherOverloaded(f"Очередь воркеров заполнена: {self._pending_items} срезов "
+                                        f"из {self.max_queue_depth}")
+            self._pending_items += len(items)
+
+        started = time.monotonic()
+        try:
+            executor = self._current_executor()
+            try:
+                study = executor.submit(_run_study, items, device, return_annotations, self.batch_size)
+            except BrokenProcessPool:
+                self._discard_executor(executor)
+                executor = self._current_executor()
+                study = executor.submit(_run_study, items, device, return_annotations, self.batch_size)
+        except Exception:
+            with self._lock:
+                self._pending_items -= len(items)
+            raise
+        futures = [Future() for _ in items]
+
+        def on_item_done(future: Future) -> None:
+            if future.cancelled() and all(item.cancelled() for item in futures):
+                study.cancel()
+
+        def on_study_done(done: Future) -> None:
+            with self._lock:
+                self._pending_items -= len(items)
+                if not done.cancelled() and done.exception() is None:
+                    pid, _ = done.result()
+                    self._counters["studies_total"] += 1
+                    self._counters["items_total"] += len(items)
+                    self._counters["study_ms_total"] += (time.monotonic() - started) * 1000
+                    self._studies_per_worker[pid] = self._studies_per_worker.get(pid, 0) + 1
+                elif not done.cancelled():
+                    self._counters["errors_total"] += 1
+
+            if not done.cancelled() and isinstance(done.exception(), BrokenProcessPool):
+                self._discard_executor(executor)
+
+            results = None if done.cancelled() or done.exception() else done.result()[1]
+            for index, future in enumerate(futures):
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if done.cancelled():
+                    future.cancel()
+                elif results is None:
+                    future.set_exception(done.exception())
+                else:
+                    future.set_result(results[index])
+
+        for future in futures:
+            future.add_done_callback(on_item_done)
+        study.add_done_callback(on_study_done)
+        return futures
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Настройки и счётчики пула для эндпоинта метрик.
+        """
+
+        with self._lock:
+            counters = dict(self._counters)
+            per_worker = dict(self._studies_per_worker)
+            pending = self._pending_items
+
+        return {
+            "workers": self.workers,
+            "threads_per_worker": self.threads_per_worker,
+            "batch_size": self.batch_size,
+            "max_queue_depth": self.max_queue_depth,
+            "queue_depth": pending,
+            **counters,
+            "avg_study_ms": round(counters["study_ms_total"] / (counters["studies_total"] or 1), 1),
+            "studies_per_worker": per_worker,
+        }
+
+    def stop(self) -> None:
+        """
+        Дожидается начатых исследований и останавливает процессы.
+        """
+
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -1,13 +1,16 @@
 import argparse
 import glob
+import json
 import logging
 import os
+import shutil
+import tempfile
+import time
 from dataclasses import dataclass
-from typing import Optional, Tuple, Dict, Any
+from typing import IO, Optional, Tuple, Dict, Any, List, Union
 
-import matplotlib
-matplotlib.use('Agg') 
-import matplotlib.pyplot as plt
+import cv2
+import numpy as np
 import pandas as pd
 import torch
 from ultralytics import YOLO
@@ -18,6 +21,130 @@ from ultralytics.engine.results import Results
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Массив срезов, который сохраняет конвертация в режиме NII_HANDOFF="array"
+STACK_FILENAME = "slices.npz"
+
+# Форматы визуализаций предсказаний: расширение и параметр качества cv2.imwrite
+ANNOTATION_FORMATS = {
+    "png": (".png", cv2.IMWRITE_PNG_COMPRESSION),
+    "jpeg": (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+# Качество по умолчанию: уровень сжатия 0-9 для PNG, качество 0-100 для JPEG и WebP
+DEFAULT_ANNOTATION_QUALITY = {"png": 3, "jpeg": 90, "webp": 90}
+
+TUMOR_CLASSES = ['Glioma', 'Meningioma', 'Pituitary']
+# Итог исследования, если ни на одном срезе лучший бокс не относится к опухоли
+NO_TUMOR = "No tumor"
+# Детекции по срезам и итог исследования, сохраняются в папке predict рядом с визуализациями
+DETECTIONS_FILENAME = "detections.json"
+
+# Бэкенды инференса: исходные веса в PyTorch или экспорт ultralytics (расширение артефакта)
+BACKEND_PYTORCH = "pytorch"
+EXPORT_BACKENDS = {"onnx": ".onnx", "torchscript": ".torchscript"}
+
+# Точность инференса на CPU: исходная, bfloat16 (autocast PyTorch) и динамический INT8 (ONNX Runtime)
+PRECISION_FP32 = "fp32"
+PRECISION_BF16 = "bf16"
+PRECISION_INT8 = "int8"
+PRECISIONS = (PRECISION_FP32, PRECISION_BF16, PRECISION_INT8)
+
+
+def load_slice_stack(stack_path: Union[str, IO[bytes]]) -> List[Tuple[np.ndarray, str]]:
+    """
+    Загружает массив срезов и превращает его в изображения для модели.
+
+    Args:
+        stack_path (Union[str, IO[bytes]]): Путь к файлу slices.npz или открытый файл
+            (массивы "slices" и "slice_numbers").
+
+    Returns:
+        List[Tuple[np.ndarray, str]]: Пары (трёхканальное изображение uint8, имя среза "<номер>.png").
+    """
+
+    with np.load(stack_path) as data:
+        slices = data["slices"]
+        slice_numbers = data["slice_numbers"]
+
+    # Модель обучена на трёхканальных изображениях, как при чтении серых PNG через cv2
+    return [(np.repeat(pixels[..., None], 3, axis=2), f"{int(number)}.png")
+            for pixels, number in zip(slices, slice_numbers)]
+
+
+def export_model(model_path: str, backend: str, imgsz: int = 640) -> str:
+    """
+    Экспортирует веса в формат бэкенда один раз и кэширует артефакт рядом с весами.
+
+    Артефакт переэкспортируется, если он старше файла весов. Экспорт идёт во
+    временную папку и переносится на место атомарно, чтобы параллельные
+    процессы не прочитали недописанный файл.
+
+    Args:
+        model_path (str): Путь к весам PyTorch (.pt).
+        backend (str): "onnx" или "torchscript".
+        imgsz (int): Размер входа модели (по умолчанию 640).
+
+    Returns:
+        str: Путь к экспортированной модели.
+    """
+
+    if backend not in EXPORT_BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд экспорта: {backend}")
+
+    artifact = os.path.splitext(model_path)[0] + EXPORT_BACKENDS[backend]
+    if os.path.exists(artifact) and os.path.getmtime(artifact) >= os.path.getmtime(model_path):
+        return artifact
+
+    logger.info(f"Экспорт {model_path} в {backend}")
+    tmp_dir = tempfile.mkdtemp(prefix=".export-", dir=os.path.dirname(os.path.abspath(model_path)))
+    try:
+        tmp_weights = os.path.join(tmp_dir, os.path.basename(model_path))
+        shutil.copy2(model_path, tmp_weights)
+        # dynamic=True для ONNX: переменный размер батча при пакетном инференсе
+        exported = YOLO(tmp_weights).export(format=backend, imgsz=imgsz, dynamic=backend == "onnx", device="cpu")
+        os.replace(exported, artifact)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    logger.info(f"Экспортировано: {artifact}")
+    return artifact
+
+
+def quantize_model(model_path: str, imgsz: int = 640) -> str:
+    """
+    Готовит динамически квантованную INT8 модель ONNX и кэширует её рядом с весами.
+
+    Веса свёрток и линейных слоёв хранятся в uint8, активации квантуются на
+    лету в ONNX Runtime. Метаданные ultralytics (классы, stride, imgsz)
+    сохраняются.
+
+    Args:
+        model_path (str): Путь к весам PyTorch (.pt).
+        imgsz (int): Размер входа модели (по умолчанию 640).
+
+    Returns:
+        str: Путь к квантованной модели (<веса>.int8.onnx).
+    """
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    onnx_path = export_model(model_path, "onnx", imgsz)
+    artifact = os.path.splitext(model_path)[0] + ".int8.onnx"
+    if os.path.exists(artifact) and os.path.getmtime(artifact) >= os.path.getmtime(onnx_path):
+        return artifact
+
+    logger.info(f"Квантование {onnx_path} в INT8")
+    tmp_path = f"{artifact}.{os.getpid()}.tmp"
+    try:
+        quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QUInt8)
+        os.replace(tmp_path, artifact)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    logger.info(f"Квантовано: {artifact}")
+    return artifact
+
 
 @dataclass
 class ModelConfig:
@@ -118,62 +245,200 @@ class ModelEvaluator:
 
     Args:
         model_path (str): Путь к файлу модели.
+        annotation_format (str): Формат визуализаций: "png", "jpeg" или "webp" (по умолчанию "png").
+        annotation_quality (Optional[int]): Уровень сжатия PNG (0-9) или качество JPEG/WebP (0-100).
+        backend (str): Бэкенд инференса: "pytorch", "onnx" или "torchscript" (по умолчанию "pytorch").
+        imgsz (int): Размер входа экспортированной модели (по умолчанию 640).
+        precision (str): Точность: "fp32", "bf16" (только PyTorch) или "int8" (квантованная
+            модель ONNX, бэкенд выбирается автоматически). По умолчанию "fp32".
     """
 
-    def __init__(self, model_path: str):
+    def __init__(self, model_path: str, annotation_format: str = "png", annotation_quality: Optional[int] = None,
+                 backend: str = BACKEND_PYTORCH, imgsz: int = 640, precision: str = PRECISION_FP32):
+        if annotation_format not in ANNOTATION_FORMATS:
+            raise ValueError(f"Неизвестный формат визуализаций: {annotation_format}")
+        self.annotation_format = annotation_format
+        self.annotation_quality = (DEFAULT_ANNOTATION_QUALITY[annotation_format]
+                                   if annotation_quality is None else annotation_quality)
+        if precision not in PRECISIONS:
+            raise ValueError(f"Неизвестная точность: {precision}")
+        if precision == PRECISION_BF16 and backend != BACKEND_PYTORCH:
+            raise ValueError("bf16 поддерживается только бэкендом pytorch")
+
         # Инициализируем модель только один раз при создании экземпляра
-        self.model = YOLO(model_path).to('cpu')
+        self.model_path = model_path
+        self.precision = precision
+        self.imgsz = imgsz
+        self.backend = "onnx" if precision == PRECISION_INT8 else backend
+        if precision == PRECISION_INT8:
+            self.model = YOLO(quantize_model(model_path, imgsz), task="detect")
+        elif backend == BACKEND_PYTORCH:
+            self.model = YOLO(model_path).to('cpu')
+        else:
+            self.model = YOLO(export_model(model_path, backend, imgsz), task="detect")
+
+    def predict(self, source: Any, **kwargs) -> List[Results]:
+        """
+        Вызывает модель с учётом выбранной точности.
+
+        Args:
+            source (Any): Путь, изображение или список изображений.
+            **kwargs: Аргументы предсказания ultralytics.
+
+        Returns:
+            List[Results]: Результаты модели.
+        """
+
+        if self.precision == PRECISION_BF16:
+            # Свёртки и матричные умножения считаются в bfloat16, постобработка — во float32
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16):
+                return self.model(source, **kwargs)
+        return self.model(source, **kwargs)
 
-    def evaluate(self, test_image_path: str, save_vis_dir: Optional[str] = None, prefix: str = "", device: str = "cpu") -> Dict[str, Any]:
+    def evaluate(self, test_image_path: Union[str, np.ndarray], save_vis_dir: Optional[str] = None, prefix: str = "",
+                 device: str = "cpu", image_name: Optional[str] = None) -> Dict[str, Any]:
         """
         Оценивает модель на тестовом изображении и сохраняет визуализацию предсказаний.
 
         Args:
-            test_image_path (str): Путь к тестовому изображению.
+            test_image_path (Union[str, np.ndarray]): Путь к тестовому изображению или само изображение.
             save_vis_dir (Optional[str]): Путь к директории для сохранения визуализаций.
             prefix (str): Префикс для имен файлов сохраненных визуализаций.
             device (str): Устройство для оценки (по умолчанию "cpu").
+            image_name (Optional[str]): Имя изображения для файлов визуализаций
+                (по умолчанию имя файла test_image_path).
 
         Returns:
             Dict[str, Any]: Метрики оценки модели.
         """
 
         try:
-            results = self.model(test_image_path, device=device) 
-            metrics = {}
-            no_tumor_data = None
+            image_name = image_name or os.path.basename(test_image_path)
+            results = self.predict(test_image_path, device=device)
+            return self._postprocess(results, image_name, save_vis_dir, prefix)
 
-            for idx, result in enumerate(results):
-                if hasattr(result, 'boxes') and len(result.boxes) > 0:
-                    best_box, class_name = self._process_detection(result)
+        except Exception as e:
+            logger.error(f"Ошибка при оценке модели: {str(e)}", exc_info=True)
+            raise
 
-                    if class_name in ['Glioma', 'Meningioma', 'Pituitary']:
-                        logger.info(f"🟢 Выбранный класс: {class_name}")
-                        self._save_prediction(best_box, result, test_image_path, save_vis_dir, prefix, idx)
-                    else:
-                        no_tumor_data = (best_box, result, idx, class_name)
+    def evaluate_batch(self, items: List[Tuple[Union[str, np.ndarray], str, Optional[str]]], prefix: str = "",
+                       device: str = "cpu", return_annotations: bool = False) -> List[Dict[str, Any]]:
+        """
+        Оценивает модель на батче изображений за один вызов и сохраняет визуализации предсказаний.
 
-                    metrics.update(self._calculate_metrics(best_box))
-                else:
-                    logger.warning("Нет боксов для оценки.")
-                    metrics.update({'avg_confidence': 'N/A', 'max_confidence': 'N/A'})
+        Args:
+            items (List[Tuple[Union[str, np.ndarray], str, Optional[str]]]): Тройки
+                (путь или изображение, имя изображения, директория для визуализаций).
+            prefix (str): Префикс для имен файлов сохраненных визуализаций.
+            device (str): Устройство для оценки (по умолчанию "cpu").
+            return_annotations (bool): Добавить в результат закодированную визуализацию
+                лучшего бокса ("annotated", bytes или None).
 
-            if no_tumor_data:
-                logger.info(f"🔴 Сохраняем No tumor в конце: {no_tumor_data[3]}")
-                self._save_prediction(
-                    best_box=no_tumor_data[0],
-                    result=no_tumor_data[1],
-                    test_image_path=test_image_path,
-                    save_vis_dir=save_vis_dir,
-                    prefix=prefix,
-                    idx=no_tumor_data[2])
+        Returns:
+            List[Dict[str, Any]]: Метрики и детекции для каждого изображения в порядке items.
+        """
 
-            return metrics
+        try:
+            sources = [source for source, _, _ in items]
+            if not all(isinstance(source, str) for source in sources):
+                # Загрузчик ultralytics не смешивает пути и массивы в одном батче
+                sources = [cv2.imread(source) if isinstance(source, str) else source for source in sources]
+            results = self.predict(sources, device=device, batch=len(sources))
+            return [self._postprocess([result], image_name, save_vis_dir, prefix, return_annotations)
+                    for result, (_, image_name, save_vis_dir) in zip(results, items)]
 
         except Exception as e:
-            logger.error(f"Ошибка при оценке модели: {str(e)}", exc_info=True)
+            logger.error(f"Ошибка при оценке батча: {str(e)}", exc_info=True)
             raise
 
+    def _postprocess(self, results: List[Results], image_name: str, save_vis_dir: Optional[str],
+                     prefix: str, return_annotation: bool = False) -> Dict[str, Any]:
+        """
+        Выбирает лучшие боксы изображения, сохраняет визуализации и считает метрики.
+
+        Args:
+            results (List[Results]): Результаты модели для одного изображения.
+            image_name (str): Имя изображения для файлов визуализаций.
+            save_vis_dir (Optional[str]): Путь к директории для сохранения визуализаций.
+            prefix (str): Префикс для имен файлов сохраненных визуализаций.
+            return_annotation (bool): Добавить закодированную визуализацию в результат.
+
+        Returns:
+            Dict[str, Any]: Метрики оценки модели и все детекции ("detections").
+        """
+
+        metrics = {}
+        detections = []
+        annotated_frame = None
+        no_tumor_data = None
+
+        for idx, result in enumerate(results):
+            if hasattr(result, 'boxes') and len(result.boxes) > 0:
+                detections.extend(self._detections(result))
+                best_box, class_name = self._process_detection(result)
+
+                if class_name in TUMOR_CLASSES:
+                    logger.info(f"🟢 Выбранный класс: {class_name}")
+                    annotated_frame = self._save_prediction(best_box, result, image_name, save_vis_dir, prefix, idx,
+                                                            return_frame=return_annotation)
+                else:
+                    no_tumor_data = (best_box, result, idx, class_name)
+
+                metrics.update(self._calculate_metrics(best_box))
+            else:
+                logger.warning("Нет боксов для оценки.")
+                metrics.update({'avg_confidence': 'N/A', 'max_confidence': 'N/A'})
+
+        if no_tumor_data:
+            logger.info(f"🔴 Сохраняем No tumor в конце: {no_tumor_data[3]}")
+            annotated_frame = self._save_prediction(
+                best_box=no_tumor_data[0],
+                result=no_tumor_data[1],
+                image_name=image_name,
+                save_vis_dir=save_vis_dir,
+                prefix=prefix,
+                idx=no_tumor_data[2],
+                return_frame=return_annotation)
+
+        metrics['detections'] = detections
+        if return_annotation:
+            metrics['annotated'] = None if annotated_frame is None else self.encode_annotation(annotated_frame)
+        return metrics
+
+    def _detections(self, result: Results) -> List[Dict[str, Any]]:
+        """
+        Все боксы результата в виде словарей.
+
+        Args:
+            result (Results): Результаты детекции.
+
+        Returns:
+            List[Dict[str, Any]]: Класс, уверенность и координаты (x1, y1, x2, y2) каждого бокса.
+        """
+
+        boxes = result.boxes
+        return [{'class': result.names[int(class_id)], 'confidence': round(float(conf), 4),
+                 'box': [round(float(value), 1) for value in xyxy]}
+                for xyxy, conf, class_id in zip(boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(),
+                                                boxes.cls.cpu().numpy())]
+
+    def encode_annotation(self, annotated_frame: np.ndarray) -> bytes:
+        """
+        Кодирует визуализацию в формат annotation_format.
+
+        Args:
+            annotated_frame (np.ndarray): Аннотированный кадр BGR.
+
+        Returns:
+            bytes: Закодированное изображение.
+        """
+
+        extension, quality_flag = ANNOTATION_FORMATS[self.annotation_format]
+        ok, buffer = cv2.imencode(extension, annotated_frame, [quality_flag, self.annotation_quality])
+        if not ok:
+            raise IOError(f"Не удалось закодировать визуализацию в {self.annotation_format}")
+        return buffer.tobytes()
+
     def _process_detection(self, result) -> Tuple[Any, str]:
         """
         Обрабатывает детекцию из результатов модели.
@@ -202,26 +467,30 @@ class ModelEvaluator:
             Dict[str, float]: Метрики (средняя и максимальная уверенность).
         """
 
-        conf = best_box.conf.cpu().numpy()[0]
+        conf = float(best_box.conf.cpu().numpy()[0])
         return {'avg_confidence': conf, 'max_confidence': conf}
 
-    def _save_prediction(self, best_box: Any, result: Results, test_image_path: str, 
-                         save_vis_dir: Optional[str], prefix: str, idx: int) -> None:
+    def _save_prediction(self, best_box: Any, result: Results, image_name: str, 
+                         save_vis_dir: Optional[str], prefix: str, idx: int,
+                         return_frame: bool = False) -> Optional[np.ndarray]:
         """
         Сохраняет визуализацию предсказания.
 
         Args:
             best_box: Лучший бокс.
             result: Результаты детекции.
-            test_image_path (str): Путь к тестовому изображению.
+            image_name (str): Имя файла исходного изображения.
             save_vis_dir (Optional[str]): Путь к директории для сохранения визуализаций.
             prefix (str): Префикс для имени файла.
             idx (int): Индекс изображения.
+            return_frame (bool): Вернуть аннотированный кадр.
+
+        Returns:
+            Optional[np.ndarray]: Аннотированный кадр, если return_frame.
         """
 
-        # Создаем новую фигуру и оси для каждого изображения
-        # Размер figsize и dpi можно настроить, если нужно более высокое разрешение
-        fig, ax = plt.subplots(figsize=(result.orig_img.shape[1] / 100, result.orig_img.shape[0] / 100), dpi=100)
+        if not save_vis_dir and not return_frame:
+            return None
 
         try:
             # Создаем новый объект Results с выбранным боксом для plot
@@ -234,30 +503,291 @@ class ModelEvaluator:
             best_result.masks = None
             best_result.probs = None
 
-            # Получаем аннотированный кадр (numpy array)
+            # Аннотированный кадр (BGR, размер исходного изображения) кодируется сразу в файл
             annotated_frame = best_result.plot()
-            
-            # Отображаем его на созданных осях
-            ax.imshow(annotated_frame)
-            ax.axis('off') # Убираем оси
 
             if save_vis_dir:
                 os.makedirs(save_vis_dir, exist_ok=True)
                 class_id = int(best_box.cls.cpu().numpy()[0])
                 class_name = result.names[class_id]
-                file_basename = os.path.basename(test_image_path).replace('.', f'_pred_{idx+1}.')
-                outname = f"{class_name}_{file_basename}"
+                extension, quality_flag = ANNOTATION_FORMATS[self.annotation_format]
+                stem, _ = os.path.splitext(image_name)
+                outname = f"{class_name}_{stem}_pred_{idx+1}{extension}"
                 save_path = os.path.join(save_vis_dir, outname)
-                
-                # Сохраняем текущую фигуру (fig)
-                fig.savefig(save_path, bbox_inches='tight', pad_inches=0)
+
+                if not cv2.imwrite(save_path, annotated_frame, [quality_flag, self.annotation_quality]):
+                    raise IOError(f"Не удалось записать {save_path}")
                 logger.info(f"Сохранено: {save_path}")
 
+            return annotated_frame if return_frame else None
+
         except Exception as e:
             logger.error(f"Ошибка при сохранении предсказания: {str(e)}", exc_info=True)
             raise
-        finally:
-            plt.close(fig) 
+
+
+def load_validation_images(path: str, limit: int = 64) -> List[np.ndarray]:
+    """
+    Загружает изображения для проверки согласия моделей.
+
+    Args:
+        path (str): Папка с PNG/JPEG или файл slices.npz.
+        limit (int): Максимальное количество изображений.
+
+    Returns:
+        List[np.ndarray]: Изображения BGR.
+    """
+
+    if os.path.isfile(path):
+        return [image for image, _ in load_slice_stack(path)[:limit]]
+
+    paths = sorted(glob.glob(os.path.join(path, "*.png")) + glob.glob(os.path.join(path, "*.jpg")))[:limit]
+    return [image for image in (cv2.imread(p) for p in paths) if image is not None]
+
+
+def _box_iou(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    top_left = np.maximum(box[:2], boxes[:, :2])
+    bottom_right = np.minimum(box[2:], boxes[:, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=1)
+    area = np.prod(box[2:] - box[:2])
+    areas = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    return intersection / np.maximum(area + areas - intersection, 1e-9)
+
+
+def compare_detections(reference: ModelEvaluator, candidate: ModelEvaluator, images: List[np.ndarray],
+                       iou_threshold: float = 0.5, device: str = "cpu", batch_size: int = 16) -> Dict[str, Any]:
+    """
+    Сравнивает детекции двух моделей на одних и тех же изображениях.
+
+    Боксы сопоставляются жадно по убыванию уверенности: бокс кандидата того же
+    класса с IoU не ниже порога. Согласие — 2 * совпавшие / (боксы эталона +
+    боксы кандидата), изображения без боксов у обеих моделей считаются совпавшими.
+
+    Args:
+        reference (ModelEvaluator): Эталонная модель (обычно PyTorch).
+        candidate (ModelEvaluator): Проверяемая модель.
+        images (List[np.ndarray]): Изображения BGR.
+        iou_threshold (float): Минимальный IoU для совпадения боксов.
+        device (str): Устройство для инференса.
+        batch_size (int): Размер батча.
+
+    Returns:
+        Dict[str, Any]: Согласие, количество боксов, средний IoU и максимальная разница уверенности.
+
+    Raises:
+        ValueError: Нет изображений: без них согласие ничего не проверяет.
+    """
+
+    if not images:
+        raise ValueError("Нет изображений для сравнения детекций")
+
+    matched = reference_boxes = candidate_boxes = 0
+    ious, conf_diffs = [], []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        reference_results = reference.predict(batch, device=device, verbose=False, batch=len(batch))
+        candidate_results = candidate.predict(batch, device=device, verbose=False, batch=len(batch))
+
+        for ref, cand in zip(reference_results, candidate_results):
+            ref_xyxy, ref_conf, ref_cls = (ref.boxes.xyxy.cpu().numpy(), ref.boxes.conf.cpu().numpy(),
+                                           ref.boxes.cls.cpu().numpy())
+            cand_xyxy, cand_conf, cand_cls = (cand.boxes.xyxy.cpu().numpy(), cand.boxes.conf.cpu().numpy(),
+                                              cand.boxes.cls.cpu().numpy())
+            reference_boxes += len(ref_xyxy)
+            candidate_boxes += len(cand_xyxy)
+            if not len(ref_xyxy) and not len(cand_xyxy):
+                continue
+
+            used = np.zeros(len(cand_xyxy), dtype=bool)
+            for i in np.argsort(-ref_conf):
+                if not len(cand_xyxy):
+                    break
+                overlap = _box_iou(ref_xyxy[i], cand_xyxy)
+                overlap[(cand_cls != ref_cls[i]) | used] = 0
+                j = int(overlap.argmax())
+                if overlap[j] >= iou_threshold:
+                    used[j] = True
+                    matched += 1
+                    ious.append(float(overlap[j]))
+                    conf_diffs.append(abs(float(ref_conf[i]) - float(cand_conf[j])))
+
+    total = reference_boxes + candidate_boxes
+    return {
+        "images": len(images),
+        "reference_boxes": reference_boxes,
+        "candidate_boxes": candidate_boxes,
+        "matched": matched,
+        "agreement": round(2 * matched / total, 4) if total else 1.0,
+        "mean_iou": round(float(np.mean(ious)), 4) if ious else None,
+        "max_conf_diff": round(float(max(conf_diffs)), 4) if conf_diffs else 0.0,
+    }
+
+
+def check_backend_parity(model_path: str, backend: str, images: List[np.ndarray], min_agreement: float = 0.95,
+                         conf_tolerance: float = 0.05, iou_threshold: float = 0.5,
+                         reference: Optional[ModelEvaluator] = None,
+                         candidate: Optional[ModelEvaluator] = None) -> Dict[str, Any]:
+    """
+    Проверяет, что экспортированная модель даёт те же боксы и уверенности, что и исходная.
+
+    Args:
+        model_path (str): Путь к весам PyTorch.
+        backend (str): Проверяемый бэкенд ("onnx" или "torchscript").
+        images (List[np.ndarray]): Изображения для проверки.
+        min_agreement (float): Минимальное согласие детекций.
+        conf_tolerance (float): Максимальная разница уверенности совпавших боксов.
+        iou_threshold (float): Минимальный IoU для совпадения боксов.
+        reference (Optional[ModelEvaluator]): Уже загруженная исходная модель.
+        candidate (Optional[ModelEvaluator]): Уже загруженная экспортированная модель.
+
+    Returns:
+        Dict[str, Any]: Отчёт compare_detections и флаг passed.
+    """
+
+    if not images:
+        raise ValueError("Для проверки паритета нужны проверочные изображения")
+
+    reference = reference or ModelEvaluator(model_path)
+    candidate = candidate or ModelEvaluator(model_path, backend=backend)
+    report = compare_detections(reference, candidate, images, iou_threshold=iou_threshold)
+    report.update(backend=backend, min_agreement=min_agreement, conf_tolerance=conf_tolerance,
+                  passed=report["agreement"] >= min_agreement and report["max_conf_diff"] <= conf_tolerance)
+    log = logger.info if report["passed"] else logger.warning
+    log(f"Проверка паритета {backend}: {report}")
+    return report
+
+
+def _current_rss_mb() -> Optional[float]:
+    """
+    Текущий RSS процесса в мегабайтах (Linux, иначе None).
+    """
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def profile_evaluator(factory: Any, images: List[np.ndarray], device: str = "cpu",
+                      batch_size: int = 16, repeats: int = 3) -> Tuple[ModelEvaluator, Dict[str, Any]]:
+    """
+    Загружает модель и замеряет прирост памяти и задержку инференса.
+
+    Args:
+        factory (Callable[[], ModelEvaluator]): Создаёт модель.
+        images (List[np.ndarray]): Изображения для замера.
+        device (str): Устройство для инференса.
+        batch_size (int): Размер батча.
+        repeats (int): Количество прогонов для замера задержки.
+
+    Returns:
+        Tuple[ModelEvaluator, Dict[str, Any]]: Модель и её замеры (мс на изображение, МБ RSS).
+    """
+
+    rss_before = _current_rss_mb()
+    started = time.perf_counter()
+    evaluator = factory()
+    load_ms = (time.perf_counter() - started) * 1000
+    rss_after = _current_rss_mb()
+
+    # Первый прогон — прогрев, он в задержку не входит
+    batch = images[:batch_size]
+    evaluator.predict(batch, device=device, verbose=False, batch=len(batch))
+    started = time.perf_counter()
+    for _ in range(repeats):
+        evaluator.predict(batch, device=device, verbose=False, batch=len(batch))
+    latency_ms = (time.perf_counter() - started) * 1000 / (repeats * max(len(batch), 1))
+
+    return evaluator, {
+        "precision": evaluator.precision,
+        "backend": evaluator.backend,
+        "load_ms": round(load_ms, 1),
+        "latency_ms_per_image": round(latency_ms, 2),
+        "rss_delta_mb": round(rss_after - rss_before, 1) if rss_before is not None else None,
+        "rss_mb": round(_current_rss_mb(), 1) if rss_before is not None else None,
+    }
+
+
+def check_precision_gate(model_path: str, precision: str, images: List[np.ndarray], min_agreement: float = 0.9,
+                         iou_threshold: float = 0.5, imgsz: int = 640,
+                         evaluator_options: Optional[Dict[str, Any]] = None
+                         ) -> Tuple[Dict[str, Any], ModelEvaluator, ModelEvaluator]:
+    """
+    Сравнивает режим пониженной точности с fp32 и решает, можно ли его включать.
+
+    Обе модели прогоняются по проверочным изображениям; режим проходит, если
+    согласие детекций не ниже min_agreement. В отчёт попадают задержка и
+    память обоих режимов.
+
+    Args:
+        model_path (str): Путь к весам PyTorch.
+        precision (str): "bf16" или "int8".
+        images (List[np.ndarray]): Проверочные изображения.
+        min_agreement (float): Минимальное согласие детекций с fp32.
+        iou_threshold (float): Минимальный IoU для совпадения боксов.
+        imgsz (int): Размер входа экспортированной модели.
+        evaluator_options (Optional[Dict[str, Any]]): Аргументы ModelEvaluator (формат визуализаций и т.д.).
+
+    Returns:
+        Tuple[Dict[str, Any], ModelEvaluator, ModelEvaluator]: Отчёт (с флагом passed),
+            модель fp32 и модель пониженной точности.
+    """
+
+    if not images:
+        raise ValueError("Для проверки точности нужны проверочные изображения")
+
+    options = {key: value for key, value in (evaluator_options or {}).items()
+               if key not in ("backend", "precision", "imgsz")}
+    reference, reference_profile = profile_evaluator(lambda: ModelEvaluator(model_path, **options), images)
+    candidate, candidate_profile = profile_evaluator(
+        lambda: ModelEvaluator(model_path, imgsz=imgsz, precision=precision, **options), images)
+
+    report = compare_detections(reference, candidate, images, iou_threshold=iou_threshold)
+    report.update(precision=precision, min_agreement=min_agreement, passed=report["agreement"] >= min_agreement,
+                  fp32=reference_profile, candidate=candidate_profile)
+    log = logger.info if report["passed"] else logger.warning
+    log(f"Проверка точности {precision}: {report}")
+    return report, reference, candidate
+
+
+def summarize_study(images: List[Dict[str, Any]], min_tumor_slices: int = 1) -> Dict[str, Any]:
+    """
+    Сводит детекции срезов в итог по исследованию.
+
+    На каждом срезе учитывается бокс с максимальной уверенностью. Диагноз —
+    класс опухоли с наибольшей суммарной уверенностью по срезам, где он
+    лучший; если срезов с опухолью меньше min_tumor_slices, итог — "No tumor".
+
+    Args:
+        images (List[Dict[str, Any]]): Результаты срезов с полями "image" и "detections".
+        min_tumor_slices (int): Минимальное количество срезов с опухолью.
+
+    Returns:
+        Dict[str, Any]: Диагноз, его максимальная уверенность и лучший срез,
+            количество срезов всего, с опухолью и по классам.
+    """
+
+    scores, best, classes = {}, {}, {}
+    for image in images:
+        if not image.get("detections"):
+            continue
+        top = max(image["detections"], key=lambda detection: detection["confidence"])
+        class_name, confidence = top["class"], top["confidence"]
+        if class_name not in TUMOR_CLASSES:
+            continue
+        classes[class_name] = classes.get(class_name, 0) + 1
+        scores[class_name] = scores.get(class_name, 0.0) + confidence
+        if class_name not in best or confidence > best[class_name][1]:
+            best[class_name] = (image["image"], confidence)
+
+    tumor_slices = sum(classes.values())
+    verdict = {"diagnosis": NO_TUMOR, "confidence": None, "best_slice": None,
+               "slices": len(images), "tumor_slices": tumor_slices, "classes": classes}
+    if tumor_slices and tumor_slices >= min_tumor_slices:
+        diagnosis = max(scores, key=scores.get)
+        verdict.update(diagnosis=diagnosis, best_slice=best[diagnosis][0], confidence=best[diagnosis][1])
+    return verdict
 
 
 class ModelComparator:
@@ -326,7 +856,100 @@ class InferencePipeline:
     """
 
     @staticmethod
-    def run_inference(best_model: str, media_root: str, single_folder_id: Optional[str] = None, device: str = "cpu") -> None:
+    def collect_images(raw_dirs: List[str]) -> List[Tuple[Union[str, np.ndarray], str, str]]:
+        """
+        Собирает изображения для инференса из папок raw.
+
+        Если в папке есть массив срезов slices.npz, изображения берутся из него
+        без декодирования PNG, иначе используются PNG файлы папки.
+
+        Args:
+            raw_dirs (List[str]): Папки raw пациентов.
+
+        Returns:
+            List[Tuple[Union[str, np.ndarray], str, str]]: Тройки (путь или изображение, имя изображения, папка raw).
+        """
+
+        items = []
+        for raw_dir in raw_dirs:
+            stack_path = os.path.join(raw_dir, STACK_FILENAME)
+            if os.path.exists(stack_path):
+                logger.info(f"Используем массив срезов {stack_path}")
+                items.extend((image, name, raw_dir) for image, name in load_slice_stack(stack_path))
+            else:
+                items.extend((path, os.path.basename(path), raw_dir)
+                             for path in glob.glob(os.path.join(raw_dir, "*.png")))
+        return items
+
+    @staticmethod
+    def prepare_items(media_root: str, single_folder_id: Optional[str] = None
+                      ) -> List[Tuple[Union[str, np.ndarray], str, str]]:
+        """
+        Собирает изображения папки (или всех папок) и создаёт для них папки predict.
+
+        Args:
+            media_root (str): Путь к корневой директории с изображениями.
+            single_folder_id (Optional[str]): ID папки для инференса (по умолчанию все папки).
+
+        Returns:
+            List[Tuple[Union[str, np.ndarray], str, str]]: Тройки (путь или изображение,
+                имя изображения, папка predict).
+        """
+
+        if single_folder_id:
+            target_dir = os.path.join(media_root, single_folder_id, "raw")
+            if not os.path.exists(target_dir):
+                logger.error(f"Папка {target_dir} не найдена!")
+                raise FileNotFoundError(f"Folder not found: {target_dir}")
+            raw_dirs = [target_dir]
+            logger.info(f"Инференс только для папки: {single_folder_id}/raw")
+        else:
+            raw_dirs = glob.glob(os.path.join(media_root, "*", "raw"))
+            logger.info(f"Инференс для всех папок в: {media_root}")
+
+        items = []
+        for source, image_name, raw_dir in InferencePipeline.collect_images(raw_dirs):
+            predict_dir = os.path.join(os.path.dirname(raw_dir), "predict")
+            os.makedirs(predict_dir, exist_ok=True)
+            items.append((source, image_name, predict_dir))
+
+        if not items:
+            logger.error("Не найдено изображений для инференса!")
+            raise FileNotFoundError("No images found for inference")
+        return items
+
+    @staticmethod
+    def save_detections(predict_dir: str, images: List[Dict[str, Any]], min_tumor_slices: int = 1) -> Dict[str, Any]:
+        """
+        Сохраняет детекции срезов и итог исследования в detections.json папки predict.
+
+        Args:
+            predict_dir (str): Папка predict исследования.
+            images (List[Dict[str, Any]]): Результаты срезов с полями "image" и "detections".
+            min_tumor_slices (int): Минимальное количество срезов с опухолью для диагноза.
+
+        Returns:
+            Dict[str, Any]: Итог исследования (см. summarize_study).
+        """
+
+        verdict = summarize_study(images, min_tumor_slices)
+        sidecar = {
+            "verdict": verdict,
+            "images": [{"image": image["image"], "detections": image.get("detections", [])} for image in images],
+        }
+        path = os.path.join(predict_dir, DETECTIONS_FILENAME)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(sidecar, f, separators=(",", ":"))
+        # Сайт не увидит наполовину записанный файл
+        os.replace(tmp_path, path)
+        logger.info(f"Итог {predict_dir}: {verdict['diagnosis']} ({verdict['tumor_slices']}/{verdict['slices']} срезов)")
+        return verdict
+
+    @staticmethod
+    def run_inference(best_model: str, media_root: str, single_folder_id: Optional[str] = None, device: str = "cpu",
+                      evaluator: Optional[ModelEvaluator] = None, batch_size: int = 1,
+                      min_tumor_slices: int = 1) -> Dict[str, Dict[str, Any]]:
         """
         Выполняет инференс лучшей модели на изображениях.
 
@@ -335,39 +958,45 @@ class InferencePipeline:
             media_root (str): Путь к корневой директории с изображениями.
             single_folder_id (Optional[str]): ID папки для инференса (по умолчанию None).
             device (str): Устройство для инференса (по умолчанию "cpu").
+            evaluator (Optional[ModelEvaluator]): Уже загруженная модель (по умолчанию
+                загружается из best_model).
+            batch_size (int): Количество срезов в одном вызове модели (по умолчанию 1 — по одному).
+            min_tumor_slices (int): Минимальное количество срезов с опухолью для диагноза.
+
+        Returns:
+            Dict[str, Dict[str, Any]]: Итог исследования для каждой папки predict.
         """
 
         try:
             logger.info(f"\n=== Инференс лучшей модели: {best_model} ===")
-            evaluator = ModelEvaluator(best_model)
-
-            if single_folder_id:
-                target_dir = os.path.join(media_root, single_folder_id, "raw")
-                if not os.path.exists(target_dir):
-                    logger.error(f"Папка {target_dir} не найдена!")
-                    raise FileNotFoundError(f"Folder not found: {target_dir}")
-                all_raw_images = glob.glob(os.path.join(target_dir, "*.png"))
-                logger.info(f"Инференс только для папки: {single_folder_id}/raw")
+            evaluator = evaluator or ModelEvaluator(best_model)
+
+            items = InferencePipeline.prepare_items(media_root, single_folder_id)
+
+            results = []
+            if batch_size > 1:
+                for start in range(0, len(items), batch_size):
+                    batch = items[start:start + batch_size]
+                    logger.info(f"\n--- Предикт для батча {start // batch_size + 1}: {len(batch)} срезов ---")
+                    results.extend(evaluator.evaluate_batch(batch, prefix="", device=device))
             else:
-                all_raw_images = glob.glob(os.path.join(media_root, "*", "raw", "*.png"))
-                logger.info(f"Инференс для всех папок в: {media_root}")
-
-            if not all_raw_images:
-                logger.error("Не найдено изображений для инференса!")
-                raise FileNotFoundError("No images found for inference")
-
-            for img_path in all_raw_images:
-                base_dir = os.path.dirname(os.path.dirname(img_path))
-                predict_dir = os.path.join(base_dir, "predict")
-                os.makedirs(predict_dir, exist_ok=True)
-                logger.info(f"\n--- Предикт для {img_path} ---")
-                evaluator.evaluate(
-                    test_image_path=img_path,
-                    save_vis_dir=predict_dir,
-                    prefix="",
-                    device=device) # Передаем device
+                for source, image_name, predict_dir in items:
+                    logger.info(f"\n--- Предикт для {image_name} -> {predict_dir} ---")
+                    results.append(evaluator.evaluate(
+                        test_image_path=source,
+                        save_vis_dir=predict_dir,
+                        prefix="",
+                        device=device,
+                        image_name=image_name)) # Передаем device
+
+            studies = {}
+            for (_, image_name, predict_dir), metrics in zip(items, results):
+                studies.setdefault(predict_dir, []).append({"image": image_name, **metrics})
+            verdicts = {predict_dir: InferencePipeline.save_detections(predict_dir, images, min_tumor_slices)
+                        for predict_dir, images in studies.items()}
 
             logger.info("\nВсе предсказания завершены и сохранены.")
+            return verdicts
 
         except Exception as e:
             logger.error(f"Ошибка при выполнении инференса: {str(e)}", exc_info=True)
@@ -393,6 +1022,17 @@ def main():
         parser.add_argument("--media_root", type=str, default="media/png", help="Корень с media/png/001, 002, ...")
         parser.add_argument("--yolo_dir", type=str, default="media/yolo/yoloruns", help="Куда сохранять веса и runs YOLO")
         parser.add_argument("--single_folder_id", type=str, help="ID папки для инференса (например, 007)")
+        parser.add_argument("--inference_batch", type=int, default=16, help="Срезов в одном вызове модели при инференсе")
+        parser.add_argument("--backend", type=str, default=BACKEND_PYTORCH,
+                            choices=[BACKEND_PYTORCH, *EXPORT_BACKENDS], help="Бэкенд инференса")
+        parser.add_argument("--parity_images", type=str,
+                            help="Папка или slices.npz для проверки паритета бэкенда с PyTorch")
+        parser.add_argument("--precision", type=str, default=PRECISION_FP32, choices=PRECISIONS,
+                            help="Точность инференса на CPU (bf16/int8 включаются только после проверки на --parity_images)")
+        parser.add_argument("--min_agreement", type=float, default=0.9,
+                            help="Минимальное согласие детекций режима пониженной точности с fp32")
+        parser.add_argument("--min_tumor_slices", type=int, default=1,
+                            help="Минимальное количество срезов с опухолью для диагноза исследования")
         args = parser.parse_args()
 
         save_root = args.yolo_dir
@@ -446,10 +1086,33 @@ def main():
                 best_model = f.read().strip()
 
         if best_model:
+            evaluator = None
+            if args.precision != PRECISION_FP32:
+                if not args.parity_images:
+                    raise ValueError("Для --precision bf16/int8 нужен --parity_images")
+                report, _, candidate = check_precision_gate(best_model, args.precision,
+                                                            load_validation_images(args.parity_images),
+                                                            min_agreement=args.min_agreement)
+                if report["passed"]:
+                    evaluator = candidate
+                else:
+                    logger.warning(f"Режим {args.precision} не прошёл проверку точности, используем fp32")
+            elif args.backend != BACKEND_PYTORCH:
+                evaluator = ModelEvaluator(best_model, backend=args.backend)
+                if args.parity_images:
+                    report = check_backend_parity(best_model, args.backend, load_validation_images(args.parity_images),
+                                                  candidate=evaluator)
+                    if not report["passed"]:
+                        logger.warning(f"Бэкенд {args.backend} не прошёл проверку паритета, используем PyTorch")
+                        evaluator = None
+
             InferencePipeline.run_inference(
                 best_model=best_model,
                 media_root=args.media_root,
-                single_folder_id=args.single_folder_id
+                single_folder_id=args.single_folder_id,
+                batch_size=args.inference_batch,
+                min_tumor_slices=args.min_tumor_slices,
+                evaluator=evaluator
             )
 
     except Exception as e: